@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# ALNUSIRY BOT - الاختبار التاريخي (Backtest) لملفات الاستراتيجيات
+# يعيد تشغيل شموع M5 (و M15/H1 إن وجدت) من ملفات محلية بنفس قواعد البوت المباشر:
+# أصوات المؤشرات وأنماط الشموع، فلتر الاتجاه، ثم التأكيد بعد confirmation_minutes.
+# كل شيء محسوب متجهياً على كامل التاريخ دفعة واحدة (دوال Panel Scoring من main.py) وليس شمعة بشمعة.
+#
+# الملفات: <DATA_DIR>/EURUSD_M5.csv (وبشكل اختياري EURUSD_M15.csv و EURUSD_H1.csv)
+# الأعمدة: datetime (ISO أو ملي ثانية) ثم Open, High, Low, Close, Volume (أو o, h, l, c, v و t بصيغة Polygon).
+#
+# الاستخدام:
+#   python backtest.py --data-dir data --profile default.json --start 2022-01-01
+
+import argparse
+import json
+import math
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from main import (
+    STRATEGIES_DIR, USER_DEFINED_PAIRS, TIMEFRAME_BUCKETS, INDICATOR_COLUMNS,
+    resample_candles, compute_panel_indicators, compute_panel_votes, compute_panel_pattern_votes, trend_filter_masks
+)
+
+PRICE_COLUMNS = ('Open', 'High', 'Low', 'Close')
+# آفاق العائد اللاحق بعدد شموع M5: 5 دقائق، 15 دقيقة، 30 دقيقة، ساعة.
+FORWARD_HORIZONS = (1, 3, 6, 12)
+COLUMN_ALIASES = {'o': 'Open', 'open': 'Open', 'h': 'High', 'high': 'High', 'l': 'Low', 'low': 'Low',
+                  'c': 'Close', 'close': 'Close', 'v': 'Volume', 'volume': 'Volume'}
+TIME_COLUMNS = ('datetime', 'timestamp', 'time', 'date', 't')
+
+# --- تحميل البيانات ---
+def history_path(data_dir: str, pair: str, timeframe: str) -> str:
+    return os.path.join(data_dir, f"{pair.replace('/', '')}_{timeframe}.csv")
+
+def load_history(data_dir: str, pair: str, timeframe: str) -> pd.DataFrame:
+    """يقرأ ملف شموع ويعيده بنفس شكل ذاكرة الشموع في البوت، أو None إذا لم يوجد الملف."""
+    path = history_path(data_dir, pair, timeframe)
+    if not os.path.exists(path): return None
+    df = pd.read_csv(path)
+    df.columns = [str(col).strip() for col in df.columns]
+    time_col = next((col for col in df.columns if col.lower() in TIME_COLUMNS), df.columns[0])
+    times = df.pop(time_col)
+    unit = 'ms' if pd.api.types.is_numeric_dtype(times) else None
+    df.index = pd.DatetimeIndex(pd.to_datetime(times, unit=unit, utc=True), name='datetime')
+    df = df.rename(columns=lambda col: COLUMN_ALIASES.get(col.lower(), col))
+    if 'Volume' not in df: df['Volume'] = 0.0
+    df = df[list(PRICE_COLUMNS) + ['Volume']].astype(float)
+    return df[~df.index.duplicated(keep='last')].sort_index()
+
+def load_profile(profile: str) -> dict:
+    path = profile if os.path.exists(profile) else os.path.join(STRATEGIES_DIR, profile)
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+# --- الحساب المتجه ---
+def trend_series(m5_end: pd.DatetimeIndex, bars: pd.DataFrame, timeframe: str, period: int) -> np.ndarray:
+    """اتجاه M15/H1 المعروف عند إغلاق كل شمعة M5: آخر شمعة مغلقة في الإطار مقابل EMA (مثل compute_pair_trends)."""
+    if bars is None or bars.empty: return np.full(len(m5_end), 'NEUTRAL')
+    close = bars['Close']
+    ema = close.ewm(span=period, min_periods=period, adjust=False).mean()
+    trend = np.where(ema.isna(), 'NEUTRAL', np.where(close > ema, 'UP', 'DOWN'))
+    # الأزمنة كأعداد صحيحة بالنانو ثانية: searchsorted على int64 أسرع بكثير من كائنات Timestamp.
+    bucket_close = (bars.index + TIMEFRAME_BUCKETS[timeframe]).as_unit('ns').asi8
+    position = np.searchsorted(bucket_close, m5_end.as_unit('ns').asi8, side='right') - 1
+    return np.where(position >= 0, trend[position.clip(0)], 'NEUTRAL')
+
+def raw_scores(m5: pd.DataFrame, profile: dict) -> (np.ndarray, np.ndarray):
+    """قوة الشراء والبيع لكل شمعة قبل فلتر الاتجاه (كما يحسبها التأكيد)."""
+    params = profile.get('indicator_params', {})
+    panel = {col: m5[col].to_numpy(dtype=float)[np.newaxis, :] for col in PRICE_COLUMNS}
+    ind = compute_panel_indicators(panel, params)
+    buy, sell = compute_panel_votes(panel, ind, profile.get('macd_strategy', 'dynamic'))
+    pattern_buy, pattern_sell = compute_panel_pattern_votes(panel)
+    valid = np.logical_and.reduce([~np.isnan(ind[name][0]) for name in INDICATOR_COLUMNS])
+    # مثل analyze_signal_strength: لا تقييم قبل توفر أطول فترة في الإعدادات.
+    required_len = max(v for k, v in params.items() if 'period' in k)
+    valid[:required_len - 1] = False
+    return np.where(valid, buy[0] + pattern_buy[0], 0), np.where(valid, sell[0] + pattern_sell[0], 0)
+
+def pair_trends(m5: pd.DataFrame, m15: pd.DataFrame, h1: pd.DataFrame, params: dict) -> (np.ndarray, np.ndarray):
+    m5_end = m5.index + TIMEFRAME_BUCKETS['M5']
+    m15 = m15 if m15 is not None else resample_candles(m5, 'M15')
+    h1 = h1 if h1 is not None else resample_candles(m5, 'H1')
+    return (trend_series(m5_end, m15, 'M15', params.get('m15_ema_period', 50)),
+            trend_series(m5_end, h1, 'H1', params.get('h1_ema_period', 50)))
+
+def evaluate_signals(close: np.ndarray, raw_buy: np.ndarray, raw_sell: np.ndarray, trend_m15: np.ndarray, trend_h1: np.ndarray,
+                     profile: dict, window: np.ndarray = None) -> dict:
+    """يستخرج الإشارات الأولية ونتائج تأكيدها والعوائد اللاحقة، كلها بعمليات مصفوفات."""
+    block_buy, block_sell = trend_filter_masks(profile.get('trend_filter_mode', 'M15'), trend_m15, trend_h1)
+    buy, sell = np.where(block_buy, 0, raw_buy), np.where(block_sell, 0, raw_sell)
+    initial_confidence = profile.get('initial_confidence', 3)
+    is_buy = (buy > sell) & (buy >= initial_confidence)
+    is_sell = (sell > buy) & (sell >= initial_confidence)
+    if window is not None: is_buy, is_sell = is_buy & window, is_sell & window
+
+    # التأكيد على أول شمعة مغلقة بعد مهلة التأكيد، بلا فلتر اتجاه (البوت يمرر NEUTRAL للتأكيد).
+    delay_bars = max(1, math.ceil(profile.get('confirmation_minutes', 5) / 5))
+    signal_bars = np.flatnonzero(is_buy | is_sell)
+    signal_bars = signal_bars[signal_bars + delay_bars < len(close)]
+    direction = np.where(is_buy[signal_bars], 1, -1)
+    entry = signal_bars + delay_bars
+    confirmation_confidence = profile.get('confirmation_confidence', 4)
+    entry_buy, entry_sell = raw_buy[entry], raw_sell[entry]
+    confirmed = np.where(direction == 1,
+                         (entry_buy > entry_sell) & (entry_buy >= confirmation_confidence),
+                         (entry_sell > entry_buy) & (entry_sell >= confirmation_confidence))
+
+    # العائد اللاحق بنقاط الأساس من إغلاق شمعة التأكيد، باتجاه الإشارة.
+    returns = {}
+    for horizon in FORWARD_HORIZONS:
+        exit_bar = entry + horizon
+        inside = exit_bar < len(close)
+        change = np.full(len(entry), np.nan)
+        change[inside] = (close[exit_bar[inside]] - close[entry[inside]]) / close[entry[inside]] * 1e4
+        returns[horizon] = direction * change
+    return {'bars': signal_bars, 'direction': direction, 'confirmed': confirmed, 'returns': returns}
+
+def summarize(signals: dict) -> dict:
+    confirmed = signals['confirmed']
+    summary = {'initial': int(len(confirmed)), 'buy': int((signals['direction'] == 1).sum()),
+               'sell': int((signals['direction'] == -1).sum()), 'confirmed': int(confirmed.sum()),
+               'confirmation_rate': float(confirmed.mean()) if len(confirmed) else 0.0, 'forward': {}}
+    for horizon, returns in signals['returns'].items():
+        groups = {'all': returns, 'confirmed': returns[confirmed], 'failed': returns[~confirmed]}
+        summary['forward'][horizon] = {
+            name: {'mean_bps': float(np.nanmean(values)) if np.isfinite(values).any() else None,
+                   'hit_rate': float((values[np.isfinite(values)] > 0).mean()) if np.isfinite(values).any() else None}
+            for name, values in groups.items()}
+    return summary
+
+def backtest_pair(data_dir: str, pair: str, profile: dict, start: str = None, end: str = None) -> dict:
+    m5 = load_history(data_dir, pair, 'M5')
+    if m5 is None or m5.empty: return None
+    params = profile.get('indicator_params', {})
+    raw_buy, raw_sell = raw_scores(m5, profile)
+    trend_m15, trend_h1 = pair_trends(m5, load_history(data_dir, pair, 'M15'), load_history(data_dir, pair, 'H1'), params)
+    # المؤشرات تُحسب على كل الملف (فترة الإحماء)، والفترة المطلوبة تحدد فقط الإشارات المحتسبة.
+    window = np.ones(len(m5), dtype=bool)
+    if start: window &= m5.index >= pd.Timestamp(start, tz='UTC')
+    if end: window &= m5.index < pd.Timestamp(end, tz='UTC')
+    signals = evaluate_signals(m5['Close'].to_numpy(dtype=float), raw_buy, raw_sell, trend_m15, trend_h1, profile, window)
+    summary = summarize(signals)
+    summary['bars'] = int(window.sum())
+    return summary
+
+def run_backtest(data_dir: str, profile: dict, pairs: list, start: str = None, end: str = None) -> dict:
+    return {pair: result for pair in pairs if (result := backtest_pair(data_dir, pair, profile, start, end)) is not None}
+
+# --- التقرير ---
+def format_rate(value) -> str:
+    return "-" if value is None else f"{value * 100:.1f}%"
+
+def format_bps(value) -> str:
+    return "-" if value is None else f"{value:+.1f}"
+
+def print_report(profile: dict, results: dict, elapsed: float):
+    print(f"ملف الاستراتيجية: {profile.get('profile_name', '-')}")
+    print(f"فلتر الاتجاه: {profile.get('trend_filter_mode', 'M15')}، الماكد: {profile.get('macd_strategy', 'dynamic')}، "
+          f"الثقة: {profile.get('initial_confidence', 3)}/{profile.get('confirmation_confidence', 4)}")
+    header = f"{'الزوج':<10}{'شموع':>9}{'أولية':>8}{'مؤكدة':>8}{'النسبة':>8}" + "".join(f"{f'+{h * 5}د':>10}" for h in FORWARD_HORIZONS)
+    print(header)
+    for pair, summary in results.items():
+        forward = "".join(f"{format_bps(summary['forward'][h]['confirmed']['mean_bps']):>10}" for h in FORWARD_HORIZONS)
+        print(f"{pair:<10}{summary['bars']:>9}{summary['initial']:>8}{summary['confirmed']:>8}"
+              f"{format_rate(summary['confirmation_rate']):>8}{forward}")
+
+    initial = sum(s['initial'] for s in results.values())
+    confirmed = sum(s['confirmed'] for s in results.values())
+    print(f"\nالمجموع: {initial} إشارة أولية، {confirmed} مؤكدة ({format_rate(confirmed / initial if initial else None)})")
+    print("العوائد اللاحقة أعلاه متوسط نقاط الأساس للإشارات المؤكدة من إغلاق شمعة التأكيد.")
+    print(f"المدة: {elapsed:.2f} ث")
+
+def main():
+    parser = argparse.ArgumentParser(description="اختبار تاريخي لملف استراتيجية على شموع محلية.")
+    parser.add_argument('--data-dir', default='data', help="مجلد ملفات الشموع (EURUSD_M5.csv ...)")
+    parser.add_argument('--profile', default='default.json', help="اسم ملف في strategies/ أو مسار كامل")
+    parser.add_argument('--pairs', default=",".join(USER_DEFINED_PAIRS), help="أزواج مفصولة بفواصل")
+    parser.add_argument('--start', help="بداية الفترة (UTC)، مثل 2022-01-01")
+    parser.add_argument('--end', help="نهاية الفترة (UTC)، غير شاملة")
+    parser.add_argument('--json', action='store_true', help="طباعة النتائج بصيغة JSON")
+    args = parser.parse_args()
+
+    profile = load_profile(args.profile)
+    started = time.perf_counter()
+    results = run_backtest(args.data_dir, profile, [p.strip() for p in args.pairs.split(',') if p.strip()], args.start, args.end)
+    elapsed = time.perf_counter() - started
+    if args.json:
+        print(json.dumps({'profile': profile.get('profile_name'), 'elapsed_seconds': elapsed, 'pairs': results}, ensure_ascii=False, indent=2))
+    else:
+        print_report(profile, results, elapsed)
+
+if __name__ == '__main__':
+    main()
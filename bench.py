@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+# ALNUSIRY BOT - مقياس الأداء (Benchmark) على خادم Polygon محلي وهمي
+# يشغّل مسارات البوت الحقيقية (execute_get_forex_data، governor_loop، analyze_signal_strength ...) دون شبكة خارجية:
+# خادم aggregates وهمي في عملية مستقلة بزمن استجابة وحد طلبات وحجم ردود قابلة للضبط، وبيانات مولدة من بذرة ثابتة.
+#
+# المقاييس:
+#   - تكلفة تقييم زوج واحد (دون حالة، ومع محرك المؤشرات المتدفق) وتقييم الدفعة لكل الأزواج
+#   - تكلفة تحليل رد من 200 شمعة (فك JSON ثم CandleArray ثم DataFrame)
+#   - إنتاجية الحاكم (طلبات في الثانية) أمام زمن استجابة الخادم
+#   - زمن دورة كاملة لكل الأزواج (15 افتراضياً) من الطابور حتى التقييم: باردة (ذاكرة فارغة) ودافئة (جلب تزايدي)
+#
+# كل تشغيل يُضاف سطراً في ملف JSONL مع رقم الـ commit والإعدادات، ويُقارن بالتشغيل السابق أو بمرجع محدد.
+#
+# الاستخدام:
+#   python bench.py --label before
+#   python bench.py --label after --baseline before --fail-on-regression
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import deque
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+from aiohttp import web
+
+import main as bot
+from main import USER_DEFINED_PAIRS, ANALYSIS_BARS, json_loads, parse_aggregates, analyze_signal_strength, score_pairs_batch
+from backtest import load_profile
+
+SUITES = ('scoring', 'parsing', 'governor', 'rotation')
+TIMESPAN_MS = {'minute': 60_000, 'hour': 3_600_000, 'day': 86_400_000}
+FUTURE_BARS = 288  # شموع بعد لحظة الإقلاع تظهر تباعاً مع مرور الوقت
+ROTATION_TIMEOUT_SECONDS = 300
+# اتجاه التحسن لكل مقياس: -1 الأقل أفضل، +1 الأعلى أفضل، 0 للعلم فقط.
+METRIC_UNITS = {
+    'scoring.single_ms': ('مللي ث', -1), 'scoring.single_p95_ms': ('مللي ث', -1),
+    'scoring.streaming_ms': ('مللي ث', -1), 'scoring.batch_ms': ('مللي ث', -1), 'scoring.batch_per_pair_ms': ('مللي ث', -1),
+    'parsing.payload_us': ('ميكرو ث', -1), 'parsing.payload_p95_us': ('ميكرو ث', -1),
+    'governor.requests_per_s': ('طلب/ث', 1), 'governor.throttled': ('رد 429', 0),
+    'rotation.cold_s': ('ث', -1), 'rotation.warm_s': ('ث', -1), 'rotation.throttled': ('رد 429', 0),
+}
+# مفاتيح لا تغير ظروف القياس، فاختلافها لا يمنع المقارنة.
+NON_CONDITION_KEYS = ('label', 'baseline', 'results', 'threshold', 'fail_on_regression', 'only', 'verbose')
+
+# --- البيانات المولدة ---
+def synthetic_series(ticker: str, step_ms: int, end_ms: int, bars: int, seed: int) -> dict:
+    """سلسلة أسعار عشوائية ثابتة لكل (زوج، إطار، بذرة) تنتهي بعد end_ms بـ FUTURE_BARS شمعة."""
+    rng = np.random.default_rng([seed, zlib.crc32(ticker.encode()), step_ms])
+    count = bars + FUTURE_BARS
+    t = end_ms - (bars - 1) * step_ms + np.arange(count, dtype=np.int64) * step_ms
+    close = (1.0 + rng.random()) * np.exp(np.cumsum(rng.normal(0, 4e-4, count)))
+    open_ = np.r_[close[0], close[:-1]]
+    spread = np.abs(rng.normal(0, 3e-4, count)) * close
+    return {'t': t, 'o': open_, 'h': np.maximum(open_, close) + spread, 'l': np.minimum(open_, close) - spread,
+            'c': close, 'v': rng.integers(50, 500, count).astype(float)}
+
+def aggregates_payload(ticker: str, series: dict, rows: slice) -> dict:
+    """رد بصيغة Polygon aggregates (أسماء الحقول نفسها)."""
+    fields = [series[key][rows].tolist() for key in ('t', 'o', 'h', 'l', 'c', 'v')]
+    results = [{'v': v, 'vw': c, 'o': o, 'c': c, 'h': h, 'l': l, 't': t, 'n': 1} for t, o, h, l, c, v in zip(*fields)]
+    return {'ticker': ticker, 'status': 'OK', 'adjusted': True, 'resultsCount': len(results), 'results': results}
+
+def series_frame(series: dict, bars: int, offset: int = 0) -> pd.DataFrame:
+    end = len(series['t']) - FUTURE_BARS - offset
+    rows = slice(end - bars, end)
+    index = pd.DatetimeIndex(pd.to_datetime(series['t'][rows], unit='ms', utc=True), name='datetime')
+    return pd.DataFrame({'Open': series['o'][rows], 'High': series['h'][rows], 'Low': series['l'][rows],
+                         'Close': series['c'][rows], 'Volume': series['v'][rows]}, index=index)
+
+# --- خادم Polygon الوهمي ---
+def parse_range_bound(value: str, end_of_day: bool) -> int:
+    if value.isdigit(): return int(value)
+    day = pd.Timestamp(value, tz='UTC')
+    return int((day + pd.Timedelta(days=1)).value // 1_000_000) - 1 if end_of_day else int(day.value // 1_000_000)
+
+def run_fake_polygon(config: dict, port_pipe, counters):
+    """يعمل في عملية مستقلة حتى لا ينافس البوت على حلقة الأحداث أو الـ GIL."""
+    rng = np.random.default_rng(config['seed'])
+    started_ms = int(time.time() * 1000)
+    timelines = {}
+    recent = deque()
+
+    async def aggregates(request: web.Request) -> web.Response:
+        counters['requests'].value += 1
+        now = time.monotonic()
+        if config['server_rate_limit']:
+            while recent and now - recent[0] > 60: recent.popleft()
+            if len(recent) >= config['server_rate_limit']:
+                counters['throttled'].value += 1
+                return web.json_response({'status': 'ERROR', 'error': 'exceeded the maximum requests per minute'}, status=429,
+                                         headers={'Retry-After': str(config['retry_after'])})
+            recent.append(now)
+        delay = config['latency_ms'] + rng.uniform(-config['jitter_ms'], config['jitter_ms'])
+        await asyncio.sleep(max(delay, 0.0) / 1000)
+
+        info = request.match_info
+        ticker, step_ms = info['ticker'], int(info['multiplier']) * TIMESPAN_MS[info['timespan']]
+        key = (ticker, step_ms)
+        if key not in timelines:
+            timelines[key] = synthetic_series(ticker, step_ms, started_ms - started_ms % step_ms, config['history_bars'], config['seed'])
+        series = timelines[key]
+        now_ms = int(time.time() * 1000)
+        first = parse_range_bound(info['start'], end_of_day=False)
+        last = min(parse_range_bound(info['end'], end_of_day=True), now_ms)
+        lo, hi = np.searchsorted(series['t'], first, 'left'), np.searchsorted(series['t'], last, 'right')
+        limit = min(int(request.query.get('limit', 5000)), config['max_bars'])
+        return web.json_response(aggregates_payload(ticker, series, slice(max(lo, hi - limit), hi)))
+
+    async def serve():
+        app = web.Application()
+        app.add_routes([web.get('/v2/aggs/ticker/{ticker}/range/{multiplier}/{timespan}/{start}/{end}', aggregates)])
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', 0).start()
+        port_pipe.send(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+def start_fake_polygon(args) -> (multiprocessing.Process, str, dict):
+    mp = multiprocessing.get_context('fork')
+    counters = {'requests': mp.Value('i', 0), 'throttled': mp.Value('i', 0)}
+    receiver, sender = mp.Pipe(duplex=False)
+    config = {key: getattr(args, key) for key in ('seed', 'latency_ms', 'jitter_ms', 'server_rate_limit', 'retry_after', 'max_bars', 'history_bars')}
+    process = mp.Process(target=run_fake_polygon, args=(config, sender, counters), daemon=True)
+    process.start()
+    if not receiver.poll(30): raise RuntimeError("الخادم الوهمي لم يبدأ خلال 30 ثانية")
+    return process, f"http://127.0.0.1:{receiver.recv()}", counters
+
+# --- القياسات ---
+def sample_durations(func, inputs: list) -> np.ndarray:
+    durations = np.empty(len(inputs))
+    for i, item in enumerate(inputs):
+        started = time.perf_counter()
+        func(item)
+        durations[i] = time.perf_counter() - started
+    return durations
+
+def bench_scoring(args, pairs: list, settings: dict) -> dict:
+    step_ms = TIMESPAN_MS['minute'] * 5
+    end_ms = int(time.time() * 1000) // step_ms * step_ms
+    histories = {pair: synthetic_series(f"C:{pair.replace('/', '')}", step_ms, end_ms, ANALYSIS_BARS + args.repeat, args.seed) for pair in pairs}
+    series = histories[pairs[0]]
+
+    # دون حالة: كل استدعاء يحسب المؤشرات على كامل النافذة (مسار التأكيد والاختبار).
+    frames = [series_frame(series, ANALYSIS_BARS, offset) for offset in range(args.repeat)]
+    single = sample_durations(lambda df: analyze_signal_strength(df, 'NEUTRAL', 'NEUTRAL', None, None, settings), frames)
+
+    # مع محرك المؤشرات: نافذة تتقدم شمعة واحدة في كل استدعاء كما في التشغيل المباشر.
+    frames = [series_frame(series, ANALYSIS_BARS, offset) for offset in reversed(range(args.repeat))]
+    pair = f"BENCH{args.seed}/{pairs[0]}"
+    streaming = sample_durations(lambda df: analyze_signal_strength(df, 'NEUTRAL', 'NEUTRAL', pair, None, settings), frames)
+
+    batch_inputs = [{p: series_frame(s, ANALYSIS_BARS, offset) for p, s in histories.items()} for offset in range(min(args.repeat, 30))]
+    trends = {p: ('NEUTRAL', 'NEUTRAL') for p in pairs}
+    batch = sample_durations(lambda frames: score_pairs_batch(frames, trends, settings), batch_inputs)
+    return {'scoring.single_ms': np.median(single) * 1e3, 'scoring.single_p95_ms': np.percentile(single, 95) * 1e3,
+            'scoring.streaming_ms': np.median(streaming[1:]) * 1e3, 'scoring.batch_ms': np.median(batch) * 1e3,
+            'scoring.batch_per_pair_ms': np.median(batch) * 1e3 / len(pairs)}
+
+def bench_parsing(args) -> dict:
+    step_ms = TIMESPAN_MS['minute'] * 5
+    series = synthetic_series('C:EURUSD', step_ms, int(time.time() * 1000) // step_ms * step_ms, args.parse_bars, args.seed)
+    payload = json.dumps(aggregates_payload('C:EURUSD', series, slice(0, args.parse_bars))).encode()
+    durations = sample_durations(lambda body: parse_aggregates(json_loads(body)).to_frame(), [payload] * args.repeat)
+    return {'parsing.payload_us': np.median(durations) * 1e6, 'parsing.payload_p95_us': np.percentile(durations, 95) * 1e6}
+
+async def bench_governor(args, counters: dict) -> dict:
+    bot.candle_cache.clear()
+    throttled = counters['throttled'].value
+    remaining, done = [args.governor_requests], asyncio.Event()
+
+    async def on_data(df, pair, context):
+        remaining[0] -= 1
+        if remaining[0] == 0: done.set()
+
+    started = time.perf_counter()
+    for i in range(args.governor_requests):
+        await bot.api_request_queue.put({'pair': f"G{i:03d}/USD", 'timeframe': 'M5', 'limit': ANALYSIS_BARS, 'callback': on_data})
+    await asyncio.wait_for(done.wait(), ROTATION_TIMEOUT_SECONDS)
+    elapsed = time.perf_counter() - started
+    return {'governor.requests_per_s': args.governor_requests / elapsed, 'governor.throttled': counters['throttled'].value - throttled}
+
+async def run_rotation(context, pairs: list, cold: bool) -> float:
+    """دورة مسح واحدة من logic_loop حتى انتهاء أثر كل زوج (من الطابور إلى التقييم والإرسال)."""
+    if cold:
+        bot.candle_cache.clear()
+        bot.trend_cache.clear()
+    bot.analysis_due.clear()
+    bot.last_scored_bars.clear()
+    started = time.perf_counter()
+    await bot.logic_loop(context)
+    prefix = bot.current_scan.get() + '.'
+    deadline = time.monotonic() + ROTATION_TIMEOUT_SECONDS
+    while sum(1 for trace in list(bot.recent_traces) if trace.id.startswith(prefix)) < len(pairs):
+        if time.monotonic() > deadline: raise TimeoutError("الدورة لم تكتمل في الوقت المحدد")
+        await asyncio.sleep(0.002)
+    return time.perf_counter() - started
+
+async def bench_rotation(context, pairs: list, counters: dict) -> dict:
+    throttled = counters['throttled'].value
+    cold = await run_rotation(context, pairs, cold=True)
+    warm = await run_rotation(context, pairs, cold=False)
+    return {'rotation.cold_s': cold, 'rotation.warm_s': warm, 'rotation.throttled': counters['throttled'].value - throttled}
+
+class FakeBot:
+    def __init__(self):
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+async def run_live_suites(args, pairs: list, suites: list, base_url: str, counters: dict) -> dict:
+    bot.POLYGON_BASE_URL, bot.POLYGON_API_KEY = base_url, 'bench'
+    bot.rate_controller.ceiling = args.client_rate_limit
+    bot.rate_controller.limit = float(args.client_rate_limit)
+    context = SimpleNamespace(bot=FakeBot())
+    governor = asyncio.create_task(bot.governor_loop(context))
+    results = {}
+    try:
+        if 'governor' in suites: results.update(await bench_governor(args, counters))
+        if 'rotation' in suites: results.update(await bench_rotation(context, pairs, counters))
+    finally:
+        governor.cancel()
+        await bot.polygon_client.close()
+        await bot.signal_store.close()
+    return results
+
+# --- حفظ النتائج والمقارنة ---
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def load_baseline(path: str, reference: str = None) -> dict:
+    """آخر تشغيل سابق، أو آخر تشغيل يطابق reference كاسم (label) أو كبداية رقم الـ commit."""
+    if not os.path.exists(path): return None
+    with open(path, 'r', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if reference:
+        records = [r for r in records if r.get('label') == reference or (r.get('commit') or '').startswith(reference)]
+    return records[-1] if records else None
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """يطبع النتائج مع التغير عن المرجع ويعيد أسماء المقاييس التي تراجعت بأكثر من threshold بالمئة."""
+    regressions = []
+    previous = baseline['results'] if baseline else {}
+    for name, value in results.items():
+        unit, direction = METRIC_UNITS[name]
+        line = f"   {name:<27} {value:>10.3f} {unit}"
+        old = previous.get(name)
+        if old:
+            change = (value - old) / old * 100
+            worse = direction != 0 and change * direction < -threshold
+            if worse: regressions.append(name)
+            line += f"   (المرجع {old:.3f}، {change:+.1f}%{' ⚠️ تراجع' if worse else ''})"
+        print(line)
+    return regressions
+
+def conditions(config: dict) -> dict:
+    return {key: value for key, value in config.items() if key not in NON_CONDITION_KEYS}
+
+def main():
+    parser = argparse.ArgumentParser(description="قياس أداء البوت على خادم Polygon محلي وهمي وحفظ النتائج للمقارنة.")
+    parser.add_argument('--profile', default='default.json', help="ملف الاستراتيجية المستخدم في التقييم")
+    parser.add_argument('--pairs', default=",".join(USER_DEFINED_PAIRS), help="أزواج الدورة الكاملة مفصولة بفواصل")
+    parser.add_argument('--only', help=f"تشغيل مجموعات محددة فقط: {','.join(SUITES)}")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--repeat', type=int, default=100, help="عدد التكرارات لقياسات التقييم والتحليل")
+    parser.add_argument('--parse-bars', type=int, default=200, help="عدد شموع الرد في قياس التحليل")
+    parser.add_argument('--latency-ms', type=float, default=40.0, help="زمن استجابة الخادم الوهمي")
+    parser.add_argument('--jitter-ms', type=float, default=10.0, help="تذبذب عشوائي حول زمن الاستجابة")
+    parser.add_argument('--server-rate-limit', type=int, default=0, help="حد طلبات الخادم في الدقيقة قبل رد 429 (0 بلا حد)")
+    parser.add_argument('--retry-after', type=int, default=1, help="قيمة Retry-After في ردود 429")
+    parser.add_argument('--max-bars', type=int, default=50000, help="أقصى عدد شموع في الرد الواحد")
+    parser.add_argument('--history-bars', type=int, default=3000, help="عمق التاريخ المتاح في الخادم لكل زوج وإطار")
+    parser.add_argument('--client-rate-limit', type=int, default=300, help="سقف طلبات البوت في الدقيقة (حسب الخطة)")
+    parser.add_argument('--governor-requests', type=int, default=60, help="عدد الطلبات في قياس إنتاجية الحاكم")
+    parser.add_argument('--results', default='bench_results.jsonl', help="ملف النتائج (سطر JSON لكل تشغيل)")
+    parser.add_argument('--label', help="اسم لهذا التشغيل يمكن المقارنة به لاحقاً")
+    parser.add_argument('--baseline', help="اسم أو commit المرجع؛ الافتراضي آخر تشغيل في الملف")
+    parser.add_argument('--threshold', type=float, default=10.0, help="نسبة التراجع (%%) التي تُعد انحداراً")
+    parser.add_argument('--fail-on-regression', action='store_true', help="إنهاء بحالة 1 عند أي تراجع")
+    parser.add_argument('--verbose', action='store_true', help="إبقاء سجلات البوت بمستوى INFO")
+    args = parser.parse_args()
+
+    suites = [s.strip() for s in args.only.split(',')] if args.only else list(SUITES)
+    pairs = [p.strip() for p in args.pairs.split(',') if p.strip()]
+    settings = load_profile(args.profile)
+    results_path = os.path.abspath(args.results)
+    # سجلات INFO لكل طلب تضيف ضجيجاً إلى القياس والمخرجات؛ التحذيرات (مثل الدورات البطيئة) تبقى.
+    if not args.verbose: logging.getLogger(bot.__name__).setLevel(logging.WARNING)
+
+    server, base_url, counters = start_fake_polygon(args) if {'governor', 'rotation'} & set(suites) else (None, None, None)
+    original_dir, workdir = os.getcwd(), tempfile.TemporaryDirectory(prefix='alnusiry_bench_')
+    # حالة البوت وقاعدة الإشارات تُكتب في مجلد مؤقت حتى لا يلمس القياس ملفات التشغيل الحقيقية.
+    os.chdir(workdir.name)
+    bot.TELEGRAM_CHAT_ID = 'bench'
+    bot.bot_state.update(settings)
+    bot.bot_state.update({'is_running': True, 'selected_pairs': pairs, 'data_mode': 'rest', 'shadow_mode': False})
+    bot.subscribers[bot.TELEGRAM_CHAT_ID] = bot.bot_state
+
+    print(f"القياس: {', '.join(suites)} | {len(pairs)} زوج، زمن الخادم {args.latency_ms:g}±{args.jitter_ms:g} مللي ث، "
+          f"حد الخادم {args.server_rate_limit or 'بلا'}، سقف البوت {args.client_rate_limit}/دقيقة")
+    results = {}
+    try:
+        if 'scoring' in suites: results.update(bench_scoring(args, pairs, settings))
+        if 'parsing' in suites: results.update(bench_parsing(args))
+        if server is not None: results.update(asyncio.run(run_live_suites(args, pairs, suites, base_url, counters)))
+    finally:
+        if server is not None: server.terminate()
+        bot.compute_stage.close()
+        os.chdir(original_dir)
+        workdir.cleanup()
+
+    results = {name: float(value) for name, value in results.items()}
+    config = vars(args)
+    baseline = load_baseline(results_path, args.baseline)
+    if baseline and conditions(baseline.get('config', {})) != conditions(config):
+        print("تنبيه: ظروف المرجع تختلف عن هذا التشغيل، المقارنة تقريبية.")
+    if baseline: print(f"المرجع: {baseline.get('label') or '-'} ({baseline.get('commit') or '-'}، {baseline.get('timestamp')})")
+    regressions = compare(results, baseline, args.threshold)
+
+    record = {'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'label': args.label, 'commit': git_commit(),
+              'python': platform.python_version(), 'cpu_count': os.cpu_count(), 'config': config, 'results': results}
+    with open(results_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    print(f"تم حفظ النتائج في {results_path}")
+    if regressions:
+        print(f"تراجع بأكثر من {args.threshold:g}%: {', '.join(regressions)}")
+        if args.fail_on_regression: sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -9,20 +9,45 @@
 import logging
 import json
 import os
+import sys
 import asyncio
+import random
+import copy
+import heapq
+import itertools
+import functools
+import time
+import sqlite3
+import contextvars
+import hmac
+import secrets
+from signal import SIGINT, SIGTERM
 from datetime import datetime, timedelta, timezone
-from threading import Thread
+from threading import Thread, Lock, Event, get_ident
+from concurrent.futures import ThreadPoolExecutor
 from collections import deque
+from operator import itemgetter
+from bisect import bisect_left
 
+import numpy as np
 import pandas as pd
-import requests
+import aiohttp
+from aiohttp import web
 import ta
 import talib
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # orjson اختياري: json القياسي يعطي النتيجة نفسها لكنه أبطأ
+    json_loads = json.loads
+# النسخ عند الكتابة (دائم منذ pandas 3): مقاطع ذاكرة الشموع تصل إلى التحليل عروضاً بلا نسخ دفاعية،
+# وأي تعديل عليها (أو على الذاكرة نفسها) ينسخ الجزء المعدل فقط.
+if int(pd.__version__.split('.')[0]) < 3: pd.set_option('mode.copy_on_write', True)
 
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters,
-    ContextTypes, ConversationHandler, CallbackQueryHandler
+    ContextTypes, ConversationHandler, CallbackQueryHandler, TypeHandler, ApplicationHandlerStop
 )
 
 from flask import Flask
@@ -30,7 +55,15 @@ from flask import Flask
 # --- الإعدادات الأساسية والمتغيرات العامة ---
 TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
 TELEGRAM_CHAT_ID = os.environ.get('TELEGRAM_CHAT_ID')
+# محادثات المشتركين المسموح لهم (مفصولة بفواصل)؛ صاحب TELEGRAM_CHAT_ID مشترك دائماً ويملك إعدادات المحرك.
+TELEGRAM_SUBSCRIBER_IDS = {chat_id.strip() for chat_id in os.environ.get('TELEGRAM_SUBSCRIBER_IDS', '').split(',') if chat_id.strip()}
+# العنوان العام للخادم (https://...)؛ عند ضبطه تصل التحديثات عبر Webhook، وبدونه يعمل البوت بالاستطلاع.
+TELEGRAM_WEBHOOK_URL = os.environ.get('TELEGRAM_WEBHOOK_URL', '').rstrip('/')
+TELEGRAM_WEBHOOK_SECRET = os.environ.get('TELEGRAM_WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+HTTP_PORT = int(os.environ.get("PORT", 10000))
 POLYGON_API_KEY = os.environ.get('POLYGON_API_KEY')
+# يمكن توجيه البوت إلى خادم Polygon محلي وهمي للاختبار.
+POLYGON_BASE_URL = os.environ.get('POLYGON_BASE_URL', 'https://api.polygon.io').rstrip('/')
 
 STATE_FILE = 'bot_state.json'
 STRATEGIES_DIR = 'strategies'
@@ -42,9 +75,504 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- مقاييس التشغيل (Metrics) ---
+# عدادات ومدرجات تكرارية بصيغة Prometheus النصية على /metrics. التحديث يحدث في حلقة الأحداث وخيوط الحساب
+# والقراءة من خيط Flask، لذا كل مقياس يحمي قيمه بقفل قصير؛ المقاييس اللحظية (Gauges) تُقرأ عند الطلب فقط.
+METRICS_PREFIX = 'alnusiry_'
+METRICS_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_COMPUTE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+EVENT_LOOP_LAG_INTERVAL_SECONDS = 1.0
+
+def format_labels(names: tuple, values: tuple) -> str:
+    if not names: return ''
+    return '{' + ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values)) + '}'
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = METRICS_PREFIX + name, help_text, labels
+        self._values = {}
+        self._lock = Lock()
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0.0) + amount
+
+    def render(self) -> list:
+        with self._lock: values = dict(self._values)
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in sorted(values.items())]
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple, labels: tuple = ()):
+        self.name, self.help, self.labels, self.buckets = METRICS_PREFIX + name, help_text, labels, buckets
+        self._values = {}  # القيم -> [عدادات الشرائح (غير تراكمية)، المجموع، العدد]
+        self._lock = Lock()
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(label_values)
+            if entry is None: entry = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets): entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self) -> list:
+        with self._lock: values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), key + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels + ('le',), key + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+class Gauge:
+    """قيمة لحظية تُحسب عند القراءة؛ read يجب أن يكتفي بلقطات ذرية (len، قراءة رقم) لأنه يعمل في خيط Flask."""
+    def __init__(self, name: str, help_text: str, read):
+        self.name, self.help, self.read = METRICS_PREFIX + name, help_text, read
+
+    def render(self) -> list:
+        try:
+            value = float(self.read())
+        except Exception:
+            value = float('nan')
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+metrics = MetricsRegistry()
+polygon_fetch_seconds = metrics.register(Histogram('polygon_fetch_seconds', "زمن طلبات Polygon بالثواني (مع إعادة المحاولات)",
+                                                   METRICS_LATENCY_BUCKETS, ('timeframe',)))
+polygon_fetch_errors = metrics.register(Counter('polygon_fetch_errors_total', "أخطاء طلبات Polygon حسب الإطار والسبب", ('timeframe', 'reason')))
+analysis_seconds = metrics.register(Histogram('analysis_seconds', "زمن تقييم الإشارات بالثواني (single: analyze_signal_strength، batch: score_pairs_batch)",
+                                              METRICS_COMPUTE_BUCKETS, ('path',)))
+event_loop_lag_seconds = metrics.register(Histogram('event_loop_lag_seconds', "تأخر حلقة الأحداث عن موعد الاستيقاظ بالثواني",
+                                                    METRICS_COMPUTE_BUCKETS))
+signals_recorded = metrics.register(Counter('signals_total', "الإشارات المسجلة حسب النوع والنتيجة", ('kind', 'outcome')))
+telegram_messages = metrics.register(Counter('telegram_messages_total', "رسائل الإشارات إلى تليجرام حسب النوع والحالة", ('kind', 'status')))
+loop_health = {'lag': 0.0}
+
+def observe_duration(histogram: Histogram, *label_values):
+    """يسجل زمن تنفيذ الدالة في المدرج التكراري (يعمل في أي خيط)."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, *label_values)
+        return wrapper
+    return decorator
+
+async def event_loop_lag_monitor():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL_SECONDS)
+        lag = max(loop.time() - started - EVENT_LOOP_LAG_INTERVAL_SECONDS, 0.0)
+        loop_health['lag'] = lag
+        event_loop_lag_seconds.observe(lag)
+
+# --- تتبع دورات المسح (Tracing) ---
+# كل طلب يدخل طابور الحاكم يحمل أثراً بمعرف ربط "الدورة.الرقم" يرافقه من الإضافة إلى الطابور حتى رسالة تليجرام.
+# الأثر النشط ينتقل عبر contextvars: المهام تنسخ السياق عند إنشائها، ومرحلة الحساب تشغّل العامل في نسخة منه.
+# الطلبات المدموجة تتشارك مقاطع الانتظار والجلب، ولكل كول باك أثره الخاص بعدها. آخر الآثار تبقى في حلقة محدودة.
+TRACE_BUFFER_SIZE = 200
+TRACE_SLOW_SECONDS = float(os.environ.get('TRACE_SLOW_SECONDS', 20))
+TRACE_REPORT_COUNT = 8
+recent_traces = deque(maxlen=TRACE_BUFFER_SIZE)
+scan_ids = itertools.count(1)
+trace_sequence = itertools.count(1)
+current_scan = contextvars.ContextVar('current_scan', default='-')
+active_traces = contextvars.ContextVar('active_traces', default=())
+
+def begin_scan(source: str) -> str:
+    """يبدأ دورة مسح جديدة في السياق الحالي؛ كل الآثار التي تنشأ فيه تحمل معرفها."""
+    scan_id = f"{source}{next(scan_ids)}"
+    current_scan.set(scan_id)
+    return scan_id
+
+class Trace:
+    def __init__(self, name: str, pair: str):
+        self.id = f"{current_scan.get()}.{next(trace_sequence)}"
+        self.name, self.pair = name, pair
+        self.started_at = datetime.now(timezone.utc)
+        self.started = self.queued = time.perf_counter()
+        self.spans = []  # (الاسم، البداية منذ بدء الأثر، المدة)؛ تضاف من حلقة الأحداث وخيوط الحساب
+        self.duration = None
+        self.status = 'ok'
+        self._holds = 0
+
+    def add_span(self, name: str, started: float, duration: float):
+        self.spans.append((name, started - self.started, duration))
+
+    def hold(self):
+        self._holds += 1
+
+    def release(self):
+        self._holds -= 1
+        if self._holds <= 0: self.finish()
+
+    def finish(self, status: str = None):
+        if self.duration is not None: return
+        if status: self.status = status
+        self.duration = time.perf_counter() - self.started
+        recent_traces.append(self)
+        if self.duration > TRACE_SLOW_SECONDS: logger.warning(f"تتبع: دورة بطيئة {self.summary()}")
+
+    def breakdown(self) -> dict:
+        totals = {}
+        for name, _, duration in list(self.spans): totals[name] = totals.get(name, 0.0) + duration
+        return totals
+
+    def summary(self) -> str:
+        parts = "، ".join(f"{name} {seconds:.3f}" for name, seconds in sorted(self.breakdown().items(), key=itemgetter(1), reverse=True))
+        return f"[{self.id}] {self.name} {self.pair}: {self.duration:.2f} ث ({self.status}) — {parts or 'بلا مقاطع'}"
+
+def record_span(name: str, started: float, duration: float):
+    for trace in active_traces.get(): trace.add_span(name, started, duration)
+
+class TraceSpan:
+    """يقيس كتلة داخل الأثر النشط؛ بلا أثر نشط لا يكلف إلا قراءة contextvar."""
+    __slots__ = ('name', 'traces', 'started')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.traces = active_traces.get()
+        if self.traces: self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.traces:
+            duration = time.perf_counter() - self.started
+            for trace in self.traces: trace.add_span(self.name, self.started, duration)
+        return False
+
+def traces_report() -> str:
+    traces = list(recent_traces)
+    if not traces: return "لا توجد آثار مسجلة بعد."
+    totals, counts = {}, {}
+    for trace in traces:
+        for name, seconds in trace.breakdown().items():
+            totals[name] = totals.get(name, 0.0) + seconds
+            counts[name] = counts.get(name, 0) + 1
+    lines = [f"🧭 آخر {len(traces)} أثر (متوسط الدورة {sum(t.duration for t in traces) / len(traces):.2f} ث):"]
+    lines += [f"   - {name}: متوسط {totals[name] / counts[name]:.3f} ث في {counts[name]} أثر"
+              for name in sorted(totals, key=totals.get, reverse=True)]
+    lines.append("\nالأبطأ:")
+    lines += [f"   {trace.summary()}" for trace in sorted(traces, key=lambda t: t.duration, reverse=True)[:TRACE_REPORT_COUNT]]
+    return "\n".join(lines)
+
+# --- محلل العينات عند الطلب (Sampling Profiler) ---
+# خيط يأخذ لقطة من مكدس كل خيط (sys._current_frames) كل بضعة أجزاء من الثانية لمدة محددة،
+# ويعد الدوال في قمة المكدس (الزمن الذاتي) وفي أي مستوى منه (الزمن الكلي). الخيوط المنتظرة تُعد خاملة ولا تدخل النسب.
+PROFILER_INTERVAL_SECONDS = 0.01
+PROFILER_MAX_MINUTES = 30
+PROFILER_TOP_FUNCTIONS = 12
+PROFILER_IDLE_FRAMES = {('threading.py', 'wait'), ('selectors.py', 'select'), ('queue.py', 'get'),
+                        ('socketserver.py', 'serve_forever'), ('thread.py', '_worker')}
+
+def frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class SamplingProfiler:
+    def __init__(self):
+        self._thread = None
+        self._stop = Event()
+        self.loop_thread = None
+        self.reset()
+
+    def reset(self):
+        self.samples, self.idle, self.loop_samples = 0, 0, 0
+        self.own, self.total = {}, {}
+        self.started_at, self.seconds = None, 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds: float):
+        self.reset()
+        self.started_at, self.seconds = datetime.now(timezone.utc), seconds
+        self.loop_thread = get_ident()
+        self._stop.clear()
+        self._thread = Thread(target=self._run, args=(time.monotonic() + seconds,), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None: self._thread.join()
+
+    def _run(self, deadline: float):
+        own_thread = get_ident()
+        while not self._stop.wait(PROFILER_INTERVAL_SECONDS) and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != own_thread: self._sample(thread_id, frame)
+
+    def _sample(self, thread_id: int, frame):
+        code = frame.f_code
+        if (os.path.basename(code.co_filename), code.co_name) in PROFILER_IDLE_FRAMES:
+            self.idle += 1
+            return
+        self.samples += 1
+        if thread_id == self.loop_thread: self.loop_samples += 1
+        label = frame_label(code)
+        self.own[label] = self.own.get(label, 0) + 1
+        seen = set()
+        while frame is not None:
+            label = frame_label(frame.f_code)
+            if label not in seen:
+                seen.add(label)
+                self.total[label] = self.total.get(label, 0) + 1
+            frame = frame.f_back
+
+    def summary(self) -> str:
+        if not self.samples: return "🔬 المحلل: لم تُجمع عينات نشطة (كل الخيوط كانت خاملة)."
+        def top(counts):
+            ranked = sorted(counts.items(), key=itemgetter(1), reverse=True)[:PROFILER_TOP_FUNCTIONS]
+            return [f"   {100 * count / self.samples:5.1f}% {label}" for label, count in ranked]
+        lines = [f"🔬 ملخص المحلل ({self.seconds / 60:g} دقيقة، عينة كل {PROFILER_INTERVAL_SECONDS * 1000:.0f} مللي ث):",
+                 f"   - عينات نشطة: {self.samples} (حلقة الأحداث {self.loop_samples}، خيوط أخرى {self.samples - self.loop_samples})، خاملة: {self.idle}",
+                 "\nالزمن الذاتي (قمة المكدس):"] + top(self.own) + ["\nالزمن الكلي (مع الدوال المستدعاة):"] + top(self.total)
+        return "\n".join(lines)[:4000]
+
+profiler = SamplingProfiler()
+
 # --- متغيرات محرك الحاكم (Governor Engine) ---
-api_request_queue = asyncio.Queue()
-api_call_timestamps = deque(maxlen=4)
+# اتجاها M15 و H1 يُشتقان من شموع M5 المخزنة، فلا طلبات اتجاه ولا طبقة أولوية لها.
+PRIORITY_CONFIRMATION, PRIORITY_ANALYSIS = 0, 1
+PRIORITY_NAMES = {PRIORITY_CONFIRMATION: 'تأكيد', PRIORITY_ANALYSIS: 'تحليل'}
+
+class GovernorScheduler:
+    """طابور أولويات (تأكيد > تحليل) مع مواعيد نهائية، يستيقظ عند وصول طلب بدلاً من الفحص الدوري.
+
+    مفاتيح الطلب الاختيارية: 'priority'، 'deadline' (datetime)، و 'on_stale' ('drop' أو 'downgrade')
+    لتحديد مصير الطلب إذا تجاوز موعده النهائي قبل أن يحين دوره.
+
+    الطلبات المتطابقة (نفس الزوج والإطار) تُدمج في جلب واحد: إذا كان هناك طلب منتظر أو قيد التنفيذ
+    يغطي نافذة الطلب الجديد، يضاف الكول باك إليه ويستلم كل كول باك نسخته من النتيجة.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._pending = {}
+        self._in_flight = {}
+        self.coalesced = 0
+        self.stats = {priority: {'served': 0, 'dropped': 0, 'downgraded': 0, 'total_wait': 0.0, 'max_wait': 0.0}
+                      for priority in PRIORITY_NAMES}
+
+    @staticmethod
+    def _key(request: dict) -> tuple:
+        return request['pair'], request['timeframe']
+
+    def _push(self, request: dict):
+        # الإدخالات القديمة لنفس الطلب في الكومة تُهمل عند السحب (حذف كسول) إذا تغير رقمها التسلسلي.
+        request['heap_sequence'] = next(self._sequence)
+        heapq.heappush(self._heap, (request['priority'], request['heap_sequence'], request))
+
+    async def put(self, request: dict):
+        request.setdefault('priority', PRIORITY_ANALYSIS)
+        request.setdefault('enqueued_at', datetime.now(timezone.utc))
+        # التتبع يُنشأ مرة واحدة فقط؛ إعادة الإدراج بعد التقييد أو الدمج تحمل ردودها وتتبعاتها معها
+        if 'callbacks' not in request:
+            request['callbacks'] = [(request.get('callback'), request['limit'], Trace(PRIORITY_NAMES[request['priority']], request['pair']))]
+        request.setdefault('tags', {request['metadata']} if request.get('metadata') else set())
+        key = self._key(request)
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None and in_flight['limit'] >= request['limit']:
+            in_flight['callbacks'].extend(request['callbacks'])
+            self.coalesced += 1
+            logger.info(f"الحاكم: دمج طلب {request['pair']} ({request['timeframe']}) مع جلب قيد التنفيذ.")
+            return
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            self._merge(pending, request)
+            return
+
+        self._pending[key] = request
+        self._push(request)
+        self._wakeup.set()
+
+    def _merge(self, target: dict, request: dict):
+        target['callbacks'].extend(request['callbacks'])
+        target['tags'] |= request['tags']
+        target['limit'] = max(target['limit'], request['limit'])
+        target['enqueued_at'] = min(target['enqueued_at'], request['enqueued_at'])
+        # الطلب المدمج يصبح متأخراً فقط إذا تأخر كل من ينتظره، ويُخفّض بدل الحذف إذا طلب أحدهم ذلك.
+        deadlines = [target.get('deadline'), request.get('deadline')]
+        target['deadline'] = None if None in deadlines else max(deadlines)
+        if request.get('on_stale') == 'downgrade': target['on_stale'] = 'downgrade'
+        self.coalesced += 1
+        logger.info(f"الحاكم: دمج طلب {request['pair']} ({request['timeframe']}) مع طلب منتظر.")
+        if request['priority'] < target['priority']:
+            target['priority'] = request['priority']
+            self._push(target)
+
+    def qsize(self) -> int:
+        return len(self._pending)
+
+    def empty(self) -> bool:
+        return not self._pending
+
+    def has_pending(self, metadata: str) -> bool:
+        return any(metadata in request['tags'] for request in self._pending.values())
+
+    def has_outstanding(self, priority: int) -> bool:
+        """هل بقي طلب بهذه الأولوية منتظراً أو قيد الجلب."""
+        return any(request['priority'] == priority for request in (*self._pending.values(), *self._in_flight.values()))
+
+    async def wait_for_request(self):
+        while not self._pending:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    def pop_next(self, now: datetime) -> dict:
+        """يعيد أعلى طلب أولوية لم يفت موعده، مع حذف أو تخفيض الطلبات المتأخرة في الطريق."""
+        while self._heap:
+            priority, sequence, request = heapq.heappop(self._heap)
+            if request.get('heap_sequence') != sequence: continue
+            deadline = request.get('deadline')
+            if deadline is not None and now > deadline:
+                if request.get('on_stale', 'drop') == 'downgrade' and priority < PRIORITY_ANALYSIS:
+                    self.stats[priority]['downgraded'] += 1
+                    logger.info(f"الحاكم: تخفيض أولوية طلب متأخر لـ {request['pair']} ({PRIORITY_NAMES[priority]}).")
+                    request['priority'], request['deadline'] = PRIORITY_ANALYSIS, None
+                    self._push(request)
+                else:
+                    self.stats[priority]['dropped'] += 1
+                    del self._pending[self._key(request)]
+                    for _, _, trace in request['callbacks']: trace.finish('dropped')
+                    logger.info(f"الحاكم: حذف طلب متأخر لـ {request['pair']} ({PRIORITY_NAMES[priority]}).")
+                continue
+
+            key = self._key(request)
+            del self._pending[key]
+            self._in_flight[key] = request
+            wait = (now - request['enqueued_at']).total_seconds()
+            stats = self.stats[priority]
+            stats['served'] += 1
+            stats['total_wait'] += wait
+            stats['max_wait'] = max(stats['max_wait'], wait)
+            request['wait_seconds'] = wait
+            return request
+        return None
+
+    def finish(self, request: dict):
+        """يُستدعى بعد انتهاء الجلب؛ بعده لا يمكن دمج طلبات جديدة في هذا الطلب."""
+        key = self._key(request)
+        if self._in_flight.get(key) is request:
+            del self._in_flight[key]
+
+    def depth_by_priority(self) -> dict:
+        depth = {priority: 0 for priority in PRIORITY_NAMES}
+        for request in self._pending.values(): depth[request['priority']] += 1
+        return depth
+
+    def report(self) -> str:
+        depth = self.depth_by_priority()
+        lines = []
+        for priority, name in PRIORITY_NAMES.items():
+            stats = self.stats[priority]
+            avg_wait = stats['total_wait'] / stats['served'] if stats['served'] else 0.0
+            lines.append(f"   - {name}: في الطابور {depth[priority]}، منفذة {stats['served']}، "
+                         f"متوسط الانتظار {avg_wait:.0f} ث، أقصى انتظار {stats['max_wait']:.0f} ث، "
+                         f"محذوفة {stats['dropped']}، مخفّضة {stats['downgraded']}")
+        lines.append(f"   - طلبات مدموجة (وفرت جلباً): {self.coalesced}")
+        return "\n".join(lines)
+
+# --- حصة طلبات Polygon المتكيفة (Adaptive Rate Budget) ---
+# السقف يأتي من خطة الاشتراك، والحد الفعلي يتكيف بأسلوب AIMD: ينخفض للنصف عند 429
+# ويرتفع طلباً واحداً لكل دقيقة كاملة من الردود السليمة حتى يبلغ السقف.
+# الخطة المجانية تسمح بـ 5 طلبات/دقيقة ونبقى على 4 كما كان الحاكم الأصلي هامشاً للأمان.
+# الخطط المدفوعة بلا حد رسمي، و300/دقيقة سقف ذاتي يكفي لتدوير كل الأزواج دون إغراق الخادم.
+POLYGON_PLAN_LIMITS = {'basic': 4, 'starter': 300, 'developer': 300, 'advanced': 300}
+POLYGON_PLAN = os.environ.get('POLYGON_PLAN', 'basic').lower()
+RATE_WINDOW_SECONDS = 60
+DEFAULT_RETRY_AFTER_SECONDS = 60
+
+class RateController:
+    def __init__(self, plan: str, ceiling: int = None):
+        self.plan = plan if plan in POLYGON_PLAN_LIMITS else 'basic'
+        self.ceiling = ceiling or POLYGON_PLAN_LIMITS[self.plan]
+        self.limit = float(self.ceiling)
+        self.calls = deque()
+        self.paused_until = None
+        self.healthy_streak = 0
+        self.throttled_count = 0
+
+    def _prune(self, now: datetime):
+        while self.calls and (now - self.calls[0]).total_seconds() > RATE_WINDOW_SECONDS:
+            self.calls.popleft()
+
+    def seconds_until_slot(self, now: datetime) -> float:
+        """صفر إذا أمكن إرسال طلب الآن، وإلا عدد الثواني حتى يتحرر مقعد أو تنتهي مهلة Retry-After."""
+        if self.paused_until is not None and now < self.paused_until:
+            return (self.paused_until - now).total_seconds()
+        self._prune(now)
+        if len(self.calls) < int(self.limit): return 0.0
+        return max(RATE_WINDOW_SECONDS - (now - self.calls[0]).total_seconds(), 0.0)
+
+    def record_call(self, now: datetime = None):
+        self.calls.append(now or datetime.now(timezone.utc))
+
+    def on_success(self):
+        self.healthy_streak += 1
+        if self.limit < self.ceiling and self.healthy_streak >= int(self.limit):
+            self.limit, self.healthy_streak = min(self.limit + 1, self.ceiling), 0
+            logger.info(f"الحاكم: ردود سليمة، رفع الحد إلى {int(self.limit)}/دقيقة.")
+
+    def on_throttled(self, retry_after: float = None):
+        self.throttled_count += 1
+        self.healthy_streak = 0
+        self.limit = max(self.limit / 2, 1.0)
+        pause = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER_SECONDS
+        self.paused_until = datetime.now(timezone.utc) + timedelta(seconds=pause)
+        logger.warning(f"الحاكم: Polygon أعاد 429. خفض الحد إلى {int(self.limit)}/دقيقة والتوقف {pause:.0f} ث.")
+
+    def usage(self, now: datetime = None) -> int:
+        self._prune(now or datetime.now(timezone.utc))
+        return len(self.calls)
+
+    def recent_calls(self) -> int:
+        """مثل usage لكن دون تعديل الطابور، فيصلح للقراءة من خيط آخر."""
+        now = datetime.now(timezone.utc)
+        return sum(1 for call in list(self.calls) if (now - call).total_seconds() <= RATE_WINDOW_SECONDS)
+
+    def report(self) -> str:
+        now = datetime.now(timezone.utc)
+        paused = (self.paused_until - now).total_seconds() if self.paused_until and self.paused_until > now else 0
+        return (f"   - الخطة: {self.plan} (السقف {self.ceiling}/دقيقة)\n"
+                f"   - الحد الحالي: {int(self.limit)}/دقيقة، المستخدم في آخر دقيقة: {self.usage(now)}\n"
+                f"   - مرات الرفض (429): {self.throttled_count}" + (f"، متوقف لمدة {paused:.0f} ث" if paused else ""))
+
+api_request_queue = GovernorScheduler()
+rate_controller = RateController(POLYGON_PLAN, int(os.environ.get('POLYGON_CALLS_PER_MINUTE', 0)) or None)
+metrics.register(Gauge('governor_queue_depth', "الطلبات المنتظرة في طابور الحاكم", api_request_queue.qsize))
+metrics.register(Gauge('polygon_calls_last_minute', "طلبات Polygon في آخر دقيقة", rate_controller.recent_calls))
+metrics.register(Gauge('polygon_rate_limit', "الحد الحالي لطلبات Polygon في الدقيقة", lambda: rate_controller.limit))
+metrics.register(Gauge('polygon_rate_utilisation', "نسبة استخدام حصة الدقيقة (0-1)", lambda: rate_controller.recent_calls() / rate_controller.limit))
+metrics.register(Gauge('polygon_throttled_total', "مرات رفض Polygon للطلبات (429)", lambda: rate_controller.throttled_count))
 
 # --- دالة إرسال الأخطاء إلى تليجرام ---
 async def send_error_to_telegram(context: ContextTypes.DEFAULT_TYPE, error_message: str):
@@ -64,14 +592,76 @@ flask_app = Flask(__name__)
 def health_check():
     return "ALNUSIRY BOT (v5.0 Final Engine) is alive!", 200
 
+@flask_app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
 def run_flask_app():
-    port = int(os.environ.get("PORT", 10000))
-    flask_app.run(host='0.0.0.0', port=port)
+    flask_app.run(host='0.0.0.0', port=HTTP_PORT)
+
+# --- استقبال التحديثات عبر Webhook ---
+# خادم aiohttp واحد على حلقة الأحداث نفسها يخدم تحديثات تليجرام و / و /metrics، فلا استطلاع طويل ولا خيط Flask.
+# تليجرام يرسل السر المسجل مع set_webhook في ترويسة كل طلب، وأي طلب بلا السر الصحيح يُرفض قبل قراءته.
+# الاستطلاع يبقى احتياطياً: run_polling يحذف الـ Webhook المسجل عند بدئه.
+WEBHOOK_PATH = '/telegram'
+WEBHOOK_SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+async def handle_webhook_update(request: web.Request) -> web.Response:
+    if not hmac.compare_digest(request.headers.get(WEBHOOK_SECRET_HEADER, ''), TELEGRAM_WEBHOOK_SECRET):
+        logger.warning(f"Webhook: رفض طلب بلا سر صحيح من {request.remote}.")
+        return web.Response(status=403)
+    try:
+        data = await request.json(loads=json_loads)
+    except ValueError:
+        return web.Response(status=400)
+    application = request.app['telegram']
+    await application.update_queue.put(Update.de_json(data, application.bot))
+    return web.Response()
+
+async def handle_health_check(request: web.Request) -> web.Response:
+    text, status = health_check()
+    return web.Response(text=text, status=status)
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    text, status, headers = metrics_endpoint()
+    return web.Response(text=text, status=status, headers=headers)
+
+async def run_webhook(application: Application):
+    """يشغّل البوت بوضع Webhook حتى SIGINT أو SIGTERM، بنفس تسلسل run_polling (post_init ثم start، و stop ثم post_shutdown)."""
+    stop_requested = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (SIGINT, SIGTERM): loop.add_signal_handler(sig, stop_requested.set)
+
+    web_app = web.Application()
+    web_app['telegram'] = application
+    web_app.add_routes([web.get('/', handle_health_check), web.get('/metrics', handle_metrics),
+                        web.post(WEBHOOK_PATH, handle_webhook_update)])
+    runner = web.AppRunner(web_app)
+    await application.initialize()
+    try:
+        if application.post_init: await application.post_init(application)
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', HTTP_PORT).start()
+        await application.bot.set_webhook(TELEGRAM_WEBHOOK_URL + WEBHOOK_PATH, secret_token=TELEGRAM_WEBHOOK_SECRET,
+                                          allowed_updates=Update.ALL_TYPES)
+        await application.start()
+        logger.info(f"Webhook: البوت يستقبل التحديثات على {TELEGRAM_WEBHOOK_URL}{WEBHOOK_PATH} (المنفذ {HTTP_PORT}).")
+        await stop_requested.wait()
+    finally:
+        logger.info("Webhook: إيقاف الخادم وإنهاء التحديثات الجارية...")
+        # نغلق الخادم أولاً حتى لا تدخل تحديثات جديدة، ثم ننهي ما في الطابور. تليجرام يحتفظ بما يصل أثناء التوقف.
+        await runner.cleanup()
+        if application.running: await application.stop()
+        await application.shutdown()
+        if application.post_shutdown: await application.post_shutdown(application)
 
 # --- حالة البوت والبيانات ---
-bot_state = {}
-signals_statistics = {}
-pending_signals = []
+bot_state = {}  # حالة المالك، وفيها أيضاً إعدادات المحرك المشتركة (مصدر البيانات والتقييم الظلي)
+subscribers = {}  # معرف المحادثة -> حالة المشترك بنفس شكل bot_state؛ المالك أحدهم
+legacy_signals_statistics = {}  # عدادات ما قبل سجل الإشارات، تبقى في الملف حتى تُنقل إلى قاعدة البيانات
+pending_signals = []  # كومة (موعد التأكيد، تسلسل، الإشارة)
+metrics.register(Gauge('pending_confirmations', "الإشارات الأولية بانتظار التأكيد", lambda: len(pending_signals)))
+metrics.register(Gauge('event_loop_lag_last_seconds', "آخر تأخر مقاس لحلقة الأحداث", lambda: loop_health['lag']))
 USER_DEFINED_PAIRS = [
     "EUR/USD", "USD/JPY", "USD/CHF", "AUD/USD", "USD/CAD",
     "EUR/JPY", "AUD/JPY", "CHF/JPY", "EUR/CHF", "AUD/CHF", "CAD/CHF",
@@ -79,23 +669,97 @@ USER_DEFINED_PAIRS = [
 ]
 
 # --- دوال إدارة الحالة والاستراتيجيات ---
-def save_bot_state():
+# الحفظ مؤجل (write-behind): save_bot_state تسجل فقط أن الحالة تغيرت، ومهمة خلفية تكتب الملف مرة واحدة
+# بعد مهلة قصيرة مهما تكرر الحفظ. الكتابة ذرية (ملف مؤقت ثم os.replace) فلا يتلف الملف إذا انهار البوت أثناءها.
+STATE_FLUSH_DELAY_SECONDS = 2.0
+state_persistence = {'dirty': False, 'flush_task': None, 'writes': 0}
+state_write_lock = Lock()
+
+def serialize_bot_state() -> str:
+    # اللقطة تؤخذ في حلقة الأحداث حيث تتغير الحالة، والكتابة وحدها تذهب إلى خيط.
+    state_persistence['dirty'] = False
+    others = {chat_id: state for chat_id, state in subscribers.items() if state is not bot_state}
+    payload = {'bot_state': bot_state, 'subscribers': others}
+    if legacy_signals_statistics: payload['signals_statistics'] = legacy_signals_statistics
+    return json.dumps(payload, indent=4, ensure_ascii=False)
+
+def write_state_file(payload: str):
+    with state_write_lock:
+        temp_file = f"{STATE_FILE}.tmp"
+        with open(temp_file, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, STATE_FILE)
+        state_persistence['writes'] += 1
+
+def flush_bot_state():
+    """يكتب الحالة فوراً إن كانت فيها تغييرات لم تُحفظ (عند الإيقاف أو خارج حلقة الأحداث)."""
+    if not state_persistence['dirty']: return
     try:
-        state_to_save = {'bot_state': bot_state, 'signals_statistics': signals_statistics}
-        with open(STATE_FILE, 'w', encoding='utf-8') as f:
-            json.dump(state_to_save, f, indent=4, ensure_ascii=False)
+        write_state_file(serialize_bot_state())
     except Exception as e:
+        state_persistence['dirty'] = True
         logger.error(f"فشل في حفظ حالة البوت: {e}")
 
-def load_strategy_profile(profile_filename: str) -> bool:
-    global bot_state
+async def flush_state_later():
+    while state_persistence['dirty']:
+        await asyncio.sleep(STATE_FLUSH_DELAY_SECONDS)
+        try:
+            await asyncio.to_thread(write_state_file, serialize_bot_state())
+        except Exception as e:
+            state_persistence['dirty'] = True
+            logger.error(f"فشل في حفظ حالة البوت: {e}")
+
+def save_bot_state():
+    state_persistence['dirty'] = True
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        # قبل تشغيل حلقة الأحداث (تحميل الحالة عند الإقلاع) نكتب مباشرة.
+        flush_bot_state()
+        return
+    task = state_persistence['flush_task']
+    if task is None or task.done():
+        state_persistence['flush_task'] = loop.create_task(flush_state_later())
+
+async def shutdown_state_persistence():
+    task = state_persistence['flush_task']
+    if task is not None and not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    flush_bot_state()
+
+# مفاتيح الحالة التي ليست جزءاً من ملف الاستراتيجية فتبقى عند تحميل ملف آخر.
+PRESERVED_STATE_KEYS = ('is_running', 'selected_pairs', 'data_mode', 'shadow_mode')
+EMERGENCY_PROFILE = {
+    'profile_name': 'الطوارئ',
+    'initial_confidence': 3, 'confirmation_confidence': 4,
+    'scan_interval_seconds': 5, 'confirmation_minutes': 5,
+    'macd_strategy': 'dynamic', 'trend_filter_mode': 'M15',
+    'indicator_params': {
+        'rsi_period': 14, 'macd_fast': 12, 'macd_slow': 26, 'macd_signal': 9,
+        'bollinger_period': 20, 'stochastic_period': 14, 'adx_period': 14,
+        'm15_ema_period': 50, 'h1_ema_period': 50
+    }
+}
+
+def load_strategy_profile(profile_filename: str, state: dict = None) -> bool:
+    """يحمّل ملف الاستراتيجية في حالة المشترك (المالك افتراضياً) مع إبقاء أزواجه وحالة تشغيله."""
+    state = bot_state if state is None else state
     filepath = os.path.join(STRATEGIES_DIR, profile_filename)
     try:
         with open(filepath, 'r', encoding='utf-8') as f:
             profile_settings = json.load(f)
-        is_running, selected_pairs = bot_state.get('is_running', False), bot_state.get('selected_pairs', [])
-        bot_state = profile_settings
-        bot_state.update({'is_running': is_running, 'selected_pairs': selected_pairs})
+        # التعديل في المكان نفسه: المشتركون ومهام الخلفية يحملون مرجعاً إلى القاموس.
+        preserved = {'is_running': False, 'selected_pairs': []}
+        preserved.update({key: state[key] for key in PRESERVED_STATE_KEYS if key in state})
+        state.clear()
+        state.update(profile_settings)
+        state.update(preserved)
         save_bot_state()
         return True
     except (FileNotFoundError, json.JSONDecodeError) as e:
@@ -103,101 +767,800 @@ def load_strategy_profile(profile_filename: str) -> bool:
         return False
 
 def load_bot_state():
-    global bot_state, signals_statistics
+    global bot_state
     try:
         with open(STATE_FILE, 'r', encoding='utf-8') as f:
             loaded_data = json.load(f)
             bot_state = loaded_data.get('bot_state', {})
-            signals_statistics = loaded_data.get('signals_statistics', {})
+            subscribers.update(loaded_data.get('subscribers', {}))
+            legacy_signals_statistics.update(loaded_data.get('signals_statistics', {}))
         logger.info("تم تحميل حالة البوت من الملف.")
     except (FileNotFoundError, json.JSONDecodeError):
         logger.warning("ملف حالة البوت غير موجود. سيتم تحميل 'default.json'.")
         if not os.path.exists(STRATEGIES_DIR): os.makedirs(STRATEGIES_DIR)
         if not load_strategy_profile('default.json'):
             logger.error("فشل تحميل 'default.json'. سيتم استخدام إعدادات الطوارئ.")
-            bot_state = {
-                'is_running': False, 'selected_pairs': [], 'profile_name': 'الطوارئ',
-                'initial_confidence': 3, 'confirmation_confidence': 4,
-                'scan_interval_seconds': 5, 'confirmation_minutes': 5,
-                'macd_strategy': 'dynamic', 'trend_filter_mode': 'M15',
-                'indicator_params': {
-                    'rsi_period': 14, 'macd_fast': 12, 'macd_slow': 26, 'macd_signal': 9,
-                    'bollinger_period': 20, 'stochastic_period': 14, 'adx_period': 14,
-                    'm15_ema_period': 50, 'h1_ema_period': 50
-                }
-            }
-        signals_statistics = {}
+            bot_state = {'is_running': False, 'selected_pairs': [], **copy.deepcopy(EMERGENCY_PROFILE)}
         save_bot_state()
+    subscribers[str(TELEGRAM_CHAT_ID)] = bot_state
 
 def get_strategy_files():
     if not os.path.exists(STRATEGIES_DIR): os.makedirs(STRATEGIES_DIR)
     return [f for f in os.listdir(STRATEGIES_DIR) if f.endswith('.json')]
 
+# --- المشتركون (Subscribers) ---
+# لكل مشترك أزواجه وملفه وعتباته، لكن البيانات تُجلب مرة واحدة لكل زوج وإطار (اتحاد أزواج المشتركين العاملين)،
+# والدرجات تُحسب مرة واحدة لكل مجموعة إعدادات تقييم فريدة ثم تُطبق عتبات كل مشترك عليها.
+EVALUATION_KEYS = ('indicator_params', 'macd_strategy', 'trend_filter_mode')
+
+def is_owner(chat_id) -> bool:
+    return str(chat_id) == str(TELEGRAM_CHAT_ID)
+
+def is_allowed_chat(chat_id) -> bool:
+    # الصلاحية من البيئة وحدها: حذف المحادثة من TELEGRAM_SUBSCRIBER_IDS يلغيها وإن بقيت حالتها في ملف الحالة.
+    chat_id = str(chat_id)
+    return is_owner(chat_id) or chat_id in TELEGRAM_SUBSCRIBER_IDS
+
+def new_subscriber_state() -> dict:
+    state = {}
+    if not load_strategy_profile('default.json', state):
+        state.update({'is_running': False, 'selected_pairs': [], **copy.deepcopy(EMERGENCY_PROFILE)})
+    return state
+
+def subscriber_state(update: Update) -> dict:
+    """حالة المشترك صاحب المحادثة؛ تُنشأ من 'default.json' عند أول استخدام."""
+    chat_id = str(update.effective_chat.id)
+    if chat_id not in subscribers:
+        subscribers[chat_id] = new_subscriber_state()
+        logger.info(f"المشتركون: مشترك جديد {chat_id}.")
+        save_bot_state()
+    return subscribers[chat_id]
+
+def running_subscribers() -> dict:
+    """المشتركون المسموح لهم الذين شغّلوا التحليل؛ المحادثة الملغاة لا تُجلب أزواجها ولا تصلها إشارات."""
+    return {chat_id: state for chat_id, state in list(subscribers.items()) if state.get('is_running', False) and is_allowed_chat(chat_id)}
+
+metrics.register(Gauge('running_subscribers', "المشتركون الذين شغّلوا التحليل", lambda: len(running_subscribers())))
+
+def watched_pairs() -> list:
+    """اتحاد أزواج المشتركين العاملين بترتيب ثابت؛ كل زوج يُجلب مرة واحدة مهما تعدد من يتابعه."""
+    pairs = []
+    for state in running_subscribers().values():
+        pairs.extend(pair for pair in state.get('selected_pairs', []) if pair not in pairs)
+    return pairs
+
+def required_history() -> int:
+    states = list(running_subscribers().values()) or [bot_state]
+    return max(required_m5_history(state.get('indicator_params', {})) for state in states)
+
+def evaluation_settings(state: dict) -> dict:
+    return {key: state[key] for key in EVALUATION_KEYS if key in state}
+
+def evaluation_groups(pair: str = None) -> dict:
+    """يجمع المشتركين العاملين (على الزوج pair إن مُرر) حسب إعدادات التقييم: {المفتاح: (الإعدادات، [المعرفات])}."""
+    groups = {}
+    for chat_id, state in running_subscribers().items():
+        if pair is not None and pair not in state.get('selected_pairs', []): continue
+        settings = evaluation_settings(state)
+        groups.setdefault(json.dumps(settings, sort_keys=True), (settings, []))[1].append(chat_id)
+    return groups
+
+def prune_analysis_due():
+    """يحذف مواعيد التحليل ومحركات المؤشرات لأزواج أو فترات لم يعد يستخدمها أي مشترك عامل."""
+    watched = set(watched_pairs())
+    for pair in [pair for pair in analysis_due if pair not in watched]: del analysis_due[pair]
+    in_use = {engine_key(pair, state.get('indicator_params', {}))
+              for state in running_subscribers().values() for pair in state.get('selected_pairs', [])}
+    for key in [key for key in indicator_engines if key not in in_use]: del indicator_engines[key]
+
+async def reject_unknown_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """يوقف أي تحديث من محادثة ليست ضمن المشتركين المسموح لهم قبل أن يصل إلى باقي المعالجات."""
+    chat = update.effective_chat
+    if chat is None or is_allowed_chat(chat.id): return
+    logger.warning(f"المشتركون: رفض تحديث من محادثة غير مسموح لها ({chat.id}).")
+    if update.message: await update.message.reply_text("⛔ هذا البوت خاص بالمشتركين.")
+    raise ApplicationHandlerStop
+
+# --- سجل الإشارات (SQLite) ---
+# كل إشارة أولية وكل نتيجة تأكيد تُسجل بصف كامل في SQLite بوضع WAL. الكتابة مؤجلة ومجمعة في معاملة واحدة
+# على خيط مخصص، وجدول signal_daily تحدّثه المشغلات (triggers) فتبقى الإحصائيات فورية مهما كبر السجل.
+SIGNALS_DB_FILE = os.environ.get('SIGNALS_DB_FILE', 'signals.db')
+SIGNALS_FLUSH_DELAY_SECONDS = 1.0
+# بداية كل جلسة بتوقيت UTC؛ تداخل لندن ونيويورك جلسة مستقلة.
+TRADING_SESSIONS = ((0, 'asia'), (7, 'london'), (12, 'london_ny'), (16, 'new_york'), (21, 'sydney'))
+SESSION_NAMES = {'asia': 'آسيا', 'london': 'لندن', 'london_ny': 'لندن ونيويورك', 'new_york': 'نيويورك', 'sydney': 'سيدني'}
+SIGNALS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS signals (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    pair TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    outcome TEXT,
+    buy_score INTEGER,
+    sell_score INTEGER,
+    trend_m15 TEXT,
+    trend_h1 TEXT,
+    profile TEXT,
+    session TEXT NOT NULL,
+    initial_id INTEGER,
+    votes TEXT,
+    indicators TEXT,
+    subscriber TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_signals_pair_ts ON signals (pair, ts);
+CREATE INDEX IF NOT EXISTS idx_signals_kind_outcome_ts ON signals (kind, outcome, ts);
+CREATE TABLE IF NOT EXISTS signal_daily (
+    day TEXT NOT NULL,
+    subscriber TEXT NOT NULL,
+    pair TEXT NOT NULL,
+    session TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, subscriber, pair, session, kind, outcome)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS signal_daily_insert AFTER INSERT ON signals BEGIN
+    INSERT INTO signal_daily (day, subscriber, pair, session, kind, outcome, count)
+    VALUES (date(NEW.ts, 'unixepoch'), COALESCE(NEW.subscriber, ''), NEW.pair, NEW.session, NEW.kind, COALESCE(NEW.outcome, ''), 1)
+    ON CONFLICT (day, subscriber, pair, session, kind, outcome) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS signal_daily_outcome AFTER UPDATE OF outcome ON signals BEGIN
+    UPDATE signal_daily SET count = count - 1
+    WHERE day = date(OLD.ts, 'unixepoch') AND subscriber = COALESCE(OLD.subscriber, '') AND pair = OLD.pair AND session = OLD.session
+      AND kind = OLD.kind AND outcome = COALESCE(OLD.outcome, '');
+    INSERT INTO signal_daily (day, subscriber, pair, session, kind, outcome, count)
+    VALUES (date(NEW.ts, 'unixepoch'), COALESCE(NEW.subscriber, ''), NEW.pair, NEW.session, NEW.kind, COALESCE(NEW.outcome, ''), 1)
+    ON CONFLICT (day, subscriber, pair, session, kind, outcome) DO UPDATE SET count = count + 1;
+END;
+CREATE TABLE IF NOT EXISTS profile_daily (
+    day TEXT NOT NULL,
+    profile TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (day, profile, outcome)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS profile_daily_insert AFTER INSERT ON signals WHEN NEW.kind = 'shadow' BEGIN
+    INSERT INTO profile_daily (day, profile, outcome, count)
+    VALUES (date(NEW.ts, 'unixepoch'), COALESCE(NEW.profile, ''), COALESCE(NEW.outcome, ''), 1)
+    ON CONFLICT (day, profile, outcome) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS profile_daily_outcome AFTER UPDATE OF outcome ON signals WHEN NEW.kind = 'shadow' BEGIN
+    UPDATE profile_daily SET count = count - 1
+    WHERE day = date(OLD.ts, 'unixepoch') AND profile = COALESCE(OLD.profile, '') AND outcome = COALESCE(OLD.outcome, '');
+    INSERT INTO profile_daily (day, profile, outcome, count)
+    VALUES (date(NEW.ts, 'unixepoch'), COALESCE(NEW.profile, ''), COALESCE(NEW.outcome, ''), 1)
+    ON CONFLICT (day, profile, outcome) DO UPDATE SET count = count + 1;
+END;
+"""
+# سجلات ما قبل تعدد المشتركين: تُنسب إلى المالك، وجدول التجميع المشتق يُبنى من جديد بعمود المشترك.
+SIGNALS_SUBSCRIBER_MIGRATION = """
+ALTER TABLE signals ADD COLUMN subscriber TEXT;
+DROP TRIGGER IF EXISTS signal_daily_insert;
+DROP TRIGGER IF EXISTS signal_daily_outcome;
+DROP TABLE IF EXISTS signal_daily;
+"""
+# عدادات bot_state.json القديمة بلا تاريخ ولا جلسة: تُضاف إلى التجميع بيوم فارغ فتدخل المجاميع الكلية فقط،
+# بعد طرح ما سُجل منها في قاعدة البيانات أصلاً. PRAGMA user_version يمنع تكرار النقل.
+LEGACY_STATISTICS_VERSION = 1
+LEGACY_STATISTICS_KINDS = {'initial': ('initial', ''), 'confirmed': ('confirmation', 'confirmed'),
+                           'failed_confirmation': ('confirmation', 'failed'), 'expired': ('confirmation', 'expired')}
+REBUILD_SIGNAL_DAILY_SQL = ("INSERT INTO signal_daily (day, subscriber, pair, session, kind, outcome, count) "
+                            "SELECT date(ts, 'unixepoch'), COALESCE(subscriber, ''), pair, session, kind, COALESCE(outcome, ''), COUNT(*) "
+                            "FROM signals GROUP BY 1, 2, 3, 4, 5, 6")
+# تجميع إشارات الظل حسب الملف (profile_daily) أُضيف لاحقاً: يُبنى من السجل مرة واحدة عند إنشائه.
+REBUILD_PROFILE_DAILY_SQL = ("INSERT INTO profile_daily (day, profile, outcome, count) "
+                             "SELECT date(ts, 'unixepoch'), COALESCE(profile, ''), COALESCE(outcome, ''), COUNT(*) "
+                             "FROM signals WHERE kind = 'shadow' GROUP BY 1, 2, 3")
+INSERT_SIGNAL_SQL = ("INSERT INTO signals (id, ts, pair, kind, direction, outcome, buy_score, sell_score, trend_m15, trend_h1, "
+                     "profile, session, initial_id, votes, indicators, subscriber) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+def trading_session(ts: datetime) -> str:
+    return next(name for start_hour, name in reversed(TRADING_SESSIONS) if ts.hour >= start_hour)
+
+class SignalStore:
+    """سجل الإشارات: الكتابات تُجمع في الذاكرة وتُنفذ دفعة واحدة على خيط قاعدة البيانات، والاستعلامات على الخيط نفسه."""
+    def __init__(self, path: str):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='signals-db')
+        self._connection = None
+        self._pending = []
+        self._flush_task = None
+        # المعرفات تُولد هنا حتى يُربط التأكيد بإشارته الأولية قبل أن تُكتب فعلياً، وتبدأ بعد أكبر معرف في القاعدة (open).
+        self._ids = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            columns = {row[1] for row in self._connection.execute("PRAGMA table_info(signals)")}
+            migrate = bool(columns) and 'subscriber' not in columns
+            if migrate:
+                self._connection.executescript(SIGNALS_SUBSCRIBER_MIGRATION)
+                with self._connection:
+                    self._connection.execute("UPDATE signals SET subscriber = ? WHERE kind != 'shadow'", (str(TELEGRAM_CHAT_ID),))
+            profile_rollup = self._connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'profile_daily'").fetchone()
+            self._connection.executescript(SIGNALS_SCHEMA)
+            if migrate:
+                with self._connection: self._connection.execute(REBUILD_SIGNAL_DAILY_SQL)
+            if columns and profile_rollup is None:
+                with self._connection: self._connection.execute(REBUILD_PROFILE_DAILY_SQL)
+        return self._connection
+
+    def _open(self, legacy_statistics: dict) -> int:
+        connection = self._connect()
+        if legacy_statistics and connection.execute("PRAGMA user_version").fetchone()[0] < LEGACY_STATISTICS_VERSION:
+            owner = str(TELEGRAM_CHAT_ID)
+            recorded = {}
+            for pair, kind, outcome, count in connection.execute(
+                    "SELECT pair, kind, outcome, SUM(count) FROM signal_daily WHERE subscriber = ? GROUP BY 1, 2, 3", (owner,)):
+                # الإشارة الأولية تُعد أولية مهما صارت نتيجتها.
+                key = (pair, kind, '' if kind == 'initial' else outcome)
+                recorded[key] = recorded.get(key, 0) + count
+            with connection:
+                for pair, counters in legacy_statistics.items():
+                    for name, (kind, outcome) in LEGACY_STATISTICS_KINDS.items():
+                        count = counters.get(name, 0) - recorded.get((pair, kind, outcome), 0)
+                        if count > 0:
+                            connection.execute("INSERT INTO signal_daily (day, subscriber, pair, session, kind, outcome, count) "
+                                               "VALUES ('', ?, ?, '', ?, ?, ?)", (owner, pair, kind, outcome, count))
+                connection.execute(f"PRAGMA user_version = {LEGACY_STATISTICS_VERSION}")
+        return connection.execute("SELECT COALESCE(MAX(id), 0) FROM signals").fetchone()[0] + 1
+
+    def open(self, legacy_statistics: dict = None) -> bool:
+        """يفتح القاعدة وينقل عدادات الإحصائيات القديمة مرة واحدة ويبدأ المعرفات بعد آخر إشارة. يعيد True إن نجح النقل."""
+        try:
+            next_id = self._executor.submit(self._open, legacy_statistics or {}).result()
+        except sqlite3.Error as e:
+            logger.error(f"سجل الإشارات: تعذر فتح قاعدة البيانات: {e}")
+            self._ids = self._ids or itertools.count(1)
+            return False
+        self._ids = itertools.count(next_id)
+        return True
+
+    def _write(self, operations: list):
+        connection = self._connect()
+        with connection:
+            for sql, params in operations: connection.execute(sql, params)
+
+    def _fetch(self, sql: str, params: tuple) -> list:
+        return self._connect().execute(sql, params).fetchall()
+
+    def _submit(self, sql: str, params: tuple):
+        self._pending.append((sql, params))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        while self._pending:
+            await asyncio.sleep(SIGNALS_FLUSH_DELAY_SECONDS)
+            operations, self._pending = self._pending, []
+            try:
+                await asyncio.get_running_loop().run_in_executor(self._executor, self._write, operations)
+            except Exception as e:
+                logger.error(f"سجل الإشارات: فشل الحفظ في قاعدة البيانات ({len(operations)} عملية): {e}")
+
+    def record(self, kind: str, pair: str, direction: str, timestamp: datetime, buy_strength: int = None, sell_strength: int = None,
+               trends: tuple = (None, None), details: dict = None, outcome: str = None, initial_id: int = None, profile: str = None,
+               subscriber: str = None) -> int:
+        if self._ids is None: self.open()
+        signal_id = next(self._ids)
+        signals_recorded.inc(kind, outcome or 'pending')
+        details = details or {}
+        indicators = json.dumps(details['indicators']) if details.get('indicators') else None
+        self._submit(INSERT_SIGNAL_SQL, (signal_id, timestamp.timestamp(), pair, kind, direction, outcome, buy_strength, sell_strength,
+                                         trends[0], trends[1], profile or bot_state.get('profile_name'), trading_session(timestamp),
+                                         initial_id, details.get('votes'), indicators, subscriber))
+        return signal_id
+
+    def resolve(self, signal_id: int, outcome: str):
+        if signal_id is None: return
+        signals_recorded.inc('resolved', outcome)
+        self._submit("UPDATE signals SET outcome = ? WHERE id = ?", (outcome, signal_id))
+
+    async def query(self, sql: str, params: tuple = ()) -> list:
+        # الكتابات المؤجلة تُنفذ أولاً على الخيط نفسه حتى ترى الاستعلامات آخر الإشارات.
+        loop = asyncio.get_running_loop()
+        operations, self._pending = self._pending, []
+        if operations: await loop.run_in_executor(self._executor, self._write, operations)
+        return await loop.run_in_executor(self._executor, self._fetch, sql, params)
+
+    def flush(self):
+        operations, self._pending = self._pending, []
+        if operations: self._executor.submit(self._write, operations).result()
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done(): await self._flush_task
+        self.flush()
+        if self._connection is not None: self._executor.submit(self._connection.close).result()
+        self._executor.shutdown(wait=True)
+
+signal_store = SignalStore(SIGNALS_DB_FILE)
+
+# --- عميل HTTP غير متزامن لـ Polygon ---
+# جلسة aiohttp واحدة باتصالات دائمة (keep-alive) بدلاً من اتصال TLS جديد في خيط منفصل لكل طلب.
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 20
+HTTP_MAX_RETRIES = 2
+HTTP_BACKOFF_SECONDS = 1.0
+
+class PolygonHTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+
+class PolygonRateLimited(PolygonHTTPError):
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(429, message)
+        self.retry_after = retry_after
+
+class PolygonClient:
+    """عميل Polygon مع تجمع اتصالات ومهلات صريحة وإعادة محاولة بتأخير عشوائي لأخطاء 5xx والمهلات."""
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=120),
+                timeout=aiohttp.ClientTimeout(connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT),
+                headers={"Authorization": f"Bearer {self.api_key}"},
+            )
+        return self._session
+
+    async def get_json(self, url: str, on_retry=None) -> dict:
+        """يجلب JSON من الرابط. on_retry يُستدعى قبل كل إعادة محاولة (كل محاولة تستهلك من حصة الطلبات)."""
+        for attempt in range(HTTP_MAX_RETRIES + 1):
+            try:
+                async with self._get_session().get(url) as response:
+                    if response.status == 429:
+                        retry_after = response.headers.get('Retry-After', '')
+                        raise PolygonRateLimited(await response.text(), float(retry_after) if retry_after.replace('.', '', 1).isdigit() else None)
+                    if response.status >= 400:
+                        raise PolygonHTTPError(response.status, await response.text())
+                    return json_loads(await response.read())
+            except (PolygonHTTPError, asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                # أخطاء العميل (بما فيها 429) لا تُعاد هنا؛ الحاكم هو من يقرر.
+                retryable = not isinstance(e, PolygonHTTPError) or e.status >= 500
+                if not retryable or attempt == HTTP_MAX_RETRIES: raise
+                delay = HTTP_BACKOFF_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5)
+                logger.warning(f"Polygon: فشل الطلب ({e})، إعادة المحاولة بعد {delay:.1f} ث.")
+                await asyncio.sleep(delay)
+                if on_retry: on_retry()
+
+    def ws_connect(self, url: str):
+        return self._get_session().ws_connect(url, heartbeat=30)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+polygon_client = PolygonClient(POLYGON_API_KEY)
+
+def fetch_error_reason(error: Exception) -> str:
+    if isinstance(error, PolygonRateLimited): return 'rate_limited'
+    if isinstance(error, PolygonHTTPError): return 'http_5xx' if error.status >= 500 else 'http_4xx'
+    if isinstance(error, asyncio.TimeoutError): return 'timeout'
+    if isinstance(error, aiohttp.ClientConnectionError): return 'connection'
+    return 'other'
+
+async def timed_polygon_fetch(url: str, timeframe: str) -> dict:
+    """يجلب من Polygon ويسجل الزمن والأخطاء في مقاييس الإطار الزمني."""
+    started = time.perf_counter()
+    try:
+        return await polygon_client.get_json(url, on_retry=rate_controller.record_call)
+    except Exception as e:
+        polygon_fetch_errors.inc(timeframe, fetch_error_reason(e))
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        polygon_fetch_seconds.observe(duration, timeframe)
+        record_span('http', started, duration)
+
+# --- ذاكرة الشموع المؤقتة (Candle Cache) ---
+# نحتفظ بتاريخ الشموع لكل (زوج، إطار زمني) ونطلب من Polygon فقط الشموع الأحدث من آخر شمعة مخزنة.
+CANDLE_CACHE_MAX_BARS = 2000
+TIMEFRAME_SPECS = {"M5": ("5", "minute"), "M15": ("15", "minute"), "H1": ("1", "hour")}
+candle_cache = {}
+
+def build_aggregates_url(pair: str, timeframe: str, limit: int, since: datetime = None) -> str:
+    polygon_ticker = f"C:{pair.replace('/', '')}"
+    interval, timespan = TIMEFRAME_SPECS[timeframe]
+    end_date = datetime.now(timezone.utc)
+    if since is not None:
+        # طلب تزايدي: من آخر شمعة مخزنة (تُعاد لأنها قد تكون ما زالت قيد التكوين) وحتى الآن.
+        start_ms, end_ms = int(since.timestamp() * 1000), int(end_date.timestamp() * 1000)
+        return (f"{POLYGON_BASE_URL}/v2/aggs/ticker/{polygon_ticker}/range/{interval}/{timespan}/"
+                f"{start_ms}/{end_ms}?adjusted=true&sort=asc&limit=50000")
+
+    if timespan == 'minute': start_date = end_date - timedelta(days=(int(interval) * limit) / (24 * 60) + 5)
+    else: start_date = end_date - timedelta(days=(int(interval) * limit) / 24 + 10)
+    return (f"{POLYGON_BASE_URL}/v2/aggs/ticker/{polygon_ticker}/range/{interval}/{timespan}/"
+            f"{start_date.strftime('%Y-%m-%d')}/{end_date.strftime('%Y-%m-%d')}?adjusted=true&sort=asc&limit={limit}")
+
+CANDLE_COLUMNS = ('Open', 'High', 'Low', 'Close', 'Volume')
+
+class CandleArray:
+    """شموع Polygon بلا كائن لكل شمعة: الزمن int64 بالملي ثانية، والأسعار كتلة float64 واحدة (5 × الشموع) صفوفها OHLCV.
+
+    التقطيع يعيد عروضاً (views) على المصفوفات نفسها، و to_frame يبني إطاراً بكتلة pandas واحدة فوق كتلة الأسعار نفسها،
+    فكل عمود في الإطار عرض على صفها دون نسخ.
+    """
+    __slots__ = ('t', 'prices')
+
+    def __init__(self, t: np.ndarray, prices: np.ndarray):
+        self.t, self.prices = t, prices
+
+    @classmethod
+    def from_results(cls, results: list) -> 'CandleArray':
+        # كل عمود يُبنى مباشرة من قواميس JSON في صفه من الكتلة النهائية، دون DataFrame وسيط.
+        count = len(results)
+        t = np.fromiter(map(itemgetter('t'), results), dtype=np.int64, count=count)
+        prices = np.empty((len(CANDLE_COLUMNS), count))
+        for row, key in zip(prices, 'ohlcv'): row[:] = np.fromiter(map(itemgetter(key), results), dtype=np.float64, count=count)
+        return cls(t, prices)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'CandleArray':
+        # إطار مبني بـ to_frame يعيد كتلته نفسها؛ الإطارات الأخرى (بعد دمج دقائق اللقطة مثلاً) تُنسخ مرة واحدة.
+        return cls(df.index.as_unit('ms').asi8, df[list(CANDLE_COLUMNS)].to_numpy(dtype=np.float64).T)
+
+    def __len__(self) -> int:
+        return len(self.t)
+
+    def __getitem__(self, key: slice) -> 'CandleArray':
+        return CandleArray(self.t[key], self.prices[:, key])
+
+    def since(self, timestamp_ms: int) -> 'CandleArray':
+        return self[int(np.searchsorted(self.t, timestamp_ms, side='left')):]
+
+    def to_frame(self) -> pd.DataFrame:
+        index = pd.DatetimeIndex(pd.to_datetime(self.t, unit='ms', utc=True), name='datetime')
+        return pd.DataFrame(self.prices.T, index=index, columns=list(CANDLE_COLUMNS), copy=False)
+
+def parse_aggregates(data: dict) -> CandleArray:
+    return CandleArray.from_results(data.get('results') or [])
+
+def merge_candles(pair: str, timeframe: str, candles: CandleArray, limit: int) -> pd.DataFrame:
+    """يدمج الشموع الجديدة في الذاكرة المؤقتة ويعيد التاريخ المحدّث.
+
+    الدمج على المصفوفات في كتلة أسعار جديدة واحدة (النسخة الوحيدة في الجلب)، والإطار المخزن عرض عليها.
+    """
+    key = (pair, timeframe)
+    cached = candle_cache.get(key)
+    if cached is not None and not cached.empty and len(candles):
+        old = CandleArray.from_frame(cached)
+        # الشموع الجديدة تحل محل ما يقابلها في الذاكرة: الشمعة الأخيرة قد تكون تغيرت منذ الجلب السابق.
+        before = int(np.searchsorted(old.t, candles.t[0], side='left'))
+        after = int(np.searchsorted(old.t, candles.t[-1], side='right'))
+        candles = CandleArray(np.concatenate([old.t[:before], candles.t, old.t[after:]]),
+                              np.concatenate([old.prices[:, :before], candles.prices, old.prices[:, after:]], axis=1))
+    if cached is not None and not cached.empty and not len(candles):
+        merged = cached
+    else:
+        merged = candles[-max(CANDLE_CACHE_MAX_BARS, limit):].to_frame()
+    if not merged.empty:
+        candle_cache[key] = merged
+    if timeframe == 'M5' and len(candles) and not merged.empty: note_rest_bar(pair, merged, datetime.now(timezone.utc))
+    return merged
+
 # --- دوال التحليل الفني ---
 async def execute_get_forex_data(pair: str, timeframe: str, limit: int, context: ContextTypes.DEFAULT_TYPE) -> pd.DataFrame:
     if not POLYGON_API_KEY:
         await send_error_to_telegram(context, "متغير البيئة POLYGON_API_KEY غير موجود!")
         return pd.DataFrame()
     
-    polygon_ticker = f"C:{pair.replace('/', '')}"
-    interval_map = {"M5": "5", "M15": "15", "H1": "1"}
-    timespan_map = {"M5": "minute", "M15": "minute", "H1": "hour"}
-    if timeframe not in interval_map: return pd.DataFrame()
-    
-    interval, timespan = interval_map[timeframe], timespan_map[timeframe]
-    end_date = datetime.now(timezone.utc)
-    if timespan == 'minute': start_date = end_date - timedelta(days=(int(interval) * limit) / (24 * 60) + 5)
-    else: start_date = end_date - timedelta(days=(int(interval) * limit) / 24 + 10)
+    if timeframe not in TIMEFRAME_SPECS: return pd.DataFrame()
     
-    url = (f"https://api.polygon.io/v2/aggs/ticker/{polygon_ticker}/range/{interval}/{timespan}/"
-           f"{start_date.strftime('%Y-%m-%d')}/{end_date.strftime('%Y-%m-%d')}?adjusted=true&sort=asc&limit={limit}")
-    headers = {"Authorization": f"Bearer {POLYGON_API_KEY}"}
+    cached = candle_cache.get((pair, timeframe))
+    since = cached.index[-1] if cached is not None and len(cached) >= limit else None
+    url = build_aggregates_url(pair, timeframe, limit, since)
     
     try:
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(None, lambda: requests.get(url, headers=headers, timeout=20))
-        response.raise_for_status()
-        data = response.json()
+        data = await timed_polygon_fetch(url, timeframe)
+        rate_controller.on_success()
         
-        if "results" in data and data['results']:
-            df = pd.DataFrame(data['results'])
-            df['datetime'] = pd.to_datetime(df['t'], unit='ms', utc=True)
-            df = df.set_index('datetime')[['o', 'h', 'l', 'c', 'v']].astype(float)
-            df.columns = ['Open', 'High', 'Low', 'Close', 'Volume']
-            return df
-        return pd.DataFrame()
+        with TraceSpan('parse'):
+            merged = merge_candles(pair, timeframe, parse_aggregates(data), limit)
+        # عرض على الذاكرة لا نسخة (tail في pandas 3 ينسخ دائماً): النسخ عند الكتابة يحمي الذاكرة من تعديلات التحليل.
+        return merged.iloc[-limit:]
         
+    except PolygonRateLimited:
+        # الحاكم يتعامل مع الرفض (يخفض الحد ويعيد الطلب إلى الطابور).
+        raise
     except Exception as e:
         await send_error_to_telegram(context, f"فشل الاتصال بـ Polygon API لجلب بيانات {pair} ({timeframe}): {e}")
         return pd.DataFrame()
 
+# --- بناء شموع M15 و H1 محلياً من M5 ---
+# جلب واحد أعمق لـ M5 يغني عن ثلاث طلبات API لكل زوج.
+ANALYSIS_BARS = 200
+TREND_HISTORY_BARS = 150
+RESAMPLE_RULES = {"M15": ("15min", 3), "H1": ("1h", 12)}
+
+def resample_candles(df: pd.DataFrame, timeframe: str) -> pd.DataFrame:
+    """يبني شموع M15 أو H1 من شموع M5."""
+    rule, bars_per_bucket = RESAMPLE_RULES[timeframe]
+    grouped = df.resample(rule, label='left', closed='left')
+    resampled = grouped.agg({'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'})
+    counts = grouped['Close'].count()
+    resampled, counts = resampled[counts > 0], counts[counts > 0]
+    # الحافة الأولى: إذا بدأ تاريخ M5 في منتصف الفترة فالشمعة الأولى ناقصة ومضللة فنحذفها.
+    # الحافة الأخيرة: الشمعة الجارية تبقى كما يعيدها Polygon تماماً لو طلبنا الإطار مباشرة.
+    if not counts.empty and counts.iloc[0] < bars_per_bucket:
+        resampled = resampled.iloc[1:]
+    return resampled
+
+def required_m5_history(params: dict) -> int:
+    """عدد شموع M5 اللازمة لحساب اتجاه M15 و H1 بنفس عمق الجلب المباشر السابق."""
+    m15_bars = max(TREND_HISTORY_BARS, 3 * params.get('m15_ema_period', 50))
+    h1_bars = max(TREND_HISTORY_BARS, 3 * params.get('h1_ema_period', 50))
+    # شمعة إضافية من كل إطار تعوض الشمعة الأولى الناقصة التي تحذف عند التجميع.
+    return max(ANALYSIS_BARS, (m15_bars + 1) * 3, (h1_bars + 1) * 12)
+
+def compute_trend(df: pd.DataFrame, period: int) -> str:
+    if df is None or df.empty: return 'NEUTRAL'
+    ema = ta.trend.EMAIndicator(df['Close'], window=period).ema_indicator()
+    if ema.dropna().empty: return 'NEUTRAL'
+    return 'UP' if df['Close'].iloc[-1] > ema.iloc[-1] else 'DOWN'
+
+BULLISH_PATTERNS = ['CDLHAMMER', 'CDLMORNINGSTAR', 'CDL3WHITESOLDIERS']
+BEARISH_PATTERNS = ['CDLHANGINGMAN', 'CDLEVENINGSTAR', 'CDL3BLACKCROWS']
+
 def analyze_candlestick_patterns(data: pd.DataFrame) -> (int, int):
     buy_score, sell_score = 0, 0
-    bullish_patterns = ['CDLHAMMER', 'CDLMORNINGSTAR', 'CDL3WHITESOLDIERS']
-    bearish_patterns = ['CDLHANGINGMAN', 'CDLEVENINGSTAR', 'CDL3BLACKCROWS']
-    for pattern in bullish_patterns:
+    for pattern in BULLISH_PATTERNS:
         result = getattr(talib, pattern)(data['Open'], data['High'], data['Low'], data['Close'])
         if not result.empty and result.iloc[-1] > 0: buy_score += 1
-    for pattern in bearish_patterns:
+    for pattern in BEARISH_PATTERNS:
         result = getattr(talib, pattern)(data['Open'], data['High'], data['Low'], data['Close'])
         if not result.empty and result.iloc[-1] < 0: sell_score += 1
     return buy_score, sell_score
 
-def analyze_signal_strength(df: pd.DataFrame, trend_m15: str, trend_h1: str) -> (int, int):
-    buy, sell = 0, 0
-    params = bot_state.get('indicator_params', {})
-    trend_mode = bot_state.get('trend_filter_mode', 'M15')
-    
-    if trend_mode == 'M15' and trend_m15 == 'DOWN': buy = -99
-    if trend_mode == 'M15' and trend_m15 == 'UP': sell = -99
-    if trend_mode == 'H1' and trend_h1 == 'DOWN': buy = -99
-    if trend_mode == 'H1' and trend_h1 == 'UP': sell = -99
-    if trend_mode == 'M15_H1' and (trend_m15 == 'DOWN' or trend_h1 == 'DOWN'): buy = -99
-    if trend_mode == 'M15_H1' and (trend_m15 == 'UP' or trend_h1 == 'UP'): sell = -99
-
-    required_len = max(v for k, v in params.items() if 'period' in k)
-    if df is None or df.empty or len(df) < required_len: return 0, 0
-    
+# --- محرك المؤشرات التزايدي (Streaming Indicator Engine) ---
+# يحتفظ بحالة كل مؤشر لكل زوج ويحدّثها بكلفة ثابتة عند وصول شمعة جديدة، بنفس معادلات مكتبة ta.
+# كل دالة update تقبل commit=False لحساب قيم الشمعة الجارية (غير المكتملة) دون تعديل الحالة.
+NAN = float('nan')
+PATTERN_LOOKBACK_BARS = 40
+
+class StreamingEMA:
+    """مكافئ لـ Series.ewm(alpha, min_periods, adjust=False).mean()."""
+    __slots__ = ('alpha', 'min_periods', 'value', 'count')
+
+    def __init__(self, alpha: float, min_periods: int):
+        self.alpha, self.min_periods = alpha, min_periods
+        self.value, self.count = None, 0
+
+    def update(self, x: float, commit: bool = True) -> float:
+        value = x if self.value is None else self.value + self.alpha * (x - self.value)
+        count = self.count + 1
+        if commit: self.value, self.count = value, count
+        return value if count >= self.min_periods else NAN
+
+class StreamingRSI:
+    __slots__ = ('up', 'down', 'prev_close')
+
+    def __init__(self, window: int):
+        self.up, self.down = StreamingEMA(1 / window, window), StreamingEMA(1 / window, window)
+        self.prev_close = None
+
+    def update(self, close: float, commit: bool = True) -> float:
+        # مثل ta: الفرق الأول غير معرف ويعامل كصفر في سلسلتي الصعود والهبوط.
+        diff = 0.0 if self.prev_close is None else close - self.prev_close
+        up = self.up.update(max(diff, 0.0), commit)
+        down = self.down.update(max(-diff, 0.0), commit)
+        if commit: self.prev_close = close
+        if down != down: return NAN
+        return 100.0 if down == 0 else 100.0 - 100.0 / (1.0 + up / down)
+
+class StreamingMACD:
+    __slots__ = ('fast', 'slow', 'signal')
+
+    def __init__(self, fast: int, slow: int, signal: int):
+        self.fast = StreamingEMA(2 / (fast + 1), fast)
+        self.slow = StreamingEMA(2 / (slow + 1), slow)
+        self.signal = StreamingEMA(2 / (signal + 1), signal)
+
+    def update(self, close: float, commit: bool = True) -> (float, float):
+        fast, slow = self.fast.update(close, commit), self.slow.update(close, commit)
+        if slow != slow: return NAN, NAN
+        macd = fast - slow
+        return macd, self.signal.update(macd, commit)
+
+class StreamingBollinger:
+    """متوسط وانحراف معياري (ddof=0) متحركان بمجاميع مزاحة لتقليل أخطاء التقريب."""
+    __slots__ = ('window', 'values', 'shift', 'sum1', 'sum2', 'updates')
+    RESYNC_EVERY = 1000
+
+    def __init__(self, window: int):
+        self.window, self.values = window, deque()
+        self.shift, self.sum1, self.sum2, self.updates = None, 0.0, 0.0, 0
+
+    def update(self, close: float, commit: bool = True) -> (float, float):
+        shift = close if self.shift is None else self.shift
+        d = close - shift
+        sum1, sum2, n = self.sum1 + d, self.sum2 + d * d, len(self.values) + 1
+        if n > self.window:
+            old = self.values[0] - shift
+            sum1, sum2, n = sum1 - old, sum2 - old * old, self.window
+        if commit:
+            self.shift, self.sum1, self.sum2 = shift, sum1, sum2
+            self.values.append(close)
+            if len(self.values) > self.window: self.values.popleft()
+            self.updates += 1
+            if self.updates % self.RESYNC_EVERY == 0: self._resync()
+        if n < self.window: return NAN, NAN
+        mean = sum1 / n
+        std = max(sum2 / n - mean * mean, 0.0) ** 0.5
+        return shift + mean + 2 * std, shift + mean - 2 * std
+
+    def _resync(self):
+        self.shift = self.values[-1]
+        self.sum1 = sum(v - self.shift for v in self.values)
+        self.sum2 = sum((v - self.shift) ** 2 for v in self.values)
+
+class RollingExtreme:
+    """أعلى/أدنى قيمة في نافذة متحركة عبر طابور رتيب (كلفة ثابتة في المتوسط)."""
+    __slots__ = ('window', 'is_max', 'candidates', 'index')
+
+    def __init__(self, window: int, is_max: bool):
+        self.window, self.is_max = window, is_max
+        self.candidates, self.index = deque(), 0
+
+    def _better(self, a: float, b: float) -> bool:
+        return a >= b if self.is_max else a <= b
+
+    def update(self, x: float, commit: bool = True) -> float:
+        index, oldest = self.index, self.index - self.window + 1
+        if not commit:
+            best = x
+            for i, value in self.candidates:
+                if i >= oldest:
+                    if self._better(value, best): best = value
+                    break
+            return best if index + 1 >= self.window else NAN
+        while self.candidates and self._better(x, self.candidates[-1][1]): self.candidates.pop()
+        self.candidates.append((index, x))
+        while self.candidates[0][0] < oldest: self.candidates.popleft()
+        self.index += 1
+        return self.candidates[0][1] if index + 1 >= self.window else NAN
+
+class StreamingStochastic:
+    __slots__ = ('lowest', 'highest', 'recent_k', 'smooth_window')
+
+    def __init__(self, window: int, smooth_window: int = 3):
+        self.lowest, self.highest = RollingExtreme(window, False), RollingExtreme(window, True)
+        self.smooth_window, self.recent_k = smooth_window, deque(maxlen=smooth_window - 1)
+
+    def update(self, high: float, low: float, close: float, commit: bool = True) -> (float, float):
+        lowest, highest = self.lowest.update(low, commit), self.highest.update(high, commit)
+        k = 100 * (close - lowest) / (highest - lowest) if highest != lowest else NAN
+        window = list(self.recent_k) + [k]
+        d = sum(window) / len(window) if len(window) == self.smooth_window else NAN
+        if commit: self.recent_k.append(k)
+        return k, d
+
+class StreamingADX:
+    """يطابق ADXIndicator في ta: تهيئة بمجموع أول نافذة ثم تنعيم Wilder."""
+    __slots__ = ('window', 'count', 'prev', 'trs', 'dip', 'din', 'dx_warmup', 'adx')
+
+    def __init__(self, window: int):
+        self.window, self.count, self.prev = window, 0, None
+        self.trs = self.dip = self.din = 0.0
+        self.dx_warmup, self.adx = [], None
+
+    def update(self, high: float, low: float, close: float, commit: bool = True) -> (float, float, float):
+        w, count = self.window, self.count
+        if self.prev is None:
+            if commit: self.prev, self.count = (high, low, close), 1
+            return NAN, NAN, NAN
+        prev_high, prev_low, prev_close = self.prev
+        tr = max(high, prev_close) - min(low, prev_close)
+        up, down = high - prev_high, prev_low - low
+        pos = up if up > down and up > 0 else 0.0
+        neg = down if down > up and down > 0 else 0.0
+        if count <= w:
+            trs, dip, din = self.trs + tr, self.dip + pos, self.din + neg
+        else:
+            trs, dip, din = self.trs - self.trs / w + tr, self.dip - self.dip / w + pos, self.din - self.din / w + neg
+
+        dmp = dmn = adx = NAN
+        if count >= w:
+            dmp = 100 * dip / trs if trs != 0 else 0.0
+            dmn = 100 * din / trs if trs != 0 else 0.0
+            dx = 100 * abs(dmp - dmn) / (dmp + dmn) if dmp + dmn != 0 else 0.0
+            if count == 2 * w - 1: adx = (sum(self.dx_warmup) + dx) / w
+            elif count > 2 * w - 1: adx = (self.adx * (w - 1) + dx) / w
+            if commit:
+                if count < 2 * w - 1: self.dx_warmup.append(dx)
+                else: self.adx, self.dx_warmup = adx, []
+
+        if commit:
+            self.prev, self.count = (high, low, close), count + 1
+            self.trs, self.dip, self.din = trs, dip, din
+        return adx, dmp, dmn
+
+INDICATOR_COLUMNS = ('rsi', 'macd', 'macd_signal', 'bb_h', 'bb_l', 'stoch_k', 'stoch_d', 'adx', 'dmp', 'dmn')
+
+class IndicatorEngine:
+    """حالة المؤشرات لزوج واحد: كل الشموع المكتملة تدخل الحالة، والشمعة الأخيرة تحسب مؤقتاً."""
+
+    def __init__(self, params: dict):
+        self.params = dict(params)
+        self.rsi = StreamingRSI(params.get('rsi_period', 14))
+        self.macd = StreamingMACD(params.get('macd_fast', 12), params.get('macd_slow', 26), params.get('macd_signal', 9))
+        self.bollinger = StreamingBollinger(params.get('bollinger_period', 20))
+        self.stoch = StreamingStochastic(params.get('stochastic_period', 14))
+        self.adx = StreamingADX(params.get('adx_period', 14))
+        self.last_timestamp = None
+        # آخر صفين مكتملين (بلا قيم NaN) من الشموع المثبتة، مثل نتيجة dropna في الطريقة الكاملة.
+        self.complete_rows = deque(maxlen=2)
+
+    def _update(self, o: float, h: float, l: float, c: float, commit: bool) -> dict:
+        macd, macd_signal = self.macd.update(c, commit)
+        bb_h, bb_l = self.bollinger.update(c, commit)
+        stoch_k, stoch_d = self.stoch.update(h, l, c, commit)
+        adx, dmp, dmn = self.adx.update(h, l, c, commit)
+        row = {'Open': o, 'High': h, 'Low': l, 'Close': c, 'rsi': self.rsi.update(c, commit),
+               'macd': macd, 'macd_signal': macd_signal, 'bb_h': bb_h, 'bb_l': bb_l,
+               'stoch_k': stoch_k, 'stoch_d': stoch_d, 'adx': adx, 'dmp': dmp, 'dmn': dmn}
+        if commit and all(row[col] == row[col] for col in INDICATOR_COLUMNS):
+            self.complete_rows.append(row)
+        return row
+
+    def process(self, df: pd.DataFrame) -> (dict, dict):
+        """يغذي المحرك بالشموع الجديدة فقط ويعيد (الصف الأخير، الصف السابق) أو (None, None)."""
+        index = df.index
+        if self.last_timestamp is not None and index[-1] == self.last_timestamp:
+            # آخر شمعة في الإطار مثبتة أصلاً في الحالة: لا جديد، فنعيد آخر صفين مكتملين دون إعادة البناء.
+            rows = list(self.complete_rows)
+            if not rows: return None, None
+            return rows[-1], rows[-2] if len(rows) > 1 else rows[-1]
+        if self.last_timestamp is not None and self.last_timestamp in index and index[-1] > self.last_timestamp:
+            start = index.get_loc(self.last_timestamp) + 1
+        else:
+            # لا يوجد اتصال بين التاريخ المخزن والبيانات الجديدة (فجوة أو بيانات أقدم): نعيد البناء من الصفر.
+            self.__init__(self.params)
+            start = 0
+
+        opens, highs = df['Open'].to_numpy(), df['High'].to_numpy()
+        lows, closes = df['Low'].to_numpy(), df['Close'].to_numpy()
+        for i in range(start, len(df) - 1):
+            self._update(opens[i], highs[i], lows[i], closes[i], commit=True)
+        if len(df) > 1: self.last_timestamp = index[-2]
+        current = self._update(opens[-1], highs[-1], lows[-1], closes[-1], commit=False)
+
+        rows = list(self.complete_rows)
+        if all(current[col] == current[col] for col in INDICATOR_COLUMNS): rows.append(current)
+        if not rows: return None, None
+        return rows[-1], rows[-2] if len(rows) > 1 else rows[-1]
+
+indicator_engines = {}
+# التحليل يعمل في خيوط مرحلة الحساب، وقد يصل تحليل وتأكيد للزوج نفسه معاً فيتشاركان محركه.
+engine_locks = {}
+
+def engine_key(pair: str, params: dict) -> tuple:
+    return pair, json.dumps(params, sort_keys=True)
+
+def get_indicator_engine(pair: str, params: dict) -> IndicatorEngine:
+    # محرك لكل زوج ومجموعة فترات: المشتركون بإعدادات مختلفة على الزوج نفسه لا يعيدون بناء محركات بعضهم.
+    # المحركات التي لم يعد يستخدمها مشترك عامل تُحذف في prune_analysis_due؛ التأكيد المعلق بعدها يبني محركاً بارداً.
+    key = engine_key(pair, params)
+    engine = indicator_engines.get(key)
+    if engine is None:
+        engine = indicator_engines[key] = IndicatorEngine(dict(params))
+    return engine
+
+def compute_indicator_rows(df: pd.DataFrame, params: dict) -> (pd.Series, pd.Series):
+    """الحساب الكامل بمكتبة ta على كامل الإطار (يستخدم عندما لا يوجد زوج تحفظ حالته)."""
     df['rsi'] = ta.momentum.RSIIndicator(df['Close'], window=params.get('rsi_period', 14)).rsi()
     macd = ta.trend.MACD(df['Close'], window_fast=params.get('macd_fast', 12), window_slow=params.get('macd_slow', 26), window_sign=params.get('macd_signal', 9))
     df['macd'], df['macd_signal'] = macd.macd(), macd.macd_signal()
@@ -209,178 +1572,1090 @@ def analyze_signal_strength(df: pd.DataFrame, trend_m15: str, trend_h1: str) ->
     df['adx'], df['dmp'], df['dmn'] = adx.adx(), adx.adx_pos(), adx.adx_neg()
 
     df.dropna(inplace=True)
-    if df.empty: return 0, 0
-    last, prev = df.iloc[-1], df.iloc[-2] if len(df) > 1 else df.iloc[-1]
+    if df.empty: return None, None
+    return df.iloc[-1], df.iloc[-2] if len(df) > 1 else df.iloc[-1]
 
-    if last['rsi'] < 30: buy += 1
-    if last['rsi'] > 70: sell += 1
-    
-    macd_strategy = bot_state.get('macd_strategy', 'dynamic')
+def indicator_votes(last, prev, macd_strategy: str) -> dict:
+    """صوت كل مؤشر على الشمعة الأخيرة: {الاسم: (شراء، بيع)}."""
+    macd_up = last['macd'] > last['macd_signal'] and prev['macd'] <= prev['macd_signal']
+    macd_down = last['macd'] < last['macd_signal'] and prev['macd'] >= prev['macd_signal']
     if macd_strategy == 'dynamic':
-        if last['macd'] > last['macd_signal'] and prev['macd'] <= prev['macd_signal'] and last['macd'] < 0: buy += 1
-        if last['macd'] < last['macd_signal'] and prev['macd'] >= prev['macd_signal'] and last['macd'] > 0: sell += 1
-    else:
-        if last['macd'] > last['macd_signal'] and prev['macd'] <= prev['macd_signal']: buy += 1
-        if last['macd'] < last['macd_signal'] and prev['macd'] >= prev['macd_signal']: sell += 1
-
-    if last['Close'] < last['bb_l']: buy += 1
-    if last['Close'] > last['bb_h']: sell += 1
-    if last['stoch_k'] > last['stoch_d'] and last['stoch_k'] < 30: buy += 1
-    if last['stoch_k'] < last['stoch_d'] and last['stoch_k'] > 70: sell += 1
-    if last['adx'] > 25 and last['dmp'] > last['dmn']: buy += 1
-    if last['adx'] > 25 and last['dmn'] > last['dmp']: sell += 1
+        macd_up, macd_down = macd_up and last['macd'] < 0, macd_down and last['macd'] > 0
+    return {
+        'rsi': (last['rsi'] < 30, last['rsi'] > 70),
+        'macd': (macd_up, macd_down),
+        'bollinger': (last['Close'] < last['bb_l'], last['Close'] > last['bb_h']),
+        'stochastic': (last['stoch_k'] > last['stoch_d'] and last['stoch_k'] < 30, last['stoch_k'] < last['stoch_d'] and last['stoch_k'] > 70),
+        'adx': (last['adx'] > 25 and last['dmp'] > last['dmn'], last['adx'] > 25 and last['dmn'] > last['dmp']),
+    }
+
+def signal_details(last, votes: dict, candle_buy: int, candle_sell: int) -> dict:
+    """لقطة المؤشرات والأصوات التي تُسجل مع الإشارة في سجل الإشارات."""
+    voted = [f"{name}:BUY" for name, (buy, _) in votes.items() if buy] + [f"{name}:SELL" for name, (_, sell) in votes.items() if sell]
+    if candle_buy: voted.append("patterns:BUY")
+    if candle_sell: voted.append("patterns:SELL")
+    indicators = {col: round(float(last[col]), 6) for col in ('Close',) + INDICATOR_COLUMNS}
+    indicators.update({'patterns_buy': int(candle_buy), 'patterns_sell': int(candle_sell)})
+    return {'indicators': indicators, 'votes': ",".join(sorted(voted))}
+
+@observe_duration(analysis_seconds, 'single')
+def analyze_signal_strength(df: pd.DataFrame, trend_m15: str, trend_h1: str, pair: str = None, details: dict = None,
+                            settings: dict = None) -> (int, int):
+    buy, sell = 0, 0
+    settings = settings if settings is not None else bot_state
+    params = settings.get('indicator_params', {})
+    trend_mode = settings.get('trend_filter_mode', 'M15')
+    
+    if trend_mode == 'M15' and trend_m15 == 'DOWN': buy = -99
+    if trend_mode == 'M15' and trend_m15 == 'UP': sell = -99
+    if trend_mode == 'H1' and trend_h1 == 'DOWN': buy = -99
+    if trend_mode == 'H1' and trend_h1 == 'UP': sell = -99
+    if trend_mode == 'M15_H1' and (trend_m15 == 'DOWN' or trend_h1 == 'DOWN'): buy = -99
+    if trend_mode == 'M15_H1' and (trend_m15 == 'UP' or trend_h1 == 'UP'): sell = -99
 
-    candle_buy, candle_sell = analyze_candlestick_patterns(df)
+    required_len = max(v for k, v in params.items() if 'period' in k)
+    if df is None or df.empty or len(df) < required_len: return 0, 0
+    
+    with TraceSpan('compute/indicators'):
+        if pair is None:
+            last, prev = compute_indicator_rows(df, params)
+        else:
+            with engine_locks.setdefault(pair, Lock()):
+                last, prev = get_indicator_engine(pair, params).process(df)
+    if last is None: return 0, 0
+
+    votes = indicator_votes(last, prev, settings.get('macd_strategy', 'dynamic'))
+    buy += sum(bool(vote_buy) for vote_buy, _ in votes.values())
+    sell += sum(bool(vote_sell) for _, vote_sell in votes.values())
+
+    with TraceSpan('compute/patterns'):
+        candle_buy, candle_sell = analyze_candlestick_patterns(df.iloc[-PATTERN_LOOKBACK_BARS:])
     buy += candle_buy; sell += candle_sell
+    if details is not None: details.update(signal_details(last, votes, candle_buy, candle_sell))
 
     return max(0, buy), max(0, sell)
 
+# --- التقييم المتجه لعدة أزواج (Panel Scoring) ---
+# نفس قواعد analyze_signal_strength لكن على مصفوفة (أزواج × شموع) دفعة واحدة.
+# الصفوف مستقلة: العمليات الزمنية تنفذ كأعمدة في pandas (ewm/rolling مكتوبة بـ C) لكل الأزواج معاً.
+# هذا هو مسار الإشارات الأولية في كل أوضاع البيانات. تأكيد المشترك يمر بـ IndicatorEngine الذي يحمل تاريخاً أطول
+# من نافذة ANALYSIS_BARS، فتختلف المؤشرات المتوسطة الأسية (RSI و ADX) بأثر التهيئة فقط: أقل من 0.01 نقطة بعد 200 شمعة
+# (tests/test_scoring_parity.py)، وهو أصغر بكثير من المسافة التي تغير صوتاً إلا عند ملامسة الحد تماماً.
+
+def build_price_panel(frames: dict, bars: int) -> (list, dict):
+    """يرصّ آخر `bars` شمعة من كل زوج في مصفوفات (أزواج × شموع) لكل عمود سعر."""
+    pairs = list(frames)
+    panel = {col: np.stack([frames[p][col].to_numpy(dtype=float)[-bars:] for p in pairs])
+             for col in ('Open', 'High', 'Low', 'Close')}
+    return pairs, panel
+
+def _wilder_from_sum(values: pd.DataFrame, window: int, first: int) -> pd.DataFrame:
+    """تنعيم Wilder مبدوء بمجموع أول نافذة، كما في ADXIndicator (بصيغة ewm)."""
+    seeded = values * window
+    seeded.iloc[:first] = np.nan
+    seeded.iloc[first] = values.iloc[first - window + 1:first + 1].sum()
+    return seeded.ewm(alpha=1 / window, adjust=False).mean()
+
+def _panel_rsi(close: pd.DataFrame, high: pd.DataFrame, low: pd.DataFrame, rsi_w: int) -> dict:
+    diff = close.diff().fillna(0.0)
+    up = diff.clip(lower=0).ewm(alpha=1 / rsi_w, min_periods=rsi_w, adjust=False).mean()
+    down = (-diff).clip(lower=0).ewm(alpha=1 / rsi_w, min_periods=rsi_w, adjust=False).mean()
+    return {'rsi': pd.DataFrame(np.where(down == 0, 100.0, 100.0 - 100.0 / (1.0 + up / down)))}
+
+def _panel_macd(close: pd.DataFrame, high: pd.DataFrame, low: pd.DataFrame, fast: int, slow: int, sign: int) -> dict:
+    macd = (close.ewm(span=fast, min_periods=fast, adjust=False).mean()
+            - close.ewm(span=slow, min_periods=slow, adjust=False).mean())
+    return {'macd': macd, 'macd_signal': macd.ewm(span=sign, min_periods=sign, adjust=False).mean()}
+
+def _panel_bollinger(close: pd.DataFrame, high: pd.DataFrame, low: pd.DataFrame, bb_w: int) -> dict:
+    mavg = close.rolling(bb_w, min_periods=bb_w).mean()
+    mstd = close.rolling(bb_w, min_periods=bb_w).std(ddof=0)
+    return {'bb_h': mavg + 2 * mstd, 'bb_l': mavg - 2 * mstd}
+
+def _panel_stochastic(close: pd.DataFrame, high: pd.DataFrame, low: pd.DataFrame, st_w: int) -> dict:
+    lowest = low.rolling(st_w, min_periods=st_w).min()
+    highest = high.rolling(st_w, min_periods=st_w).max()
+    stoch_k = 100 * (close - lowest) / (highest - lowest).replace(0.0, np.nan)
+    return {'stoch_k': stoch_k, 'stoch_d': stoch_k.rolling(3, min_periods=3).mean()}
+
+def _panel_adx(close: pd.DataFrame, high: pd.DataFrame, low: pd.DataFrame, adx_w: int) -> dict:
+    prev_close, prev_high, prev_low = close.shift(1), high.shift(1), low.shift(1)
+    tr = np.maximum(high, prev_close) - np.minimum(low, prev_close)
+    move_up, move_down = high - prev_high, prev_low - low
+    pos = move_up.where((move_up > move_down) & (move_up > 0), 0.0)
+    neg = move_down.where((move_down > move_up) & (move_down > 0), 0.0)
+    trs = _wilder_from_sum(tr, adx_w, adx_w)
+    nonzero = trs.replace(0.0, np.nan)
+    dmp = (100 * _wilder_from_sum(pos, adx_w, adx_w) / nonzero).where(trs != 0, 0.0).where(trs.notna())
+    dmn = (100 * _wilder_from_sum(neg, adx_w, adx_w) / nonzero).where(trs != 0, 0.0).where(trs.notna())
+    dx = (100 * (dmp - dmn).abs() / (dmp + dmn).replace(0.0, np.nan)).where(dmp + dmn != 0, 0.0).where(dmp.notna())
+    adx = dx.copy()
+    adx.iloc[:2 * adx_w - 1] = np.nan
+    adx.iloc[2 * adx_w - 1] = dx.iloc[adx_w:2 * adx_w].mean()
+    return {'adx': adx.ewm(alpha=1 / adx_w, adjust=False).mean(), 'dmp': dmp, 'dmn': dmn}
+
+# كل مجموعة تعتمد فقط على فتراتها: (المفاتيح، القيم الافتراضية، دالة الحساب).
+PANEL_INDICATOR_GROUPS = {
+    'rsi': (('rsi_period',), (14,), _panel_rsi),
+    'macd': (('macd_fast', 'macd_slow', 'macd_signal'), (12, 26, 9), _panel_macd),
+    'bollinger': (('bollinger_period',), (20,), _panel_bollinger),
+    'stochastic': (('stochastic_period',), (14,), _panel_stochastic),
+    'adx': (('adx_period',), (14,), _panel_adx),
+}
+
+def compute_panel_indicators(panel: dict, params: dict, computed: dict = None) -> dict:
+    """يحسب كل المؤشرات لكل الأزواج؛ كل نتيجة مصفوفة (أزواج × شموع).
+
+    computed ذاكرة {(المجموعة، الفترات): النتائج} لنفس المصفوفة: ملفات الاستراتيجية التي تتشارك فترة مؤشر تحسبه مرة واحدة.
+    """
+    computed = {} if computed is None else computed
+    if 'frames' not in computed:
+        computed['frames'] = tuple(pd.DataFrame(panel[col].T) for col in ('Close', 'High', 'Low'))
+    result = {}
+    for group, (keys, defaults, func) in PANEL_INDICATOR_GROUPS.items():
+        periods = tuple(params.get(key, default) for key, default in zip(keys, defaults))
+        if (group, periods) not in computed:
+            computed[(group, periods)] = {name: frame.to_numpy().T for name, frame in func(*computed['frames'], *periods).items()}
+        result.update(computed[(group, periods)])
+    return result
+
+def compute_panel_votes(panel: dict, ind: dict, macd_strategy: str) -> (np.ndarray, np.ndarray):
+    """أصوات الشراء والبيع من المؤشرات لكل زوج ولكل شمعة (الشمعة السابقة هي العمود السابق)."""
+    close = panel['Close']
+    macd, signal = ind['macd'], ind['macd_signal']
+    prev_macd = np.concatenate([macd[:, :1], macd[:, :-1]], axis=1)
+    prev_signal = np.concatenate([signal[:, :1], signal[:, :-1]], axis=1)
+    cross_up = (macd > signal) & (prev_macd <= prev_signal)
+    cross_down = (macd < signal) & (prev_macd >= prev_signal)
+    if macd_strategy == 'dynamic':
+        cross_up, cross_down = cross_up & (macd < 0), cross_down & (macd > 0)
+
+    strong = ind['adx'] > 25
+    buy = ((ind['rsi'] < 30).astype(int) + cross_up + (close < ind['bb_l'])
+           + ((ind['stoch_k'] > ind['stoch_d']) & (ind['stoch_k'] < 30)) + (strong & (ind['dmp'] > ind['dmn'])))
+    sell = ((ind['rsi'] > 70).astype(int) + cross_down + (close > ind['bb_h'])
+            + ((ind['stoch_k'] < ind['stoch_d']) & (ind['stoch_k'] > 70)) + (strong & (ind['dmn'] > ind['dmp'])))
+    valid = np.logical_and.reduce([~np.isnan(ind[name]) for name in INDICATOR_COLUMNS])
+    return np.where(valid, buy, 0), np.where(valid, sell, 0)
+
+def compute_panel_pattern_votes(panel: dict) -> (np.ndarray, np.ndarray):
+    """أنماط الشموع: TA-Lib يعمل على سلسلة واحدة، لذا ندور على الأزواج فقط (كل نداء مكتوب بـ C)."""
+    buy, sell = np.zeros(panel['Close'].shape, dtype=int), np.zeros(panel['Close'].shape, dtype=int)
+    for row in range(panel['Close'].shape[0]):
+        ohlc = [panel[col][row] for col in ('Open', 'High', 'Low', 'Close')]
+        for pattern in BULLISH_PATTERNS: buy[row] += getattr(talib, pattern)(*ohlc) > 0
+        for pattern in BEARISH_PATTERNS: sell[row] += getattr(talib, pattern)(*ohlc) < 0
+    return buy, sell
+
+def trend_filter_masks(trend_mode: str, trend_m15, trend_h1) -> (np.ndarray, np.ndarray):
+    """يعيد أقنعة حجب الشراء والبيع حسب وضع فلتر الاتجاه (المدخلات مصفوفات من 'UP'/'DOWN'/'NEUTRAL')."""
+    trend_m15, trend_h1 = np.asarray(trend_m15), np.asarray(trend_h1)
+    no_block = np.zeros(np.broadcast(trend_m15, trend_h1).shape, dtype=bool)
+    if trend_mode == 'M15': return no_block | (trend_m15 == 'DOWN'), no_block | (trend_m15 == 'UP')
+    if trend_mode == 'H1': return no_block | (trend_h1 == 'DOWN'), no_block | (trend_h1 == 'UP')
+    if trend_mode == 'M15_H1':
+        return (trend_m15 == 'DOWN') | (trend_h1 == 'DOWN'), (trend_m15 == 'UP') | (trend_h1 == 'UP')
+    return no_block, no_block
+
+@observe_duration(analysis_seconds, 'batch')
+def score_pairs_batch(frames: dict, trends: dict = None, settings: dict = None, details: dict = None, shared: dict = None) -> dict:
+    """يقيّم كل الأزواج في تمريرة واحدة ويعيد {الزوج: (قوة الشراء، قوة البيع)} مثل analyze_signal_strength.
+
+    إذا مُرر details يُملأ بلقطة المؤشرات والأصوات لكل زوج كما في analyze_signal_strength.
+    shared ذاكرة تمريرة واحدة بين عدة إعدادات على نفس الشموع: المصفوفة والأنماط والمؤشرات تُحسب مرة واحدة.
+    """
+    settings = settings if settings is not None else bot_state
+    params = settings.get('indicator_params', {})
+    required_len = max(v for k, v in params.items() if 'period' in k)
+    scores = {pair: (0, 0) for pair in frames}
+    # كل زوج يُقيّم على آخر ANALYSIS_BARS شمعة (أو كل تاريخه إن كان أقصر) أياً كانت الأزواج التي تُقيّم معه،
+    # فالأزواج ذات الأطوال المختلفة تذهب إلى مصفوفات منفصلة بدل قصّ الجميع إلى أقصر تاريخ.
+    by_length = {}
+    for pair, df in frames.items():
+        if df is not None and len(df) >= required_len: by_length.setdefault(min(ANALYSIS_BARS, len(df)), {})[pair] = df
+    for bars, eligible in by_length.items():
+        scores.update(_score_panel(eligible, bars, trends or {}, settings, details, shared))
+    return scores
+
+def _score_panel(eligible: dict, bars: int, trends: dict, settings: dict, details: dict, shared: dict) -> dict:
+    params = settings.get('indicator_params', {})
+    panel_key = (tuple(eligible), bars)
+    if shared is not None and panel_key in shared:
+        pairs, panel, computed, (pattern_buy, pattern_sell) = shared[panel_key]
+    else:
+        pairs, panel = build_price_panel(eligible, bars)
+        computed, (pattern_buy, pattern_sell) = {}, compute_panel_pattern_votes(panel)
+        if shared is not None: shared[panel_key] = (pairs, panel, computed, (pattern_buy, pattern_sell))
+    ind = compute_panel_indicators(panel, params, computed)
+    macd_strategy = settings.get('macd_strategy', 'dynamic')
+    buy, sell = compute_panel_votes(panel, ind, macd_strategy)
+    if details is not None:
+        for row, pair in enumerate(pairs):
+            last = {col: ind[col][row, -1] for col in INDICATOR_COLUMNS}
+            prev = {col: ind[col][row, -2] if bars > 1 else ind[col][row, -1] for col in INDICATOR_COLUMNS}
+            last['Close'] = panel['Close'][row, -1]
+            votes = indicator_votes(last, prev, macd_strategy) if all(v == v for v in last.values()) else {}
+            details[pair] = signal_details(last, votes, pattern_buy[row, -1], pattern_sell[row, -1])
+    buy, sell = buy[:, -1] + pattern_buy[:, -1], sell[:, -1] + pattern_sell[:, -1]
+
+    trend_m15 = [trends.get(p, ('NEUTRAL', 'NEUTRAL'))[0] for p in pairs]
+    trend_h1 = [trends.get(p, ('NEUTRAL', 'NEUTRAL'))[1] for p in pairs]
+    block_buy, block_sell = trend_filter_masks(settings.get('trend_filter_mode', 'M15'), trend_m15, trend_h1)
+    buy, sell = np.where(block_buy, 0, buy), np.where(block_sell, 0, sell)
+    return {pair: (int(b), int(s)) for pair, b, s in zip(pairs, buy, sell)}
+
+# --- مرحلة الحساب خارج حلقة الأحداث (Compute Stage) ---
+# pandas و ta و TA-Lib تعمل في مجمع خيوط محدود حتى لا تحجب حلقة الأحداث التي تخدم تليجرام والحاكم.
+# خيوط وليست عمليات: حالة المحركات التزايدية لكل زوج تبقى في الذاكرة نفسها، والمكتبات الرقمية تحرر GIL أثناء الحساب.
+COMPUTE_WORKERS = int(os.environ.get('COMPUTE_WORKERS', 0)) or min(4, os.cpu_count() or 1)
+COMPUTE_SLOW_SECONDS = 1.0
+
+def _timed_call(func, args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - started
+
+class ComputeStage:
+    """مجمع خيوط محدود بضغط عكسي: عند امتلائه ينتظر المستدعون ويتوقف الحاكم عن جلب بيانات جديدة."""
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.max_in_flight = workers * 2
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='compute')
+        self._slots = asyncio.Semaphore(self.max_in_flight)
+        self.in_flight = 0
+        self.saturated = 0
+        self.stats = {}
+
+    async def wait_for_capacity(self):
+        if self._slots.locked(): self.saturated += 1
+        async with self._slots: pass
+
+    async def run(self, label: str, func, *args):
+        loop = asyncio.get_running_loop()
+        queued_at = loop.time()
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                # نسخة من السياق حتى تصل مقاطع التتبع داخل العامل إلى أثر المهمة.
+                result, run_seconds = await loop.run_in_executor(self._executor, contextvars.copy_context().run, _timed_call, func, args)
+            finally:
+                self.in_flight -= 1
+        wait_seconds = loop.time() - queued_at - run_seconds
+        finished = time.perf_counter()
+        record_span('compute_wait', finished - run_seconds - wait_seconds, wait_seconds)
+        record_span('compute', finished - run_seconds, run_seconds)
+
+        stats = self.stats.setdefault(label, {'jobs': 0, 'total_run': 0.0, 'max_run': 0.0, 'total_wait': 0.0, 'max_wait': 0.0})
+        stats['jobs'] += 1
+        stats['total_run'] += run_seconds; stats['max_run'] = max(stats['max_run'], run_seconds)
+        stats['total_wait'] += wait_seconds; stats['max_wait'] = max(stats['max_wait'], wait_seconds)
+        log = logger.warning if run_seconds > COMPUTE_SLOW_SECONDS else logger.info
+        log(f"الحساب: {label} استغرق {run_seconds:.3f} ث (انتظار {wait_seconds:.3f} ث، قيد التنفيذ {self.in_flight}/{self.max_in_flight}).")
+        return result
+
+    def report(self) -> str:
+        lines = [f"   - العمال: {self.workers}، قيد التنفيذ: {self.in_flight}/{self.max_in_flight}، مرات الامتلاء: {self.saturated}"]
+        for label, stats in self.stats.items():
+            jobs = stats['jobs']
+            lines.append(f"   - {label}: {jobs} مهمة، متوسط الحساب {stats['total_run'] / jobs:.3f} ث، أقصى {stats['max_run']:.3f} ث، "
+                         f"متوسط الانتظار {stats['total_wait'] / jobs:.3f} ث")
+        return "\n".join(lines)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+compute_stage = ComputeStage(COMPUTE_WORKERS)
+metrics.register(Gauge('compute_in_flight', "مهام التحليل قيد التنفيذ في مجمع الحساب", lambda: compute_stage.in_flight))
+
 # --- محرك الحاكم والمنطق (Governor and Logic Engine) ---
 
+# بعد هذه المهل يصبح الطلب متأخراً: طلب التحليل يحذف (الدورة القادمة ستعيد طلبه ببيانات أحدث)،
+# وطلب التأكيد تخفض أولويته حتى لا تضيع الإشارة.
+ANALYSIS_STALE_SECONDS = 300
+CONFIRMATION_STALE_SECONDS = 120
+
 async def governor_loop(context: ContextTypes.DEFAULT_TYPE):
     logger.info("محرك الحاكم (Governor) بدأ بالعمل...")
     while True:
-        await asyncio.sleep(1)
+        await api_request_queue.wait_for_request()
+        # ضغط عكسي: لا فائدة من جلب بيانات جديدة بينما مرحلة الحساب ممتلئة.
+        await compute_stage.wait_for_capacity()
         
         now = datetime.now(timezone.utc)
-        
-        while api_call_timestamps and (now - api_call_timestamps[0]).total_seconds() > 60:
-            api_call_timestamps.popleft()
-
-        if len(api_call_timestamps) < 4 and not api_request_queue.empty():
-            request = await api_request_queue.get()
+        delay = rate_controller.seconds_until_slot(now)
+        if delay > 0:
+            # ننام حتى يتحرر أقدم مقعد في نافذة الدقيقة بالضبط، ثم نعيد اختيار أعلى طلب أولوية.
+            await asyncio.sleep(delay + 0.01)
+            continue
+
+        request = api_request_queue.pop_next(now)
+        if request is None: continue
             
-            api_call_timestamps.append(now)
-            logger.info(f"الحاكم: السماح بطلب API. الطلبات في آخر دقيقة: {len(api_call_timestamps)}/4")
-
-            pair, timeframe, limit, callback = request['pair'], request['timeframe'], request['limit'], request['callback']
-            df = await execute_get_forex_data(pair, timeframe, limit, context)
-            
-            if callback:
-                asyncio.create_task(callback(df, pair, context))
-            
-            api_request_queue.task_done()
-
-async def logic_loop(context: ContextTypes.DEFAULT_TYPE):
-    if not bot_state.get('is_running', False): return
+        rate_controller.record_call(now)
+        logger.info(f"الحاكم: السماح بطلب API ({PRIORITY_NAMES[request['priority']]} {request['pair']}). "
+                    f"الطلبات في آخر دقيقة: {rate_controller.usage(now)}/{int(rate_controller.limit)}، "
+                    f"الانتظار: {request['wait_seconds']:.0f} ث، المتبقي في الطابور: {api_request_queue.qsize()}")
+
+        pair, timeframe, limit = request['pair'], request['timeframe'], request['limit']
+        traces = tuple(trace for _, _, trace in request['callbacks'])
+        popped = time.perf_counter()
+        for trace in traces: trace.add_span('queue', trace.queued, popped - trace.queued)
+        throttled = None
+        traces_token = active_traces.set(traces)
+        try:
+            if 'fetch' in request:
+                df = await request['fetch'](context)
+            else:
+                df = await execute_get_forex_data(pair, timeframe, limit, context)
+        except PolygonRateLimited as e:
+            throttled = e
+        finally:
+            active_traces.reset(traces_token)
+            api_request_queue.finish(request)
+
+        if throttled is not None:
+            rate_controller.on_throttled(throttled.retry_after)
+            await api_request_queue.put(request)
+            continue
+        
+        # كل كول باك يستلم عرضاً بالنافذة التي طلبها (النسخ عند الكتابة يعزل تعديلاته)، ويعمل في سياق أثره.
+        for callback, callback_limit, trace in request['callbacks']:
+            if not callback:
+                trace.finish()
+                continue
+            result = df.iloc[-callback_limit:] if isinstance(df, pd.DataFrame) else df
+            traces_token = active_traces.set((trace,))
+            trace.hold()
+            asyncio.create_task(callback(result, pair, context)).add_done_callback(lambda _, trace=trace: trace.release())
+            active_traces.reset(traces_token)
+
+# --- جدولة التأكيدات (Confirmation Scheduler) ---
+# الإشارات الأولية في كومة مرتبة بموعد تأكيدها؛ مهمة مستقلة تنام حتى أقرب موعد وتطلق كل التأكيدات المستحقة معاً،
+# فلا تمسح دورة المنطق القائمة في كل نبضة ولا تتوقف التحليلات بسبب التأكيدات.
+CONFIRMATION_EXPIRY_SECONDS = 300  # بعدها تصبح بيانات التأكيد بعيدة عن موعده ولا معنى لتقييمه
+confirmation_sequence = itertools.count()
+confirmation_wakeup = asyncio.Event()
+
+def schedule_confirmation(signal: dict):
+    state = subscribers.get(signal['chat_id'], bot_state)
+    due_at = signal['timestamp'] + timedelta(minutes=state.get('confirmation_minutes', 5))
+    heapq.heappush(pending_signals, (due_at, next(confirmation_sequence), signal))
+    confirmation_wakeup.set()
+
+def expire_confirmation(signal: dict, reason: str):
+    pair = signal['pair']
+    logger.info(f"التأكيد: انتهت صلاحية تأكيد {pair} ({reason}).")
+    signal_store.record('confirmation', pair, signal['type'], datetime.now(timezone.utc), outcome='expired', initial_id=signal.get('id'),
+                        profile=signal.get('profile'), subscriber=signal['chat_id'])
+    signal_store.resolve(signal.get('id'), 'expired')
+
+def is_confirmation_expired(due_at: datetime, now: datetime) -> bool:
+    return (now - due_at).total_seconds() > CONFIRMATION_EXPIRY_SECONDS
+
+async def send_signal_message(context: ContextTypes.DEFAULT_TYPE, chat_id: str, text: str, kind: str):
+    try:
+        with TraceSpan('telegram'):
+            await context.bot.send_message(chat_id=chat_id, text=text)
+    except Exception:
+        telegram_messages.inc(kind, 'failed')
+        raise
+    telegram_messages.inc(kind, 'sent')
+
+def make_confirmation_callback(signal: dict, due_at: datetime):
+    async def confirmation_callback(df, pair, context):
+        logger.info(f"الكول باك: تم استلام بيانات التأكيد للزوج {pair}.")
+        if is_confirmation_expired(due_at, datetime.now(timezone.utc)):
+            expire_confirmation(signal, "تأخر جلب البيانات")
+            return
+        initial_type, chat_id = signal['type'], signal['chat_id']
+        state = subscribers.get(chat_id, bot_state)
+        if df is not None and not df.empty:
+            details = {}
+            buy_strength, sell_strength = await compute_stage.run('تأكيد', analyze_signal_strength, df, 'NEUTRAL', 'NEUTRAL', pair, details,
+                                                                  evaluation_settings(state))
+
+            confirmed = False
+            if initial_type == 'BUY' and buy_strength > sell_strength and buy_strength >= state.get('confirmation_confidence', 4): confirmed = True
+            elif initial_type == 'SELL' and sell_strength > buy_strength and sell_strength >= state.get('confirmation_confidence', 4): confirmed = True
+
+            if confirmed:
+                strength_meter = '⬆️' * buy_strength if initial_type == 'BUY' else '⬇️' * sell_strength
+                message = (f"✅ إشارة مؤكدة ✅\n\nالزوج: {pair}\nالنوع: {initial_type}\nقوة التأكيد: {strength_meter}")
+                try:
+                    await send_signal_message(context, chat_id, message, 'confirmation')
+                except Exception as e:
+                    await send_error_to_telegram(context, f"فشل إرسال رسالة التأكيد للزوج {pair}: {e}")
+            outcome = 'confirmed' if confirmed else 'failed'
+            signal_store.record('confirmation', pair, initial_type, datetime.now(timezone.utc), buy_strength, sell_strength,
+                                details=details, outcome=outcome, initial_id=signal.get('id'), profile=signal.get('profile'), subscriber=chat_id)
+            signal_store.resolve(signal.get('id'), outcome)
+        else:
+            signal_store.record('confirmation', pair, initial_type, datetime.now(timezone.utc), outcome='failed', initial_id=signal.get('id'),
+                                profile=signal.get('profile'), subscriber=chat_id)
+            signal_store.resolve(signal.get('id'), 'failed')
+    return confirmation_callback
+
+async def wait_for_confirmation_wakeup(timeout: float):
+    try:
+        await asyncio.wait_for(confirmation_wakeup.wait(), timeout=max(timeout, 0))
+    except asyncio.TimeoutError:
+        pass
 
-    current_time = datetime.now(timezone.utc)
-    confirmation_minutes = bot_state.get('confirmation_minutes', 5)
-    
-    signal_to_confirm = next((s for s in pending_signals if (current_time - s['timestamp']).total_seconds() / 60 >= confirmation_minutes), None)
+async def confirmation_loop(context: ContextTypes.DEFAULT_TYPE):
+    logger.info("التأكيد: بدء مجدول التأكيدات.")
+    while True:
+        try:
+            confirmation_wakeup.clear()
+            if not pending_signals:
+                await confirmation_wakeup.wait()
+                continue
+
+            now = datetime.now(timezone.utc)
+            due_at = pending_signals[0][0]
+            if due_at > now:
+                await wait_for_confirmation_wakeup((due_at - now).total_seconds())
+                continue
+
+            if not running_subscribers():
+                # البوت متوقف: نحتفظ بالتأكيدات حتى يعود ما لم تنتهِ صلاحيتها.
+                while pending_signals and is_confirmation_expired(pending_signals[0][0], now):
+                    expire_confirmation(heapq.heappop(pending_signals)[2], "البوت متوقف")
+                if pending_signals:
+                    expires_in = CONFIRMATION_EXPIRY_SECONDS - (now - pending_signals[0][0]).total_seconds()
+                    await wait_for_confirmation_wakeup(expires_in)
+                continue
+
+            # كل التأكيدات المستحقة تدخل طابور الحاكم معاً؛ تأكيدات الزوج نفسه تندمج في جلب واحد.
+            begin_scan('C')
+            while pending_signals and pending_signals[0][0] <= now:
+                due_at, _, signal = heapq.heappop(pending_signals)
+                if is_confirmation_expired(due_at, now):
+                    expire_confirmation(signal, "فات موعدها")
+                    continue
+                if signal['chat_id'] not in running_subscribers():
+                    expire_confirmation(signal, "المشترك أوقف البوت أو أُلغيت صلاحيته")
+                    continue
+                logger.info(f"التأكيد: إضافة طلب تأكيد للزوج {signal['pair']} إلى الطابور.")
+                await api_request_queue.put({
+                    'pair': signal['pair'], 'timeframe': 'M5', 'limit': ANALYSIS_BARS,
+                    'callback': make_confirmation_callback(signal, due_at),
+                    'priority': PRIORITY_CONFIRMATION, 'on_stale': 'downgrade',
+                    'deadline': now + timedelta(seconds=CONFIRMATION_STALE_SECONDS)
+                })
+        except asyncio.CancelledError:
+            logger.info("التأكيد: تم إيقاف مجدول التأكيدات.")
+            break
+        except Exception as e:
+            logger.error(f"التأكيد: خطأ في مجدول التأكيدات: {e}", exc_info=True)
+            await asyncio.sleep(5)
+
+# --- جدولة التحليل على حدود الشموع (Bar-Close Scheduler) ---
+# كل زوج يُحلل مرة واحدة بعد إغلاق شمعته M5 بقليل، بدل المرور الدوري على الأزواج كل بضع ثوانٍ.
+# اتجاها M15 و H1 يُحسبان من الشموع المغلقة فقط، ولا يُعاد حسابهما إلا عند إغلاق شمعة جديدة في إطارهما.
+TIMEFRAME_BUCKETS = {"M5": pd.Timedelta(minutes=5), "M15": pd.Timedelta(minutes=15), "H1": pd.Timedelta(hours=1)}
+TREND_TIMEFRAMES = (("M15", 'm15_ema_period'), ("H1", 'h1_ema_period'))
+BAR_CLOSE_GRACE_SECONDS = 5  # مهلة تنشر خلالها Polygon الشمعة المغلقة
+BAR_CLOSE_RETRY_SECONDS = 15
+BAR_CLOSE_RETRY_WINDOW_SECONDS = 120
+analysis_due = {}
+last_scored_bars = {}
+trend_cache = {}
+
+def bar_close_time(ts, timeframe: str) -> pd.Timestamp:
+    """نهاية الشمعة التي تقع فيها اللحظة ts، أي بداية الشمعة التالية."""
+    bucket = TIMEFRAME_BUCKETS[timeframe]
+    return pd.Timestamp(ts).floor(bucket) + bucket
+
+def drop_forming_bar(df: pd.DataFrame, now: datetime) -> pd.DataFrame:
+    return df[df.index + TIMEFRAME_BUCKETS['M5'] <= now]
+
+def compute_pair_trends(df: pd.DataFrame, params: dict, pair: str = None) -> (str, str):
+    """اتجاها M15 و H1 على الشموع المغلقة حتى آخر شمعة M5 في df، مع ذاكرة لكل زوج عند تمرير pair."""
+    if df is None or df.empty: return 'NEUTRAL', 'NEUTRAL'
+    m5_end = df.index[-1] + TIMEFRAME_BUCKETS['M5']
+    trends = []
+    for timeframe, period_key in TREND_TIMEFRAMES:
+        period = params.get(period_key, 50)
+        # الشمعة التي تبدأ قبل هذه اللحظة مغلقة بالكامل ضمن df.
+        closed_until = m5_end.floor(TIMEFRAME_BUCKETS[timeframe])
+        # المفتاح يشمل الفترة: ملفات التقييم الظلي بفترات مختلفة لا تطرد اتجاه الملف النشط.
+        cached = trend_cache.get((pair, timeframe, period)) if pair else None
+        if cached is not None and cached[0] == closed_until:
+            trends.append(cached[1])
+            continue
+        resampled = resample_candles(df, timeframe)
+        trend = compute_trend(resampled[resampled.index < closed_until], period)
+        if pair: trend_cache[(pair, timeframe, period)] = (closed_until, trend)
+        trends.append(trend)
+    return tuple(trends)
+
+async def emit_initial_signal(chat_id: str, pair: str, buy_strength: int, sell_strength: int, trend_m15: str, trend_h1: str,
+                              context: ContextTypes.DEFAULT_TYPE, details: dict = None):
+    state = subscribers.get(chat_id, bot_state)
+    signal_type, confidence = (None, 0)
+    if buy_strength > sell_strength and buy_strength >= state.get('initial_confidence', 3):
+        signal_type, confidence = 'BUY', buy_strength
+    elif sell_strength > buy_strength and sell_strength >= state.get('initial_confidence', 3):
+        signal_type, confidence = 'SELL', sell_strength
+
+    if signal_type:
+        new_signal = {'pair': pair, 'type': signal_type, 'confidence': confidence, 'timestamp': datetime.now(timezone.utc),
+                      'chat_id': chat_id, 'profile': state.get('profile_name')}
+        new_signal['id'] = signal_store.record('initial', pair, signal_type, new_signal['timestamp'], buy_strength, sell_strength,
+                                               (trend_m15, trend_h1), details, profile=new_signal['profile'], subscriber=chat_id)
+        schedule_confirmation(new_signal)
+
+        strength_meter = '⬆️' * buy_strength if signal_type == 'BUY' else '⬇️' * sell_strength
+        trend_text = f" (M15: {trend_m15}, H1: {trend_h1})"
+        message = (f"🔔 إشارة أولية محتملة 🔔\n\nالزوج: {pair}\nالنوع: {signal_type}\nالقوة: {strength_meter} ({confidence})\nالاتجاه العام: {trend_text}\n"
+                   f"سيتم التأكيد بعد {state.get('confirmation_minutes', 5)} دقيقة.")
+        await send_signal_message(context, chat_id, message, 'initial')
+
+async def m5_callback(df, pair, context):
+    if df is None or df.empty: return
+
+    now = datetime.now(timezone.utc)
+    df = drop_forming_bar(df, now)
+    if df.empty: return
+    closed_ts = df.index[-1]
+    if last_scored_bars.get(pair) == closed_ts:
+        # Polygon لم تنشر الشمعة المغلقة بعد: نعيد المحاولة قريباً بدل انتظار الإغلاق التالي.
+        if (now - pd.Timestamp(now).floor(TIMEFRAME_BUCKETS['M5'])).total_seconds() < BAR_CLOSE_RETRY_WINDOW_SECONDS:
+            retry_at = now + timedelta(seconds=BAR_CLOSE_RETRY_SECONDS)
+            analysis_due[pair] = min(analysis_due.get(pair, retry_at), retry_at)
+        logger.info(f"الكول باك: لا شمعة M5 جديدة للزوج {pair}، تخطي التحليل.")
+        return
+    last_scored_bars[pair] = closed_ts
+    # لا تقييم منفرد: الزوج ينضم إلى دفعة الشموع المغلقة فيُقيّم مع بقية الأزواج التي يجلبها الحاكم الآن
+    # (الدورة عند الإغلاق، التعبئة الأولية عند الإقلاع، وإصلاح الفجوات) بمسار التقييم نفسه في كل أوضاع البيانات.
+    queue_closed_bar(pair, df, context)
 
-    if signal_to_confirm:
-        logger.info(f"المنطق: إضافة طلب تأكيد للزوج {signal_to_confirm['pair']} إلى الطابور.")
-        pending_signals.remove(signal_to_confirm)
-        
-        async def confirmation_callback(df, pair, context):
-            logger.info(f"الكول باك: تم استلام بيانات التأكيد للزوج {pair}.")
-            initial_type = signal_to_confirm['type']
-            if df is not None and not df.empty:
-                buy_strength, sell_strength = analyze_signal_strength(df, 'NEUTRAL', 'NEUTRAL')
-                
-                confirmed = False
-                if initial_type == 'BUY' and buy_strength > sell_strength and buy_strength >= bot_state.get('confirmation_confidence', 4): confirmed = True
-                elif initial_type == 'SELL' and sell_strength > buy_strength and sell_strength >= bot_state.get('confirmation_confidence', 4): confirmed = True
-                
-                if confirmed:
-                    strength_meter = '⬆️' * buy_strength if initial_type == 'BUY' else '⬇️' * sell_strength
-                    message = (f"✅ إشارة مؤكدة ✅\n\nالزوج: {pair}\nالنوع: {initial_type}\nقوة التأكيد: {strength_meter}")
-                    try:
-                        await context.bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=message)
-                        if pair in signals_statistics: signals_statistics[pair]['confirmed'] += 1
-                    except Exception as e:
-                        await send_error_to_telegram(context, f"فشل إرسال رسالة التأكيد للزوج {pair}: {e}")
-                else:
-                    if pair in signals_statistics: signals_statistics[pair]['failed_confirmation'] += 1
-                save_bot_state()
-            else:
-                if pair in signals_statistics: signals_statistics[pair]['failed_confirmation'] += 1
-                save_bot_state()
+async def enqueue_analysis(pair: str, current_time: datetime):
+    m5_limit = required_history()
+    await api_request_queue.put({
+        'pair': pair, 'timeframe': 'M5', 'limit': m5_limit, 'callback': m5_callback, 'metadata': f"analysis_{pair}",
+        'priority': PRIORITY_ANALYSIS, 'on_stale': 'drop', 'deadline': current_time + timedelta(seconds=ANALYSIS_STALE_SECONDS)
+    })
 
-        await api_request_queue.put({
-            'pair': signal_to_confirm['pair'], 'timeframe': 'M5', 'limit': 200, 'callback': confirmation_callback
-        })
+# --- لقطة بيانات السوق للإقلاع الدافئ (Warm Restart) ---
+# ذاكرة الشموع واتجاهات M15/H1 وآخر شمعة قُيّمت لكل زوج تُكتب دورياً إلى ملف ثنائي، وتُربط بالذاكرة (mmap) عند الإقلاع،
+# فلا يُجلب بعد إعادة النشر إلا ما فات منذ اللقطة (الجلب التزايدي في execute_get_forex_data) ولا تُعاد إشارة شمعة قُيّمت.
+# الشكل: MAGIC، طول الترويسة (uint64)، ترويسة JSON، ثم لكل (زوج، إطار) مصفوفة t (ملي ثانية) تليها كتلة أسعار CandleArray (5 × الشموع).
+# كتلة الأسعار تُقرأ من الملف كما هي وتصبح كتلة الإطار الوحيدة (to_frame)، فالأعمدة المستعادة عروض على الملف نفسه
+# (tests/test_market_snapshot.py) بنسخ عند الكتابة (mode='c')، وتعديلها لا يمس الملف. محركات المؤشرات لا تُحفظ:
+# تُبنى من الشموع المستعادة عند أول تحليل دون أي طلب API، وهذا يجنبنا حالة محفوظة لا تطابق كوداً تغير بعد النشر.
+MARKET_SNAPSHOT_FILE = os.environ.get('MARKET_SNAPSHOT_FILE', 'market_snapshot.bin')
+MARKET_SNAPSHOT_INTERVAL_SECONDS = int(os.environ.get('MARKET_SNAPSHOT_INTERVAL_SECONDS', 300))
+MARKET_SNAPSHOT_MAX_AGE_HOURS = 72
+MARKET_SNAPSHOT_MAGIC = b'ALNSNAP1'
+MARKET_SNAPSHOT_VERSION = 1
+MARKET_SNAPSHOT_ALIGN = 64
+market_snapshot_state = {'signature': None, 'writes': 0, 'restored': 0}
+
+def collect_market_snapshot() -> (dict, list):
+    """يأخذ نسخة متسقة من بيانات السوق في حلقة الأحداث؛ الكتابة وحدها تذهب إلى خيط."""
+    header = {'version': MARKET_SNAPSHOT_VERSION, 'saved_at': datetime.now(timezone.utc).isoformat(), 'entries': [],
+              # trend_cache يُحدّث من خيوط الحساب، و copy عملية واحدة تحت الـ GIL.
+              'trends': [[pair, timeframe, period, closed_until.value, trend]
+                         for (pair, timeframe, period), (closed_until, trend) in trend_cache.copy().items()],
+              'last_scored': {pair: ts.value for pair, ts in last_scored_bars.items()}}
+    columns, offset = [], 0
+    for (pair, timeframe), df in candle_cache.items():
+        if df.empty: continue
+        candles = CandleArray.from_frame(df)
+        arrays = [candles.t.astype(np.int64), np.ascontiguousarray(candles.prices)]
+        header['entries'].append({'pair': pair, 'timeframe': timeframe, 'rows': len(df), 'offset': offset})
+        columns.extend(arrays)
+        offset += sum(array.nbytes for array in arrays)
+    return header, columns
+
+def write_market_snapshot(header: dict, columns: list):
+    payload = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    prefix = MARKET_SNAPSHOT_MAGIC + np.uint64(len(payload)).tobytes() + payload
+    padding = b'\0' * (-len(prefix) % MARKET_SNAPSHOT_ALIGN)
+    temp_file = f"{MARKET_SNAPSHOT_FILE}.tmp"
+    with open(temp_file, 'wb') as f:
+        f.write(prefix + padding)
+        for array in columns: f.write(array.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    # الاستبدال لا يمس الملف القديم المربوط بالذاكرة: يبقى صالحاً حتى تُغلق عروضه.
+    os.replace(temp_file, MARKET_SNAPSHOT_FILE)
+
+async def save_market_snapshot():
+    signature = (tuple((key, len(df), df.index[-1]) for key, df in candle_cache.items() if not df.empty), len(last_scored_bars))
+    if not signature[0] or signature == market_snapshot_state['signature']: return
+    header, columns = collect_market_snapshot()
+    try:
+        await asyncio.to_thread(write_market_snapshot, header, columns)
+    except Exception as e:
+        logger.error(f"لقطة السوق: فشل الحفظ: {e}")
         return
+    market_snapshot_state['signature'] = signature
+    market_snapshot_state['writes'] += 1
+    logger.info(f"لقطة السوق: حُفظت {len(header['entries'])} سلسلة شموع و {len(header['trends'])} اتجاه.")
 
-    selected_pairs = bot_state.get('selected_pairs', [])
-    if not selected_pairs: return
+async def market_snapshot_loop():
+    while True:
+        await asyncio.sleep(MARKET_SNAPSHOT_INTERVAL_SECONDS)
+        await save_market_snapshot()
 
-    pair_index = context.bot_data.get('pair_index', 0)
-    if pair_index >= len(selected_pairs): pair_index = 0
+def load_market_snapshot() -> bool:
+    """يربط آخر لقطة بالذاكرة ويعبئ منها ذاكرة الشموع والاتجاهات؛ لقطة تالفة أو قديمة جداً تُتجاهل."""
+    try:
+        mapped = np.memmap(MARKET_SNAPSHOT_FILE, dtype=np.uint8, mode='c')
+    except (FileNotFoundError, ValueError):
+        return False
+    try:
+        if bytes(mapped[:8]) != MARKET_SNAPSHOT_MAGIC: raise ValueError("توقيع الملف غير معروف")
+        header_len = int(mapped[8:16].view(np.uint64)[0])
+        header = json.loads(bytes(mapped[16:16 + header_len]))
+        if header.get('version') != MARKET_SNAPSHOT_VERSION: raise ValueError(f"إصدار غير مدعوم {header.get('version')}")
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(header['saved_at'])
+        if age > timedelta(hours=MARKET_SNAPSHOT_MAX_AGE_HOURS):
+            logger.info(f"لقطة السوق: عمرها {age} أقدم من الحد، سيتم الجلب من جديد.")
+            return False
+        data_start = 16 + header_len + (-(16 + header_len) % MARKET_SNAPSHOT_ALIGN)
+        for entry in header['entries']:
+            rows, start = entry['rows'], data_start + entry['offset']
+            t = mapped[start:start + rows * 8].view(np.int64)
+            prices = mapped[start + rows * 8:start + rows * 48].view(np.float64).reshape(len(CANDLE_COLUMNS), rows)
+            candle_cache[(entry['pair'], entry['timeframe'])] = CandleArray(t, prices).to_frame()
+        for pair, timeframe, period, closed_until, trend in header['trends']:
+            trend_cache[(pair, timeframe, period)] = (pd.Timestamp(closed_until, tz='UTC'), trend)
+        last_scored_bars.update({pair: pd.Timestamp(ts, tz='UTC') for pair, ts in header['last_scored'].items()})
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        logger.warning(f"لقطة السوق: تجاهل ملف تالف أو غير متوافق: {e}")
+        return False
+    market_snapshot_state['restored'] = len(header['entries'])
+    logger.info(f"لقطة السوق: استعادة {len(header['entries'])} سلسلة شموع من لقطة عمرها {age}؛ سيُجلب الفارق فقط.")
+    return True
+
+# --- التقييم الظلي لملفات الاستراتيجية (Shadow Profiles) ---
+# كل ملف استراتيجية مثبت، بما فيه النشط، يُقيّم على نفس الشموع المجلوبة وفي نفس مهمة الحساب، فلا طلب إضافي إلى Polygon.
+# المؤشرات ذات الفترات المشتركة بين الملفات تُحسب مرة واحدة (ذاكرة shared في score_pairs_batch).
+# إشاراته تُسجل بنوع 'shadow' واسم ملفه ولا تُرسل، وتأكيدها يُحكم عليه عند إغلاق شمعة التأكيد بقواعد backtest.py.
+# الملف النشط يُقيّم هنا أيضاً حتى تُقارن كل الملفات بالطريقة نفسها (تقييم جماعي وتأكيد على شمعة مغلقة)،
+# لا بإشارات المشترك الحية التي تُؤكد على الشمعة الجارية. وقت إشارة الظل هو إغلاق شمعتها، فتُستعاد المعلقة بعد الإقلاع.
+SHADOW_SIGNAL_KIND = 'shadow'
+shadow_profiles = {'signature': None, 'profiles': []}
+shadow_pending = {}  # (الزوج، الملف) -> [(شمعة التأكيد، معرف الإشارة، الاتجاه)]
+
+def shadow_mode_enabled() -> bool:
+    return bot_state.get('shadow_mode', False)
+
+def load_shadow_profiles() -> list:
+    """كل ملفات الاستراتيجية كقائمة [(اسم الملف، الإعدادات)]؛ تُعاد قراءتها فقط عند تغير الملفات."""
+    files = sorted(get_strategy_files())
+    try:
+        signature = tuple((f, os.path.getmtime(os.path.join(STRATEGIES_DIR, f))) for f in files)
+    except OSError:
+        signature = None
+    if signature is None or signature != shadow_profiles['signature']:
+        profiles = []
+        for filename in files:
+            try:
+                with open(os.path.join(STRATEGIES_DIR, filename), 'r', encoding='utf-8') as f:
+                    profile = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logger.warning(f"التقييم الظلي: تعذر قراءة {filename}: {e}")
+                continue
+            if profile.get('indicator_params'): profiles.append((filename, profile))
+        shadow_profiles.update({'signature': signature, 'profiles': profiles})
+    return shadow_profiles['profiles']
+
+def shadow_delay_bars(profile: dict) -> int:
+    return max(1, -(-profile.get('confirmation_minutes', 5) // 5))
+
+def score_shadow_profiles(histories: dict, profiles: list, shared: dict = None) -> dict:
+    """يقيّم ملفات الظل على نفس الشموع المغلقة في تمريرة واحدة.
+
+    يعيد {اسم الملف: (الإعدادات، الدرجات بعد فلتر الاتجاه، الدرجات بلا فلتر للتأكيد، الاتجاهات، التفاصيل)}.
+    """
+    shared = {} if shared is None else shared
+    frames = {pair: df.iloc[-ANALYSIS_BARS:] for pair, df in histories.items()}
+    results = {}
+    for filename, profile in profiles:
+        try:
+            params = profile['indicator_params']
+            trends = {pair: compute_pair_trends(df, params, pair) for pair, df in histories.items()}
+            details = {}
+            scores = score_pairs_batch(frames, trends, profile, details, shared)
+            # التأكيد في البوت يمرر NEUTRAL للاتجاه، أي بلا فلتر.
+            raw_scores = score_pairs_batch(frames, None, profile, shared=shared)
+            results[filename] = (profile, scores, raw_scores, trends, details)
+        except Exception as e:
+            logger.error(f"التقييم الظلي: فشل تقييم {filename}: {e}")
+    return results
+
+def resolve_shadow_confirmations(key: tuple, bar: pd.Timestamp, raw_scores: tuple, confidence: int):
+    pending = shadow_pending.pop(key, [])
+    remaining = []
+    for due_bar, signal_id, direction in pending:
+        if bar < due_bar:
+            remaining.append((due_bar, signal_id, direction))
+            continue
+        if bar > due_bar:
+            # شمعة التأكيد لم تُقيّم (توقف البوت أو فجوة في البيانات).
+            outcome = 'expired'
+        else:
+            strength, opposite = raw_scores if direction == 'BUY' else raw_scores[::-1]
+            outcome = 'confirmed' if strength > opposite and strength >= confidence else 'failed'
+        signal_store.resolve(signal_id, outcome)
+    if remaining: shadow_pending[key] = remaining
+
+def record_shadow_signals(results: dict, bars: dict):
+    """يحكم على تأكيدات الظل المستحقة ثم يسجل إشارات الظل الجديدة دون إرسال أي رسالة."""
+    for filename, (profile, scores, raw_scores, trends, details) in results.items():
+        initial_confidence = profile.get('initial_confidence', 3)
+        delay_bars = shadow_delay_bars(profile)
+        for pair, (buy_strength, sell_strength) in scores.items():
+            bar = bars[pair]
+            resolve_shadow_confirmations((pair, filename), bar, raw_scores[pair], profile.get('confirmation_confidence', 4))
+            if buy_strength > sell_strength and buy_strength >= initial_confidence: signal_type = 'BUY'
+            elif sell_strength > buy_strength and sell_strength >= initial_confidence: signal_type = 'SELL'
+            else: continue
+            closed_at = (bar + TIMEFRAME_BUCKETS['M5']).to_pydatetime()
+            signal_id = signal_store.record(SHADOW_SIGNAL_KIND, pair, signal_type, closed_at, buy_strength, sell_strength, trends[pair],
+                                            details.get(pair), profile=profile.get('profile_name', filename))
+            shadow_pending.setdefault((pair, filename), []).append((bar + delay_bars * TIMEFRAME_BUCKETS['M5'], signal_id, signal_type))
+
+async def restore_shadow_pending():
+    """يعيد إلى الذاكرة تأكيدات الظل التي لم تُحسم قبل الإيقاف، ويحسم منتهية ما قُيّمت شمعة تأكيده أو حُذف ملفه."""
+    rows = await signal_store.query("SELECT id, ts, pair, direction, profile FROM signals WHERE kind = ? AND outcome IS NULL",
+                                    (SHADOW_SIGNAL_KIND,))
+    if not rows: return
+    files = {profile.get('profile_name', filename): (filename, profile) for filename, profile in load_shadow_profiles()}
+    restored = 0
+    for signal_id, ts, pair, direction, name in rows:
+        # ts إغلاق شمعة الإشارة (والسجلات الأقدم بعده بقليل)، فالتقريب للأسفل يعيد بداية الشمعة.
+        bar = (pd.Timestamp(ts, unit='s', tz='UTC') - TIMEFRAME_BUCKETS['M5']).floor('5min')
+        filename, profile = files.get(name, (None, None))
+        due_bar = bar + shadow_delay_bars(profile or {}) * TIMEFRAME_BUCKETS['M5']
+        if filename is None or (pair in last_scored_bars and due_bar <= last_scored_bars[pair]):
+            signal_store.resolve(signal_id, 'expired')
+            continue
+        shadow_pending.setdefault((pair, filename), []).append((due_bar, signal_id, direction))
+        restored += 1
+    for pending in shadow_pending.values(): pending.sort(key=itemgetter(0))
+    logger.info(f"التقييم الظلي: استُعيد {restored} تأكيد معلق وانتهت صلاحية {len(rows) - restored}.")
+
+# --- التحديث الجماعي لكل الأزواج (Bulk Snapshot) ---
+# طلب لقطة واحد يعيد آخر شمعة دقيقة لكل الأزواج المختارة، فندمجها في شمعة M5 الجارية لكل زوج.
+# الجلب العميق بالنطاق الزمني يبقى فقط للتعبئة الأولية، أو لإصلاح شمعة لم نرَ كل دقائقها.
+BULK_SNAPSHOT_TIMEFRAME = 'SNAPSHOT'
+M5_BUCKET = TIMEFRAME_BUCKETS['M5']
+ONE_MINUTE = pd.Timedelta(minutes=1)
+# الزوج -> الشمعة الجارية: start، الدقائق المدموجة، has_base إن كان أساسها من Polygon،
+# و next_minute أول دقيقة لم نرها بعد متصلة بما قبلها (دقائق الأساس تُعد مرئية).
+snapshot_buckets = {}
+
+def note_rest_bar(pair: str, cached: pd.DataFrame, fetched_at: datetime):
+    """Polygon أعاد تاريخ الزوج لحظة fetched_at: الشمعة المغلقة لا تحتاج إصلاحاً، والجارية أساس يغطي دقائقها المكتملة."""
+    snapshot_buckets.pop(pair, None)
+    start = cached.index[-1]
+    if start + M5_BUCKET > fetched_at:
+        snapshot_buckets[pair] = {'start': start, 'minutes': {}, 'has_base': True, 'base_volume': float(cached['Volume'].iloc[-1]),
+                                  'next_minute': max(start, pd.Timestamp(fetched_at).floor(ONE_MINUTE))}
+
+def build_snapshot_url(pairs: list) -> str:
+    tickers = ",".join(f"C:{pair.replace('/', '')}" for pair in pairs)
+    return f"{POLYGON_BASE_URL}/v2/snapshot/locale/global/markets/forex/tickers?tickers={tickers}"
+
+def fold_minute_bar(pair: str, minute: dict) -> str:
+    """يدمج شمعة دقيقة من اللقطة في تاريخ M5 للزوج.
+
+    يعيد 'closed' إذا بدأت شمعة M5 جديدة (أي أُغلقت السابقة)، 'updated' إذا تحدثت الشمعة الجارية،
+    'stale' إذا لم يتغير شيء، و 'gap' إذا فاتتنا دقائق ويلزم جلب بالنطاق الزمني لإصلاح التاريخ.
+    """
+    cached = candle_cache.get((pair, 'M5'))
+    if cached is None or cached.empty or not minute or not minute.get('t'): return 'stale'
+    minute_ts = pd.Timestamp(minute['t'], unit='ms', tz='UTC')
+    bucket_ts = minute_ts.floor('5min')
+    last_ts = cached.index[-1]
+    if bucket_ts < last_ts: return 'stale'
+
+    bucket = snapshot_buckets.get(pair)
+    status = 'updated'
+    if bucket_ts > last_ts:
+        if bucket_ts > last_ts + M5_BUCKET:
+            # فاتتنا شمعة M5 كاملة: الجلب التزايدي من آخر شمعة مخزنة يملأ الفجوة.
+            snapshot_buckets.pop(pair, None)
+            return 'gap'
+        if bucket is not None and bucket['start'] == last_ts and bucket['next_minute'] < last_ts + M5_BUCKET:
+            # فاتتنا دقيقة من الشمعة بعد أساسها من Polygon (أو منذ بدايتها إن بُنيت من الدقائق فقط):
+            # نحذفها ليعيد الجلب التزايدي بناءها كاملة.
+            candle_cache[(pair, 'M5')] = cached.iloc[:-1]
+            snapshot_buckets.pop(pair, None)
+            return 'gap'
+        status = 'closed'
+        row = pd.DataFrame({'Open': [float(minute['o'])], 'High': [float(minute['h'])], 'Low': [float(minute['l'])],
+                            'Close': [float(minute['c'])], 'Volume': [0.0]}, index=[bucket_ts])
+        cached = pd.concat([cached, row])
+        bucket = snapshot_buckets[pair] = {'start': bucket_ts, 'minutes': {}, 'has_base': False, 'next_minute': bucket_ts}
+    elif bucket is None or bucket['start'] != bucket_ts:
+        # شمعة جارية من Polygon لا نعرف لحظة جلبها (لقطة الإقلاع مثلاً): نعتبر ما قبل هذه الدقيقة مغطى بالأساس.
+        bucket = snapshot_buckets[pair] = {'start': bucket_ts, 'minutes': {}, 'has_base': True,
+                                           'base_volume': float(cached['Volume'].iloc[-1]), 'next_minute': minute_ts}
+
+    if bucket['minutes'].get(minute_ts) == minute and status == 'updated': return 'stale'
+    bucket['minutes'][minute_ts] = minute
+    skipped = minute_ts > bucket['next_minute']
+    if not skipped: bucket['next_minute'] = max(bucket['next_minute'], minute_ts + ONE_MINUTE)
+    last = cached.index[-1]
+    cached.loc[last, 'High'] = max(cached.loc[last, 'High'], float(minute['h']))
+    cached.loc[last, 'Low'] = min(cached.loc[last, 'Low'], float(minute['l']))
+    if minute_ts == max(bucket['minutes']): cached.loc[last, 'Close'] = float(minute['c'])
+    # الحجم تقريبي عند وجود أساس من Polygon لأننا لا نعرف أي الدقائق يغطيها.
+    minutes_volume = sum(float(m.get('v', 0)) for m in bucket['minutes'].values())
+    cached.loc[last, 'Volume'] = max(bucket.get('base_volume', 0.0), minutes_volume)
+    # بنفس حد merge_candles حتى لا يقل التاريخ عن required_history فيعود الجلب العميق في كل دورة.
+    candle_cache[(pair, 'M5')] = cached.iloc[-max(CANDLE_CACHE_MAX_BARS, required_history()):]
+    # دقيقة ناقصة داخل الشمعة الجارية: نطلب الإصلاح فوراً بدل انتظار إغلاقها.
+    return 'gap' if skipped else status
+
+async def execute_bulk_snapshot(context: ContextTypes.DEFAULT_TYPE) -> dict:
+    """يجلب لقطة كل الأزواج المختارة بطلب واحد ويعيد الأزواج حسب حالة دمجها."""
+    pairs = watched_pairs()
+    result = {'closed': [], 'updated': [], 'gap': [], 'stale': []}
+    if not pairs: return result
+    tickers = {f"C:{pair.replace('/', '')}": pair for pair in pairs}
+    try:
+        data = await timed_polygon_fetch(build_snapshot_url(pairs), 'SNAPSHOT')
+        rate_controller.on_success()
+    except PolygonRateLimited:
+        raise
+    except Exception as e:
+        await send_error_to_telegram(context, f"فشل جلب اللقطة الجماعية من Polygon: {e}")
+        return result
+    for ticker in data.get('tickers') or []:
+        pair = tickers.get(ticker.get('ticker'))
+        if pair: result[fold_minute_bar(pair, ticker.get('min'))].append(pair)
+    return result
+
+async def repair_pair_history(pair: str, now: datetime):
+    # الإصلاح جلب تزايدي عادي من آخر شمعة موثوقة، ويحلل الزوج على البيانات المصلحة.
+    logger.info(f"التحديث المباشر: فجوة في بيانات {pair}، طلب إصلاح من Polygon.")
+    if not api_request_queue.has_pending(f"analysis_{pair}"): await enqueue_analysis(pair, now)
+
+def score_histories(histories: dict, evaluations: dict, shadow: list = ()) -> (dict, dict):
+    """يقيّم كل الأزواج لكل مجموعة إعدادات على مصفوفة واحدة مشتركة: {المفتاح: {الزوج: (شراء، بيع، M15، H1، التفاصيل)}}."""
+    frames, shared, results = {pair: df.iloc[-ANALYSIS_BARS:] for pair, df in histories.items()}, {}, {}
+    for key, settings in evaluations.items():
+        params = settings.get('indicator_params', {})
+        with TraceSpan('compute/trends'):
+            trends = {pair: compute_pair_trends(df, params, pair) for pair, df in histories.items()}
+        details = {}
+        with TraceSpan('compute/batch'):
+            scores = score_pairs_batch(frames, trends, settings, details, shared)
+        results[key] = {pair: (*scores[pair], *trends[pair], details.get(pair)) for pair in frames}
+    with TraceSpan('compute/shadow'):
+        shadow_results = score_shadow_profiles(histories, shadow, shared) if shadow else {}
+    return results, shadow_results
+
+async def score_closed_bars(histories: dict, context: ContextTypes.DEFAULT_TYPE):
+    """يقيّم دفعة واحدة الأزواج التي أُغلقت شمعتها؛ كل تاريخ ينتهي بالشمعة المغلقة."""
+    groups = evaluation_groups()
+    shadow = load_shadow_profiles() if shadow_mode_enabled() else []
+    if not groups and not shadow: return
+    results, shadow_results = await compute_stage.run(
+        'تقييم جماعي', score_histories, histories, {key: settings for key, (settings, _) in groups.items()}, shadow)
+    logger.info(f"التقييم الجماعي: تقييم {len(histories)} زوج أُغلقت شمعتها لـ {len(groups)} مجموعة إعدادات.")
+    for key, (_, chat_ids) in groups.items():
+        for chat_id in chat_ids:
+            watched = subscribers[chat_id].get('selected_pairs', [])
+            for pair, (buy_strength, sell_strength, trend_m15, trend_h1, details) in results[key].items():
+                if pair not in watched: continue
+                await emit_initial_signal(chat_id, pair, buy_strength, sell_strength, trend_m15, trend_h1, context, details)
+    if shadow_results: record_shadow_signals(shadow_results, {pair: df.index[-1] for pair, df in histories.items()})
+
+async def bulk_snapshot_callback(result: dict, _, context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.now(timezone.utc)
+    for pair in result['gap']: await repair_pair_history(pair, now)
+    # نحلل فقط الأزواج التي أُغلقت شمعتها للتو، على الشموع المكتملة، وكل شمعة مرة واحدة مهما كان مسارها
+    # (الإصلاح يعيد الزوج عبر m5_callback الذي يتخطى ما سُجل هنا).
+    histories = {}
+    for pair in result['closed']:
+        history = candle_cache[(pair, 'M5')].iloc[:-1]
+        if history.empty or last_scored_bars.get(pair) == history.index[-1]: continue
+        last_scored_bars[pair] = history.index[-1]
+        histories[pair] = history
+    if histories: await score_closed_bars(histories, context)
+
+# --- دفعة الشموع المغلقة (Closed-Bar Batch) ---
+# كل شمعة مغلقة، من الحاكم (REST والتعبئة والإصلاح) أو من البث، تنتظر هنا قليلاً حتى تصل شموع بقية الأزواج
+# التي أُغلقت معها، ثم تُقيّم كلها في تمريرة متجهة واحدة عبر score_closed_bars.
+STREAM_BATCH_DELAY_SECONDS = 1.0
+CLOSED_BAR_BATCH_MAX_WAIT_SECONDS = 5.0
+CLOSED_BAR_BATCH_POLL_SECONDS = 0.05
+closed_bar_batch = {'histories': {}, 'traces': [], 'scheduled': False}
+
+def queue_closed_bar(pair: str, history: pd.DataFrame, context: ContextTypes.DEFAULT_TYPE):
+    """يضيف تاريخ زوج ينتهي بشمعة مغلقة إلى الدفعة التالية؛ أثر الطلب الذي جلبه يبقى مفتوحاً حتى تقييمها."""
+    closed_bar_batch['histories'][pair] = history
+    for trace in active_traces.get():
+        trace.hold()
+        closed_bar_batch['traces'].append(trace)
+    if not closed_bar_batch['scheduled']:
+        closed_bar_batch['scheduled'] = True
+        asyncio.create_task(flush_closed_bars(context))
+
+async def flush_closed_bars(context: ContextTypes.DEFAULT_TYPE):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + CLOSED_BAR_BATCH_MAX_WAIT_SECONDS
+    # شموع البث تصل لكل الأزواج في اللحظة نفسها، أما الحاكم فيجلب الأزواج تباعاً: ننتظر ما بقي من طلبات التحليل.
+    if not closed_bar_batch['traces']:
+        await asyncio.sleep(STREAM_BATCH_DELAY_SECONDS)
+    else:
+        while api_request_queue.has_outstanding(PRIORITY_ANALYSIS) and loop.time() < deadline:
+            await asyncio.sleep(CLOSED_BAR_BATCH_POLL_SECONDS)
+    histories, traces = dict(closed_bar_batch['histories']), list(closed_bar_batch['traces'])
+    closed_bar_batch.update({'histories': {}, 'traces': [], 'scheduled': False})
+    if not traces:
+        begin_scan('W')
+        traces = [Trace('بث', f"{len(histories)} زوج")]
+    active_traces.set(tuple(traces))
+    try:
+        await score_closed_bars(histories, context)
+    finally:
+        for trace in traces: trace.release()
+
+async def enqueue_backfill(selected_pairs: list, current_time: datetime) -> bool:
+    """يطلب التاريخ العميق بالنطاق الزمني للأزواج التي لا تملك تاريخاً كافياً. يعيد True إذا كانت كلها جاهزة."""
+    required = required_history()
+    backfilled = True
+    for pair in selected_pairs:
+        cached = candle_cache.get((pair, 'M5'))
+        if cached is None or len(cached) < required:
+            backfilled = False
+            if not api_request_queue.has_pending(f"analysis_{pair}"):
+                await enqueue_analysis(pair, current_time)
+    return backfilled
+
+async def enqueue_bulk_refresh(selected_pairs: list, current_time: datetime):
+    """يعبئ تاريخ الأزواج الجديدة بالنطاق الزمني، ثم يحدث كل الأزواج بطلب لقطة واحد."""
+    if not await enqueue_backfill(selected_pairs, current_time) or api_request_queue.has_pending('bulk_snapshot'): return
+    await api_request_queue.put({
+        'pair': 'ALL', 'timeframe': BULK_SNAPSHOT_TIMEFRAME, 'limit': 0, 'fetch': execute_bulk_snapshot,
+        'callback': bulk_snapshot_callback, 'metadata': 'bulk_snapshot',
+        'priority': PRIORITY_ANALYSIS, 'on_stale': 'drop', 'deadline': current_time + timedelta(seconds=ANALYSIS_STALE_SECONDS)
+    })
 
-    pair_to_process = selected_pairs[pair_index]
-    
-    if any(req.get('metadata') == f"analysis_{pair_to_process}" for req in api_request_queue._queue):
-        logger.info(f"المنطق: تخطي إضافة طلب تحليل لـ {pair_to_process}، يوجد طلب بالفعل في الطابور.")
-        context.bot_data['pair_index'] = (pair_index + 1) % len(selected_pairs)
+# --- البث المباشر عبر WebSocket (Streaming Mode) ---
+# اشتراك في شموع الدقيقة (CA) لكل زوج مختار؛ تُدمج في شموع M5 ويُحلل الزوج فور إغلاق شمعته.
+# REST يبقى للتعبئة الأولية ولإصلاح الفجوات بعد انقطاع الاتصال (يكتشفها fold_minute_bar).
+POLYGON_WS_URL = os.environ.get('POLYGON_WS_URL', 'wss://socket.polygon.io/forex')
+STREAM_RECONNECT_MAX_SECONDS = 60
+stream_state = {'task': None, 'connected': False, 'reconnects': 0}
+
+def stream_channel(pair: str) -> str:
+    return f"CA.C:{pair.replace('/', '-')}"
+
+def stream_is_wanted() -> bool:
+    return bool(running_subscribers()) and bot_state.get('data_mode', 'rest') == 'stream'
+
+async def handle_stream_minute(pair: str, event: dict, context: ContextTypes.DEFAULT_TYPE):
+    minute = {'t': event.get('s'), 'o': event.get('o'), 'h': event.get('h'), 'l': event.get('l'),
+              'c': event.get('c'), 'v': event.get('v', 0)}
+    status = fold_minute_bar(pair, minute)
+    if status == 'gap':
+        await repair_pair_history(pair, datetime.now(timezone.utc))
+        return
+    if status == 'stale': return
+
+    cached = candle_cache[(pair, 'M5')]
+    minute_ts = pd.Timestamp(minute['t'], unit='ms', tz='UTC')
+    if minute_ts + ONE_MINUTE == cached.index[-1] + M5_BUCKET:
+        # وصلت الدقيقة الأخيرة من الشمعة: الشمعة مكتملة ولا داعي لانتظار بداية الشمعة التالية.
+        closed_ts, history = cached.index[-1], cached
+    elif status == 'closed':
+        closed_ts, history = cached.index[-2], cached.iloc[:-1]
+    else:
         return
+    if last_scored_bars.get(pair) == closed_ts: return
+    last_scored_bars[pair] = closed_ts
+    queue_closed_bar(pair, history, context)
+
+async def stream_loop(context: ContextTypes.DEFAULT_TYPE):
+    logger.info("البث المباشر: بدء الاتصال بـ Polygon WebSocket...")
+    delay = 1.0
+    while stream_is_wanted():
+        try:
+            async with polygon_client.ws_connect(POLYGON_WS_URL) as ws:
+                await ws.send_json({'action': 'auth', 'params': POLYGON_API_KEY})
+                subscribed = set()
+                while stream_is_wanted():
+                    wanted = set(watched_pairs())
+                    if wanted != subscribed:
+                        if wanted - subscribed:
+                            await ws.send_json({'action': 'subscribe', 'params': ",".join(stream_channel(p) for p in wanted - subscribed)})
+                        if subscribed - wanted:
+                            await ws.send_json({'action': 'unsubscribe', 'params': ",".join(stream_channel(p) for p in subscribed - wanted)})
+                        subscribed = wanted
 
-    logger.info(f"المنطق: إضافة طلبات تحليل للزوج {pair_to_process} إلى الطابور.")
+                    try:
+                        msg = await ws.receive(timeout=5)
+                    except asyncio.TimeoutError:
+                        continue
+                    if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR): break
+                    if msg.type != aiohttp.WSMsgType.TEXT: continue
+
+                    for event in json_loads(msg.data):
+                        if event.get('ev') == 'status':
+                            logger.info(f"البث المباشر: {event.get('status')} - {event.get('message', '')}")
+                            if event.get('status') == 'auth_success':
+                                stream_state['connected'], delay = True, 1.0
+                            elif event.get('status') == 'auth_failed':
+                                await send_error_to_telegram(context, f"فشل التحقق من مفتاح Polygon في البث المباشر: {event.get('message', '')}")
+                        elif event.get('ev') == 'CA' and event.get('pair') in subscribed:
+                            await handle_stream_minute(event['pair'], event, context)
+        except Exception as e:
+            logger.warning(f"البث المباشر: انقطع الاتصال ({e}).")
+        stream_state['connected'] = False
+        if not stream_is_wanted(): break
+        stream_state['reconnects'] += 1
+        wait = delay * random.uniform(0.5, 1.5)
+        logger.info(f"البث المباشر: إعادة الاتصال بعد {wait:.1f} ث.")
+        await asyncio.sleep(wait)
+        delay = min(delay * 2, STREAM_RECONNECT_MAX_SECONDS)
+    logger.info("البث المباشر: توقف.")
+
+async def ensure_stream_running(selected_pairs: list, current_time: datetime, context: ContextTypes.DEFAULT_TYPE):
+    await enqueue_backfill(selected_pairs, current_time)
+    task = stream_state['task']
+    if task is None or task.done():
+        stream_state['task'] = asyncio.create_task(stream_loop(context))
+
+def stream_report() -> str:
+    status = "متصل ✅" if stream_state['connected'] else "غير متصل ❌"
+    return f"{status}، مرات إعادة الاتصال: {stream_state['reconnects']}"
 
-    context.bot_data[f'trend_data_{pair_to_process}'] = {}
+async def logic_loop(context: ContextTypes.DEFAULT_TYPE):
+    begin_scan('S')
+    current_time = datetime.now(timezone.utc)
+    selected_pairs = watched_pairs()
+    if not selected_pairs: return
 
-    async def h1_callback(df, pair, context):
-        if df is not None and not df.empty:
-            params = bot_state.get('indicator_params', {})
-            period = params.get('h1_ema_period', 50)
-            df[f'ema_{period}'] = ta.trend.EMAIndicator(df['Close'], window=period).ema_indicator()
-            if not df[f'ema_{period}'].dropna().empty:
-                trend = 'UP' if df['Close'].iloc[-1] > df[f'ema_{period}'].iloc[-1] else 'DOWN'
-                context.bot_data[f'trend_data_{pair}']['h1'] = trend
-        
-        await api_request_queue.put({
-            'pair': pair, 'timeframe': 'M5', 'limit': 200, 'callback': m5_callback, 'metadata': f"analysis_{pair}"
-        })
+    if bot_state.get('data_mode', 'rest') == 'bulk':
+        await enqueue_bulk_refresh(selected_pairs, current_time)
+        return
+    if bot_state.get('data_mode', 'rest') == 'stream':
+        await ensure_stream_running(selected_pairs, current_time, context)
+        return
 
-    async def m15_callback(df, pair, context):
-        if df is not None and not df.empty:
-            params = bot_state.get('indicator_params', {})
-            period = params.get('m15_ema_period', 50)
-            df[f'ema_{period}'] = ta.trend.EMAIndicator(df['Close'], window=period).ema_indicator()
-            if not df[f'ema_{period}'].dropna().empty:
-                trend = 'UP' if df['Close'].iloc[-1] > df[f'ema_{period}'].iloc[-1] else 'DOWN'
-                context.bot_data[f'trend_data_{pair}']['m15'] = trend
-
-        await api_request_queue.put({
-            'pair': pair, 'timeframe': 'H1', 'limit': 150, 'callback': h1_callback, 'metadata': f"analysis_{pair}"
-        })
-
-    async def m5_callback(df, pair, context):
-        if df is None or df.empty: return
-
-        trend_m15 = context.bot_data.get(f'trend_data_{pair}', {}).get('m15', 'NEUTRAL')
-        trend_h1 = context.bot_data.get(f'trend_data_{pair}', {}).get('h1', 'NEUTRAL')
-        
-        buy_strength, sell_strength = analyze_signal_strength(df, trend_m15, trend_h1)
-        
-        signal_type, confidence = (None, 0)
-        if buy_strength > sell_strength and buy_strength >= bot_state.get('initial_confidence', 3):
-            signal_type, confidence = 'BUY', buy_strength
-        elif sell_strength > buy_strength and sell_strength >= bot_state.get('initial_confidence', 3):
-            signal_type, confidence = 'SELL', sell_strength
-
-        if signal_type:
-            new_signal = {'pair': pair, 'type': signal_type, 'confidence': confidence, 'timestamp': datetime.now(timezone.utc)}
-            pending_signals.append(new_signal)
-            if pair not in signals_statistics: signals_statistics[pair] = {'initial': 0, 'confirmed': 0, 'failed_confirmation': 0}
-            signals_statistics[pair]['initial'] += 1
-            save_bot_state()
-
-            strength_meter = '⬆️' * buy_strength if signal_type == 'BUY' else '⬇️' * sell_strength
-            trend_text = f" (M15: {trend_m15}, H1: {trend_h1})"
-            message = (f"🔔 إشارة أولية محتملة 🔔\n\nالزوج: {pair}\nالنوع: {signal_type}\nالقوة: {strength_meter} ({confidence})\nالاتجاه العام: {trend_text}\n"
-                       f"سيتم التأكيد بعد {bot_state.get('confirmation_minutes', 5)} دقيقة.")
-            await context.bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=message)
-        
-        if f'trend_data_{pair}' in context.bot_data:
-            del context.bot_data[f'trend_data_{pair}']
+    # كل زوج يُحلل عند أول دورة بعد إغلاق شمعته M5؛ الأزواج التي لم تُغلق شمعتها لا تكلف شيئاً.
+    next_due = bar_close_time(current_time, 'M5') + timedelta(seconds=BAR_CLOSE_GRACE_SECONDS)
+    for pair in selected_pairs:
+        due = analysis_due.get(pair)
+        if due is not None and current_time < due: continue
+        analysis_due[pair] = next_due
 
-    await api_request_queue.put({
-        'pair': pair_to_process, 'timeframe': 'M15', 'limit': 150, 'callback': m15_callback, 'metadata': f"analysis_{pair_to_process}"
-    })
+        if api_request_queue.has_pending(f"analysis_{pair}"):
+            logger.info(f"المنطق: تخطي إضافة طلب تحليل لـ {pair}، يوجد طلب بالفعل في الطابور.")
+            continue
 
-    context.bot_data['pair_index'] = (pair_index + 1) % len(selected_pairs)
+        logger.info(f"المنطق: إضافة طلب تحليل للزوج {pair} إلى الطابور.")
+        await enqueue_analysis(pair, current_time)
 
 # --- تعريف حالات المحادثة ---
 (SELECTING_ACTION, SELECTING_PAIR, SETTINGS_MENU, SETTING_CONFIDENCE, 
@@ -389,7 +2664,6 @@ async def logic_loop(context: ContextTypes.DEFAULT_TYPE):
 
 # --- دوال واجهة المستخدم ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.bot_data.setdefault('pair_index', 0)
     user_name = update.effective_user.first_name
     message = (f"أهلاً بك يا {user_name} في ALNUSIRY BOT {{ VIP }} - v5.0 👋\n\n"
                "مساعدك الذكي للتداول (المحرك النهائي المستقر)")
@@ -397,7 +2671,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     return await send_main_menu(update, context)
 
 async def send_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text: str = 'القائمة الرئيسية:') -> int:
-    status_text = "يعمل ✅" if bot_state.get('is_running', False) else "متوقف ❌"
+    state = subscriber_state(update)
+    status_text = "يعمل ✅" if state.get('is_running', False) else "متوقف ❌"
     main_menu_keyboard = [
         [KeyboardButton(f"حالة البوت: {status_text}")],
         [KeyboardButton("اختيار الأزواج"), KeyboardButton("الإعدادات ⚙️")],
@@ -416,18 +2691,19 @@ async def send_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, mes
     return SELECTING_ACTION
 
 async def show_current_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    status = "يعمل ✅" if bot_state.get('is_running', False) else "متوقف ❌"
-    pairs = ", ".join(bot_state.get('selected_pairs', [])) or "لا يوجد"
-    profile = bot_state.get('profile_name', 'غير معروف')
+    state = subscriber_state(update)
+    status = "يعمل ✅" if state.get('is_running', False) else "متوقف ❌"
+    pairs = ", ".join(state.get('selected_pairs', [])) or "لا يوجد"
+    profile = state.get('profile_name', 'غير معروف')
     
     trend_modes = {'NONE': '⚫️ إيقاف', 'M15': '🟢 M15 فقط', 'H1': '🟡 H1 فقط', 'M15_H1': '🔴 M15 + H1'}
-    trend_filter = trend_modes.get(bot_state.get('trend_filter_mode', 'M15'))
+    trend_filter = trend_modes.get(state.get('trend_filter_mode', 'M15'))
     
-    initial_conf = bot_state.get('initial_confidence', 'N/A')
-    final_conf = bot_state.get('confirmation_confidence', 'N/A')
-    macd_strategy = bot_state.get('macd_strategy', 'N/A')
+    initial_conf = state.get('initial_confidence', 'N/A')
+    final_conf = state.get('confirmation_confidence', 'N/A')
+    macd_strategy = state.get('macd_strategy', 'N/A')
 
-    params_text = "\n".join([f"   - {key.replace('_', ' ').title()}: {value}" for key, value in bot_state.get('indicator_params', {}).items()])
+    params_text = "\n".join([f"   - {key.replace('_', ' ').title()}: {value}" for key, value in state.get('indicator_params', {}).items()])
 
     message = (
         f"📋 **ملخص الإعدادات الحالية للبوت** 📋\n\n"
@@ -436,31 +2712,45 @@ async def show_current_settings(update: Update, context: ContextTypes.DEFAULT_TY
         f"   - ملف الاستراتيجية: {profile}\n\n"
         f"🔹 **إعدادات التداول:**\n"
         f"   - الأزواج المحددة: {pairs}\n"
-        f"   - فلتر الاتجاه: {trend_filter}\n\n"
+        f"   - فلتر الاتجاه: {trend_filter}\n"
+        f"   - مصدر البيانات: {DATA_MODES.get(bot_state.get('data_mode', 'rest'))}\n"
+        f"   - حالة البث المباشر: {stream_report()}\n"
+        f"   - التقييم الظلي: {'يعمل ✅' if shadow_mode_enabled() else 'متوقف ❌'}\n\n"
         f"🔹 **عتبات الثقة:**\n"
         f"   - الإشارة الأولية: {initial_conf} مؤشرات\n"
         f"   - التأكيد النهائي: {final_conf} مؤشرات\n\n"
         f"🔹 **استراتيجية الماكد:** {macd_strategy.title()}\n\n"
         f"🔹 **قيم المؤشرات الفنية:**\n"
-        f"{params_text}"
+        f"{params_text}\n\n"
+        f"🔹 **طابور الحاكم:**\n"
+        f"{api_request_queue.report()}\n\n"
+        f"🔹 **حصة Polygon:**\n"
+        f"{rate_controller.report()}\n\n"
+        f"🔹 **مرحلة الحساب:**\n"
+        f"{compute_stage.report()}\n\n"
+        f"🔹 **المشتركون:** {len(subscribers)} (العاملون {len(running_subscribers())}، "
+        f"مجموعات إعدادات التقييم {len(evaluation_groups())})"
     )
     await update.message.reply_text(message, parse_mode='Markdown')
     return SELECTING_ACTION
 
 async def toggle_bot_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not bot_state.get('selected_pairs') and not bot_state.get('is_running'):
+    state = subscriber_state(update)
+    if not state.get('selected_pairs') and not state.get('is_running'):
         await update.message.reply_text("⚠️ خطأ: يرجى تحديد زوج عملات واحد على الأقل قبل البدء.")
         return await send_main_menu(update, context, "")
-    bot_state['is_running'] = not bot_state.get('is_running', False)
-    if not bot_state['is_running']: context.bot_data['pair_index'] = 0
+    state['is_running'] = not state.get('is_running', False)
+    prune_analysis_due()
+    confirmation_wakeup.set()
     save_bot_state()
-    message = "✅ تم تشغيل البوت. سيبدأ محرك الحاكم الآن." if bot_state['is_running'] else "❌ تم إيقاف البوت."
+    message = "✅ تم تشغيل البوت. سيبدأ محرك الحاكم الآن." if state['is_running'] else "❌ تم إيقاف البوت."
     await update.message.reply_text(message)
     return await send_main_menu(update, context, "")
 
 async def select_pairs_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يعرض قائمة لاختيار الأزواج باستخدام أزرار نصية عادية."""
-    selected = bot_state.get('selected_pairs', [])
+    state = subscriber_state(update)
+    selected = state.get('selected_pairs', [])
     message = "اختر زوجًا لإضافته أو إزالته. الأزواج المختارة حاليًا:\n" + (", ".join(selected) or "لا يوجد")
     
     # بناء لوحة المفاتيح النصية
@@ -473,16 +2763,17 @@ async def select_pairs_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def toggle_pair(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يضيف أو يزيل زوجًا من القائمة ويعيد عرضها."""
+    state = subscriber_state(update)
     pair = update.message.text.split(" ")[0]
-    if 'selected_pairs' not in bot_state:
-        bot_state['selected_pairs'] = []
+    if 'selected_pairs' not in state:
+        state['selected_pairs'] = []
     
-    if pair in bot_state['selected_pairs']:
-        bot_state['selected_pairs'].remove(pair)
+    if pair in state['selected_pairs']:
+        state['selected_pairs'].remove(pair)
+        prune_analysis_due()
     elif pair in USER_DEFINED_PAIRS:
-        bot_state['selected_pairs'].append(pair)
+        state['selected_pairs'].append(pair)
     
-    context.bot_data['pair_index'] = 0
     save_bot_state()
     
     return await select_pairs_menu(update, context)
@@ -496,6 +2787,9 @@ async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         [KeyboardButton("تعديل قيم المؤشرات"), KeyboardButton("📊 استراتيجية الماكد")],
         [KeyboardButton("العودة إلى القائمة الرئيسية")]
     ]
+    # مصدر البيانات والتقييم الظلي يخصان المحرك المشترك لكل المشتركين، فهما للمالك فقط.
+    if is_owner(update.effective_chat.id):
+        settings_keyboard.insert(3, [KeyboardButton("📡 مصدر البيانات"), KeyboardButton("👥 التقييم الظلي")])
     # هذا هو السطر الصحيح والكامل
     reply_markup = ReplyKeyboardMarkup(settings_keyboard, resize_keyboard=True, one_time_keyboard=True)
     
@@ -504,7 +2798,8 @@ async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
 async def trend_filter_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يعرض قائمة فلاتر الاتجاه باستخدام أزرار مضمنة."""
-    current_mode = bot_state.get('trend_filter_mode', 'M15')
+    state = subscriber_state(update)
+    current_mode = state.get('trend_filter_mode', 'M15')
     modes = {'NONE': '⚫️ إيقاف الفلترة', 'M15': '🟢 M15 فقط', 'H1': '🟡 H1 فقط', 'M15_H1': '🔴 M15 + H1'}
     
     keyboard = []
@@ -520,19 +2815,95 @@ async def trend_filter_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def set_trend_filter_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يضبط وضع فلتر الاتجاه بناءً على الكول باك."""
+    state = subscriber_state(update)
     query = update.callback_query
     await query.answer()
     
     new_mode = query.data.split('_')[-1]
-    bot_state['trend_filter_mode'] = new_mode
+    state['trend_filter_mode'] = new_mode
     save_bot_state()
     
     await query.edit_message_text(text=f"✅ تم تحديث وضع فلتر الاتجاه إلى: {new_mode}")
     await send_main_menu(update, context, "القائمة الرئيسية:")
     return SELECTING_ACTION
 
+async def reply_owner_only(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    return await send_main_menu(update, context, "⛔ هذا الإعداد خاص بمالك البوت لأنه يغير المحرك لكل المشتركين.")
+
+DATA_MODES = {'rest': '🔁 طلب لكل زوج (REST)', 'bulk': '📦 لقطة جماعية لكل الأزواج', 'stream': '⚡ بث مباشر (WebSocket)'}
+
+async def data_mode_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """يعرض قائمة مصدر البيانات باستخدام أزرار مضمنة."""
+    if not is_owner(update.effective_chat.id): return await reply_owner_only(update, context)
+    current_mode = bot_state.get('data_mode', 'rest')
+    keyboard = []
+    for mode, text in DATA_MODES.items():
+        button_text = f"{text} {'✅' if current_mode == mode else ''}"
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f"set_data_mode_{mode}")])
+    
+    keyboard.append([InlineKeyboardButton("العودة إلى القائمة الرئيسية", callback_data="main_menu")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await update.message.reply_text("اختر طريقة جلب بيانات الأسعار:", reply_markup=reply_markup)
+    return SETTINGS_MENU
+
+async def set_data_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """يضبط مصدر البيانات بناءً على الكول باك."""
+    if not is_owner(update.effective_chat.id): return await reply_owner_only(update, context)
+    query = update.callback_query
+    await query.answer()
+    
+    new_mode = query.data.replace("set_data_mode_", "")
+    bot_state['data_mode'] = new_mode
+    save_bot_state()
+    
+    await query.edit_message_text(text=f"✅ تم تحديث مصدر البيانات إلى: {DATA_MODES.get(new_mode, new_mode)}")
+    await send_main_menu(update, context, "القائمة الرئيسية:")
+    return SELECTING_ACTION
+
+async def toggle_shadow_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """يشغّل أو يوقف التقييم الظلي لباقي ملفات الاستراتيجية."""
+    if not is_owner(update.effective_chat.id): return await reply_owner_only(update, context)
+    bot_state['shadow_mode'] = not shadow_mode_enabled()
+    save_bot_state()
+    if bot_state['shadow_mode']:
+        message = f"✅ تم تشغيل التقييم الظلي لـ {len(load_shadow_profiles())} ملف استراتيجية. إشاراتها تُسجل للمقارنة ولا تُرسل."
+    else:
+        message = "❌ تم إيقاف التقييم الظلي."
+    return await send_main_menu(update, context, message)
+
+# --- أوامر التشخيص للمالك (/traces و /profile) ---
+async def show_traces(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_owner(update.effective_chat.id): return
+    await update.message.reply_text(traces_report()[:4000])
+
+async def finish_profiling(context: ContextTypes.DEFAULT_TYPE, chat_id: str, seconds: float):
+    await asyncio.sleep(seconds)
+    profiler.stop()
+    try:
+        await context.bot.send_message(chat_id=chat_id, text=profiler.summary())
+    except Exception as e:
+        logger.error(f"المحلل: فشل إرسال الملخص: {e}")
+
+async def start_profiling(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile [دقائق]: يشغّل محلل العينات للمدة المطلوبة ثم يرسل الملخص."""
+    if not is_owner(update.effective_chat.id): return
+    if profiler.running:
+        await update.message.reply_text("🔬 المحلل يعمل بالفعل، سيصلك الملخص عند انتهائه.")
+        return
+    try:
+        minutes = float(context.args[0]) if context.args else 5.0
+    except ValueError:
+        await update.message.reply_text("❌ الاستخدام: /profile [عدد الدقائق]")
+        return
+    minutes = min(max(minutes, 0.1), PROFILER_MAX_MINUTES)
+    profiler.start(minutes * 60)
+    asyncio.create_task(finish_profiling(context, update.effective_chat.id, minutes * 60))
+    await update.message.reply_text(f"🔬 بدأ محلل العينات لمدة {minutes:g} دقيقة.")
+
 async def strategy_profile_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يعرض قائمة ملفات التعريف باستخدام أزرار مضمنة."""
+    state = subscriber_state(update)
     profiles = get_strategy_files()
     keyboard = []
     for profile in profiles:
@@ -541,18 +2912,20 @@ async def strategy_profile_menu(update: Update, context: ContextTypes.DEFAULT_TY
     keyboard.append([InlineKeyboardButton("العودة إلى القائمة الرئيسية", callback_data="main_menu")])
     reply_markup = InlineKeyboardMarkup(keyboard)
     
-    current_profile = bot_state.get('profile_name', 'غير معروف')
+    current_profile = state.get('profile_name', 'غير معروف')
     await update.message.reply_text(f"اختر ملف تعريف لتحميله. (الحالي: {current_profile})", reply_markup=reply_markup)
     return SETTINGS_MENU
 
 async def set_strategy_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يقوم بتحميل ملف التعريف المختار."""
+    state = subscriber_state(update)
     query = update.callback_query
     await query.answer()
     
     profile_filename = query.data.replace("load_profile_", "")
-    if load_strategy_profile(profile_filename):
-        await query.edit_message_text(text=f"✅ تم تحميل ملف التعريف '{bot_state.get('profile_name')}' بنجاح.")
+    if load_strategy_profile(profile_filename, state):
+        prune_analysis_due()
+        await query.edit_message_text(text=f"✅ تم تحميل ملف التعريف '{state.get('profile_name')}' بنجاح.")
     else:
         await query.edit_message_text(text=f"❌ فشل تحميل ملف التعريف '{profile_filename}'.")
         
@@ -561,9 +2934,10 @@ async def set_strategy_profile(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def set_confidence_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يعرض قائمة تحديد عتبات الثقة باستخدام أزرار مضمنة."""
+    state = subscriber_state(update)
     setting_type = 'initial' if 'الأولية' in update.message.text else 'final'
     setting_key = 'initial_confidence' if setting_type == 'initial' else 'confirmation_confidence'
-    current = bot_state.get(setting_key, 2)
+    current = state.get(setting_key, 2)
     title = "عتبة الإشارة الأولية" if setting_type == 'initial' else "عتبة التأكيد النهائي"
     
     keyboard = []
@@ -580,6 +2954,7 @@ async def set_confidence_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def set_confidence_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يضبط قيمة عتبة الثقة."""
+    state = subscriber_state(update)
     query = update.callback_query
     await query.answer()
     
@@ -587,7 +2962,7 @@ async def set_confidence_value(update: Update, context: ContextTypes.DEFAULT_TYP
     value = int(value_str)
     setting_key = 'initial_confidence' if setting_type == 'initial' else 'confirmation_confidence'
     
-    bot_state[setting_key] = value
+    state[setting_key] = value
     save_bot_state()
     
     title = "الإشارة الأولية" if setting_type == 'initial' else "التأكيد النهائي"
@@ -599,7 +2974,8 @@ async def set_confidence_value(update: Update, context: ContextTypes.DEFAULT_TYP
 # --- الجزء الذي أعيد تصميمه بالكامل ---
 async def set_indicator_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يعرض قائمة تعديل المؤشرات باستخدام أزرار مضمنة (الطريقة الجديدة)."""
-    params = bot_state.get('indicator_params', {})
+    state = subscriber_state(update)
+    params = state.get('indicator_params', {})
     keyboard = []
     for key, value in params.items():
         text = f"{key.replace('_', ' ').title()} ({value})"
@@ -615,13 +2991,14 @@ async def set_indicator_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def handle_indicator_selection(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يتعامل مع اختيار المؤشر من القائمة المضمنة."""
+    state = subscriber_state(update)
     query = update.callback_query
     await query.answer()
     
     # استخراج اسم المؤشر من بيانات الكول باك
     param_key = query.data.replace("set_indicator_", "")
     
-    if param_key in bot_state.get('indicator_params', {}):
+    if param_key in state.get('indicator_params', {}):
         # تخزين المؤشر المختار في user_data
         context.user_data['param_to_set'] = param_key
         
@@ -637,6 +3014,7 @@ async def handle_indicator_selection(update: Update, context: ContextTypes.DEFAU
 
 async def receive_new_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يستقبل القيمة الرقمية الجديدة للمؤشر."""
+    state = subscriber_state(update)
     param_key = context.user_data.get('param_to_set')
     if not param_key:
         # إذا لم يكن هناك مؤشر قيد التعديل، تجاهل الرسالة
@@ -644,7 +3022,8 @@ async def receive_new_value(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     try:
         new_value = int(update.message.text)
-        bot_state['indicator_params'][param_key] = new_value
+        state['indicator_params'][param_key] = new_value
+        prune_analysis_due()
         save_bot_state()
         await update.message.reply_text(f"✅ تم حفظ القيمة الجديدة لـ **{param_key}**: {new_value}", parse_mode='Markdown')
         
@@ -660,7 +3039,8 @@ async def receive_new_value(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def set_macd_strategy_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يعرض قائمة استراتيجية الماكد باستخدام أزرار مضمنة."""
-    current_strategy = bot_state.get('macd_strategy', 'dynamic')
+    state = subscriber_state(update)
+    current_strategy = state.get('macd_strategy', 'dynamic')
     keyboard = [
         [InlineKeyboardButton(f"ديناميكي (جودة عالية) {'✅' if current_strategy == 'dynamic' else ''}", callback_data="set_macd_dynamic")],
         [InlineKeyboardButton(f"بسيط (كمية أكبر) {'✅' if current_strategy == 'simple' else ''}", callback_data="set_macd_simple")],
@@ -672,11 +3052,12 @@ async def set_macd_strategy_menu(update: Update, context: ContextTypes.DEFAULT_T
 
 async def set_macd_strategy_value(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """يضبط استراتيجية الماكد."""
+    state = subscriber_state(update)
     query = update.callback_query
     await query.answer()
     
     new_strategy = query.data.replace("set_macd_", "")
-    bot_state['macd_strategy'] = new_strategy
+    state['macd_strategy'] = new_strategy
     save_bot_state()
     
     await query.edit_message_text(text=f"✅ تم تحديث استراتيجية الماكد إلى: {new_strategy}")
@@ -685,23 +3066,59 @@ async def set_macd_strategy_value(update: Update, context: ContextTypes.DEFAULT_
 
 # --- باقي الدوال المساعدة ---
 async def show_statistics(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if not signals_statistics:
+    # كل الأرقام من جدول signal_daily المجمع (صف لكل يوم ومشترك وزوج وجلسة ونتيجة) وليس من سجل الإشارات الكامل.
+    chat_id = str(update.effective_chat.id)
+    totals_sql = ("SELECT {group}, SUM(CASE WHEN kind = 'initial' THEN count ELSE 0 END), "
+                  "SUM(CASE WHEN kind = 'confirmation' AND outcome = 'confirmed' THEN count ELSE 0 END), "
+                  "SUM(CASE WHEN kind = 'confirmation' AND outcome = 'failed' THEN count ELSE 0 END), "
+                  "SUM(CASE WHEN kind = 'confirmation' AND outcome = 'expired' THEN count ELSE 0 END) "
+                  "FROM signal_daily WHERE subscriber = ? {where} GROUP BY {group} ORDER BY {group}")
+    rows = await signal_store.query(totals_sql.format(where='', group='pair'), (chat_id,))
+    if not rows:
         await update.message.reply_text("لا توجد إحصائيات لعرضها حتى الآن.")
         return SELECTING_ACTION
 
     message = "📊 **إحصائيات البوت**:\n\n"
-    totals = {'initial': 0, 'confirmed': 0, 'failed': 0}
-    for pair, stats in signals_statistics.items():
-        initial, confirmed, failed = stats.get('initial', 0), stats.get('confirmed', 0), stats.get('failed_confirmation', 0)
-        totals['initial'] += initial; totals['confirmed'] += confirmed; totals['failed'] += failed
+    totals = {'initial': 0, 'confirmed': 0, 'failed': 0, 'expired': 0}
+    for pair, initial, confirmed, failed, expired in rows:
+        totals['initial'] += initial; totals['confirmed'] += confirmed; totals['failed'] += failed; totals['expired'] += expired
         if initial > 0:
-            message += f"🔹 **{pair}**: أولية: {initial}, مؤكدة: {confirmed}, فاشلة: {failed}\n"
+            message += f"🔹 **{pair}**: أولية: {initial}, مؤكدة: {confirmed}, فاشلة: {failed}, منتهية: {expired}\n"
 
     message += f"\n**المجموع الكلي:**\n- إجمالي الإشارات الأولية: {totals['initial']}\n- إجمالي الإشارات المؤكدة: {totals['confirmed']}\n"
+    if totals['expired'] > 0: message += f"- تأكيدات انتهت صلاحيتها: {totals['expired']}\n"
     if totals['initial'] > 0:
         rate = (totals['confirmed'] / totals['initial']) * 100
         message += f"- نسبة نجاح التأكيد: {rate:.2f}%\n"
 
+    week_ago = (datetime.now(timezone.utc) - timedelta(days=7)).strftime('%Y-%m-%d')
+    sessions = await signal_store.query(totals_sql.format(where='AND day >= ?', group='session'), (chat_id, week_ago))
+    if sessions:
+        message += "\n**آخر 7 أيام حسب الجلسة:**\n"
+        for session, initial, confirmed, failed, expired in sessions:
+            rate = f"{(confirmed / initial) * 100:.0f}%" if initial else "-"
+            message += f"- {SESSION_NAMES.get(session, session)}: أولية {initial}، مؤكدة {confirmed} ({rate})\n"
+
+    # كل الملفات، والنشط منها، مقيّمة بالطريقة نفسها في التقييم الظلي؛ إشارات المشترك الحية لا تدخل المقارنة.
+    profiles = await signal_store.query(
+        "SELECT profile, SUM(count), SUM(CASE WHEN outcome = 'confirmed' THEN count ELSE 0 END) AS confirmed FROM profile_daily "
+        "WHERE day >= ? GROUP BY profile HAVING SUM(count) > 0 ORDER BY confirmed * 1.0 / SUM(count) DESC", (week_ago,))
+    if profiles:
+        active = subscribers.get(chat_id, bot_state).get('profile_name')
+        message += "\n**مقارنة ملفات الاستراتيجية (آخر 7 أيام):**\n"
+        for profile, initial, confirmed in profiles:
+            role = "نشط" if profile == active else "ظل"
+            message += f"- {profile} ({role}): أولية {initial}، مؤكدة {confirmed} ({(confirmed / initial) * 100:.0f}%)\n"
+
+    month_ago = (datetime.now(timezone.utc) - timedelta(days=30)).timestamp()
+    failed_votes = await signal_store.query(
+        "SELECT votes, COUNT(*) FROM signals WHERE kind = 'initial' AND outcome = 'failed' AND ts >= ? AND subscriber = ? AND votes != '' "
+        "GROUP BY votes ORDER BY COUNT(*) DESC LIMIT 3", (month_ago, chat_id))
+    if failed_votes:
+        message += "\n**أكثر الأصوات في الإشارات التي فشل تأكيدها (30 يوماً):**\n"
+        for votes, count in failed_votes:
+            message += f"- {votes.replace(',', ' + ')}: {count}\n"
+
     await update.message.reply_text(message, parse_mode='Markdown')
     return SELECTING_ACTION
 
@@ -720,7 +3137,19 @@ async def done(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def post_init(application: Application) -> None:
     logger.info("Application initialized. Starting background tasks.")
     context = ContextTypes.DEFAULT_TYPE(application=application)
+    await restore_shadow_pending()
     asyncio.create_task(governor_loop(context))
+    asyncio.create_task(confirmation_loop(context))
+    asyncio.create_task(event_loop_lag_monitor())
+    asyncio.create_task(market_snapshot_loop())
+
+async def post_shutdown(application: Application) -> None:
+    if profiler.running: profiler.stop()
+    await polygon_client.close()
+    compute_stage.close()
+    await save_market_snapshot()
+    await shutdown_state_persistence()
+    await signal_store.close()
 
 # --- نقطة انطلاق البوت ---
 def main() -> None:
@@ -729,10 +3158,13 @@ def main() -> None:
         return
 
     load_bot_state()
+    if signal_store.open(legacy_signals_statistics) and legacy_signals_statistics:
+        logger.info(f"سجل الإشارات: نُقلت إحصائيات {len(legacy_signals_statistics)} زوج من ملف الحالة.")
+        legacy_signals_statistics.clear()
+        save_bot_state()
+    load_market_snapshot()
     
-    application = Application.builder().token(TELEGRAM_TOKEN).post_init(post_init).build()
-    
-    application.bot_data['pair_index'] = 0
+    application = Application.builder().token(TELEGRAM_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
     
     logic_interval = bot_state.get('scan_interval_seconds', 5)
     application.job_queue.run_repeating(logic_loop, interval=logic_interval, first=5)
@@ -758,6 +3190,8 @@ def main() -> None:
                 MessageHandler(filters.Regex(r'^تحديد عتبة'), set_confidence_menu),
                 MessageHandler(filters.Regex(r'^تعديل قيم المؤشرات$'), set_indicator_menu),
                 MessageHandler(filters.Regex(r'^📊 استراتيجية الماكد$'), set_macd_strategy_menu),
+                MessageHandler(filters.Regex(r'^📡 مصدر البيانات$'), data_mode_menu),
+                MessageHandler(filters.Regex(r'^👥 التقييم الظلي$'), toggle_shadow_mode),
                 MessageHandler(filters.Regex(r'^العودة إلى القائمة الرئيسية$'), start),
             ],
             AWAITING_VALUE: [
@@ -769,19 +3203,26 @@ def main() -> None:
         allow_reentry=True
     )
 
+    application.add_handler(TypeHandler(Update, reject_unknown_chat), group=-1)
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler('traces', show_traces))
+    application.add_handler(CommandHandler('profile', start_profiling))
     
     application.add_handler(CallbackQueryHandler(set_trend_filter_mode, pattern=r'^set_trend_'))
     application.add_handler(CallbackQueryHandler(set_strategy_profile, pattern=r'^load_profile_'))
     application.add_handler(CallbackQueryHandler(set_confidence_value, pattern=r'^set_conf_'))
     application.add_handler(CallbackQueryHandler(set_macd_strategy_value, pattern=r'^set_macd_'))
+    application.add_handler(CallbackQueryHandler(set_data_mode, pattern=r'^set_data_mode_'))
     application.add_handler(CallbackQueryHandler(start, pattern=r'^main_menu$'))
 
+    logger.info("البوت (إصدار v5.0 النهائي) جاهز للعمل...")
+    if TELEGRAM_WEBHOOK_URL:
+        asyncio.run(run_webhook(application))
+        return
+
     flask_thread = Thread(target=run_flask_app)
     flask_thread.daemon = True
     flask_thread.start()
-
-    logger.info("البوت (إصدار v5.0 النهائي) جاهز للعمل...")
     application.run_polling()
 
 if __name__ == '__main__':
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+# ALNUSIRY BOT - محسّن الإعدادات (Sweep / Optimizer)
+# يقيّم شبكة أو عينة عشوائية من نسخ ملف الاستراتيجية على البيانات التاريخية بقواعد backtest.py نفسها،
+# ويرتب النتائج ويكتب الأفضل كملفات JSON جديدة في strategies/ تظهر مباشرة في قائمة ملفات البوت.
+#
+# التوازي: الشموع تُحمّل مرة واحدة في ذاكرة مشتركة (shared_memory) وكل عامل يقرأها كعروض numpy دون نسخ.
+# النسخ تُجمع حسب إعدادات المؤشرات: كل مجموعة مهمة واحدة تحسب المؤشرات والاتجاهات مرة واحدة،
+# ثم تقيّم كل عتبات الثقة وأوضاع فلتر الاتجاه عليها (عمليات مصفوفات رخيصة).
+#
+# الاستخدام:
+#   python optimize.py --data-dir data --base default.json --random 200 --workers 8 --top 3
+
+import argparse
+import copy
+import itertools
+import json
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from main import STRATEGIES_DIR, USER_DEFINED_PAIRS
+from backtest import PRICE_COLUMNS, FORWARD_HORIZONS, load_history, load_profile, raw_scores, pair_trends, evaluate_signals
+
+FRAME_COLUMNS = list(PRICE_COLUMNS) + ['Volume']
+# المفاتيح التي تغير المؤشرات نفسها (مكلفة)؛ الباقي عتبات تُقيّم على نفس المؤشرات.
+HEAVY_KEYS = ('macd_strategy',)
+CHEAP_KEYS = ('trend_filter_mode', 'initial_confidence', 'confirmation_confidence', 'confirmation_minutes')
+DEFAULT_SEARCH_SPACE = {
+    'rsi_period': [9, 14, 21],
+    'macd_fast': [8, 12],
+    'macd_slow': [21, 26],
+    'macd_signal': [9],
+    'bollinger_period': [20],
+    'stochastic_period': [14],
+    'adx_period': [14],
+    'm15_ema_period': [20, 50],
+    'h1_ema_period': [50],
+    'macd_strategy': ['dynamic', 'simple'],
+    'trend_filter_mode': ['NONE', 'M15', 'H1', 'M15_H1'],
+    'initial_confidence': [2, 3],
+    'confirmation_confidence': [2, 3, 4],
+}
+METRICS = ('t_stat', 'mean_bps', 'hit_rate', 'confirmation_rate')
+
+# --- الذاكرة المشتركة ---
+def share_histories(histories: dict) -> (list, dict):
+    """ينسخ كل الشموع مرة واحدة إلى مقطعي ذاكرة مشتركة ويعيد (المقاطع، وصف المواقع لكل زوج وإطار)."""
+    total = sum(len(df) for df in histories.values())
+    prices = shared_memory.SharedMemory(create=True, size=max(1, total * len(FRAME_COLUMNS) * 8))
+    times = shared_memory.SharedMemory(create=True, size=max(1, total * 8))
+    price_array = np.ndarray((len(FRAME_COLUMNS), total), dtype=np.float64, buffer=prices.buf)
+    time_array = np.ndarray((total,), dtype=np.int64, buffer=times.buf)
+    layout = {'prices': prices.name, 'times': times.name, 'total': total, 'frames': {}}
+    offset = 0
+    for key, df in histories.items():
+        count = len(df)
+        price_array[:, offset:offset + count] = df[FRAME_COLUMNS].to_numpy(dtype=np.float64).T
+        time_array[offset:offset + count] = df.index.as_unit('ns').asi8
+        layout['frames'][key] = (offset, count)
+        offset += count
+    return [prices, times], layout
+
+def attach_histories(layout: dict) -> (list, dict):
+    """يبني DataFrame لكل زوج وإطار فوق الذاكرة المشتركة مباشرة (الأسعار عروض وليست نسخاً)."""
+    segments = [shared_memory.SharedMemory(name=layout['prices']), shared_memory.SharedMemory(name=layout['times'])]
+    price_array = np.ndarray((len(FRAME_COLUMNS), layout['total']), dtype=np.float64, buffer=segments[0].buf)
+    time_array = np.ndarray((layout['total'],), dtype=np.int64, buffer=segments[1].buf)
+    frames = {}
+    for key, (offset, count) in layout['frames'].items():
+        index = pd.DatetimeIndex(time_array[offset:offset + count].view('datetime64[ns]'), name='datetime').tz_localize('UTC')
+        frames[key] = pd.DataFrame(price_array[:, offset:offset + count].T, index=index, columns=FRAME_COLUMNS, copy=False)
+    return segments, frames
+
+# --- العامل ---
+_worker = {}
+
+def init_worker(layout: dict, pairs: list, start: str, end: str, horizon: int):
+    segments, frames = attach_histories(layout)
+    _worker.update({'segments': segments, 'horizon': horizon, 'pairs': []})
+    for pair in pairs:
+        m5 = frames.get((pair, 'M5'))
+        if m5 is None: continue
+        window = np.ones(len(m5), dtype=bool)
+        if start: window &= m5.index >= pd.Timestamp(start, tz='UTC')
+        if end: window &= m5.index < pd.Timestamp(end, tz='UTC')
+        _worker['pairs'].append((m5, frames.get((pair, 'M15')), frames.get((pair, 'H1')), window))
+
+def variant_metrics(signals: list, horizon: int) -> dict:
+    confirmed = np.concatenate([s['confirmed'] for s in signals]) if signals else np.zeros(0, dtype=bool)
+    returns = np.concatenate([s['returns'][horizon][s['confirmed']] for s in signals]) if signals else np.zeros(0)
+    returns = returns[np.isfinite(returns)]
+    metrics = {'initial': int(len(confirmed)), 'confirmed': int(confirmed.sum()),
+               'confirmation_rate': float(confirmed.mean()) if len(confirmed) else 0.0,
+               'mean_bps': float(returns.mean()) if len(returns) else 0.0,
+               'hit_rate': float((returns > 0).mean()) if len(returns) else 0.0, 't_stat': 0.0}
+    if len(returns) > 1 and returns.std(ddof=1) > 0:
+        metrics['t_stat'] = float(returns.mean() / (returns.std(ddof=1) / np.sqrt(len(returns))))
+    return metrics
+
+def evaluate_group(task: tuple) -> list:
+    """مهمة واحدة: إعدادات مؤشرات ثابتة مع كل عتباتها. يعيد [(النسخة، المقاييس)]."""
+    heavy, variants = task
+    started = time.process_time()
+    params = heavy['indicator_params']
+    prepared = []
+    for m5, m15, h1, window in _worker['pairs']:
+        raw_buy, raw_sell = raw_scores(m5, heavy)
+        prepared.append((m5['Close'].to_numpy(), raw_buy, raw_sell, *pair_trends(m5, m15, h1, params), window))
+
+    results = []
+    for cheap in variants:
+        profile = {**heavy, **cheap}
+        signals = [evaluate_signals(close, raw_buy, raw_sell, trend_m15, trend_h1, profile, window)
+                   for close, raw_buy, raw_sell, trend_m15, trend_h1, window in prepared]
+        results.append((cheap, variant_metrics(signals, _worker['horizon'])))
+    return heavy, results, time.process_time() - started
+
+# --- توليد النسخ ---
+def load_search_space(path: str) -> dict:
+    space = dict(DEFAULT_SEARCH_SPACE)
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            space.update(json.load(f))
+    return space
+
+def generate_variants(space: dict, samples: int = None, seed: int = 0) -> list:
+    """كل النسخ (شبكة كاملة) أو عينة عشوائية بلا تكرار. كل نسخة قاموس {المفتاح: القيمة}."""
+    keys = list(space)
+    grid_size = int(np.prod([len(space[k]) for k in keys]))
+    if samples is None or samples >= grid_size:
+        return [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+    rng = random.Random(seed)
+    chosen = set()
+    while len(chosen) < samples:
+        chosen.add(tuple(rng.choice(space[k]) for k in keys))
+    return [dict(zip(keys, values)) for values in sorted(chosen, key=str)]
+
+def group_variants(variants: list, base: dict) -> list:
+    """يجمع النسخ حسب إعدادات المؤشرات: [(ملف أساس بمؤشراته، [عتبات...])]."""
+    groups = {}
+    for variant in variants:
+        heavy = copy.deepcopy({k: v for k, v in base.items() if k not in CHEAP_KEYS})
+        for key, value in variant.items():
+            if key in CHEAP_KEYS: continue
+            if key in HEAVY_KEYS: heavy[key] = value
+            else: heavy.setdefault('indicator_params', {})[key] = value
+        # macd_slow يجب أن يكون أبطأ من macd_fast.
+        if heavy['indicator_params'].get('macd_fast', 12) >= heavy['indicator_params'].get('macd_slow', 26): continue
+        group_key = json.dumps(heavy, sort_keys=True)
+        groups.setdefault(group_key, (heavy, []))[1].append({k: v for k, v in variant.items() if k in CHEAP_KEYS})
+    return list(groups.values())
+
+# --- الترتيب والكتابة ---
+def write_profiles(ranked: list, base: dict, metric: str, top: int) -> list:
+    stamp = datetime.now().strftime('%Y%m%d_%H%M')
+    if not os.path.exists(STRATEGIES_DIR): os.makedirs(STRATEGIES_DIR)
+    written = []
+    for rank, (heavy, cheap, metrics) in enumerate(ranked[:top], start=1):
+        profile = copy.deepcopy(base)
+        profile.update(copy.deepcopy(heavy))
+        profile.update(cheap)
+        # الاسم يُعرض بوضع Markdown في تيليجرام، والشرطة السفلية وحدها تُفسد التنسيق
+        profile['profile_name'] = f"محسّن #{rank} ({metric.replace('_', ' ')}={metrics[metric]:.2f})"
+        filename = f"optimized_{stamp}_{rank}.json"
+        with open(os.path.join(STRATEGIES_DIR, filename), 'w', encoding='utf-8') as f:
+            json.dump(profile, f, indent=4, ensure_ascii=False)
+        written.append(filename)
+    return written
+
+def describe(heavy: dict, cheap: dict) -> str:
+    params = heavy['indicator_params']
+    return (f"RSI {params.get('rsi_period')}، MACD {params.get('macd_fast')}/{params.get('macd_slow')}/{params.get('macd_signal')} "
+            f"{heavy.get('macd_strategy')}، EMA {params.get('m15_ema_period')}/{params.get('h1_ema_period')}، "
+            f"فلتر {cheap.get('trend_filter_mode')}، ثقة {cheap.get('initial_confidence')}/{cheap.get('confirmation_confidence')}")
+
+def main():
+    parser = argparse.ArgumentParser(description="بحث شبكي أو عشوائي عن أفضل إعدادات ملف الاستراتيجية.")
+    parser.add_argument('--data-dir', default='data', help="مجلد ملفات الشموع (EURUSD_M5.csv ...)")
+    parser.add_argument('--base', default='default.json', help="ملف الاستراتيجية الأساسي الذي تُشتق منه النسخ")
+    parser.add_argument('--pairs', default=",".join(USER_DEFINED_PAIRS), help="أزواج مفصولة بفواصل")
+    parser.add_argument('--start', help="بداية الفترة (UTC)")
+    parser.add_argument('--end', help="نهاية الفترة (UTC)، غير شاملة")
+    parser.add_argument('--space', help="ملف JSON يستبدل قيم فضاء البحث الافتراضي")
+    parser.add_argument('--random', type=int, help="عدد النسخ العشوائية بدل الشبكة الكاملة")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--horizon', type=int, choices=FORWARD_HORIZONS, default=6, help="أفق العائد بعدد شموع M5 (من آفاق backtest.py)")
+    parser.add_argument('--metric', choices=METRICS, default='t_stat')
+    parser.add_argument('--min-signals', type=int, default=30, help="أقل عدد إشارات مؤكدة لقبول النسخة")
+    parser.add_argument('--top', type=int, default=3, help="عدد أفضل النسخ التي تُكتب في strategies/")
+    parser.add_argument('--dry-run', action='store_true', help="عرض الترتيب فقط دون كتابة ملفات")
+    args = parser.parse_args()
+
+    base = load_profile(args.base)
+    pairs = [p.strip() for p in args.pairs.split(',') if p.strip()]
+    groups = group_variants(generate_variants(load_search_space(args.space), args.random, args.seed), base)
+    print(f"النسخ: {sum(len(v) for _, v in groups)} في {len(groups)} مجموعة مؤشرات، العمال: {args.workers}")
+
+    started = time.perf_counter()
+    histories = {}
+    for pair in pairs:
+        for timeframe in ('M5', 'M15', 'H1'):
+            df = load_history(args.data_dir, pair, timeframe)
+            if df is not None and not df.empty: histories[(pair, timeframe)] = df
+    segments, layout = share_histories(histories)
+    del histories
+    print(f"تحميل البيانات إلى الذاكرة المشتركة: {time.perf_counter() - started:.2f} ث")
+
+    ranked, compute_seconds = [], 0.0
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                 initargs=(layout, pairs, args.start, args.end, args.horizon)) as pool:
+            for heavy, results, seconds in pool.map(evaluate_group, groups):
+                compute_seconds += seconds
+                ranked.extend((heavy, cheap, metrics) for cheap, metrics in results if metrics['confirmed'] >= args.min_signals)
+    finally:
+        for segment in segments:
+            segment.close()
+            segment.unlink()
+
+    elapsed = time.perf_counter() - started
+    ranked.sort(key=lambda item: item[2][args.metric], reverse=True)
+    print(f"المدة: {elapsed:.2f} ث (وقت المعالج في العمال {compute_seconds:.2f} ث، كفاءة التوازي "
+          f"{compute_seconds / elapsed / args.workers * 100:.0f}%)")
+    print(f"النسخ المقبولة (≥ {args.min_signals} إشارة مؤكدة): {len(ranked)}")
+    for rank, (heavy, cheap, metrics) in enumerate(ranked[:max(args.top, 10)], start=1):
+        print(f"{rank:>3}. {args.metric}={metrics[args.metric]:+.3f}  مؤكدة {metrics['confirmed']}/{metrics['initial']}  "
+              f"متوسط {metrics['mean_bps']:+.2f} bps  إصابة {metrics['hit_rate'] * 100:.1f}%  |  {describe(heavy, cheap)}")
+
+    if ranked and not args.dry_run:
+        for filename in write_profiles(ranked, base, args.metric, args.top):
+            print(f"تمت كتابة {os.path.join(STRATEGIES_DIR, filename)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(autouse=True)
+def isolated_workdir(tmp_path, monkeypatch):
+    # البوت يكتب signals.db و bot_state.json في مجلد العمل؛ كل اختبار يعمل في مجلد مؤقت خاص به.
+    monkeypatch.chdir(tmp_path)
+
+def make_candles(bars: int, seed: int = 7, start: str = '2024-01-01', freq: str = '5min') -> pd.DataFrame:
+    """شموع عشوائية (مسار عشوائي) بفهرس زمني UTC كما تعيدها execute_get_forex_data."""
+    rng = np.random.default_rng(seed)
+    close = 1.1 + np.cumsum(rng.normal(0, 0.0005, bars))
+    open_ = np.concatenate([[close[0]], close[:-1]])
+    spread = np.abs(rng.normal(0, 0.0003, (2, bars)))
+    index = pd.date_range(start, periods=bars, freq=freq, tz='UTC', name='datetime')
+    return pd.DataFrame({'Open': open_, 'High': np.maximum(open_, close) + spread[0],
+                         'Low': np.minimum(open_, close) - spread[1], 'Close': close,
+                         'Volume': rng.integers(50, 500, bars).astype(float)}, index=index)
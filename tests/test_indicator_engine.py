@@ -0,0 +1,63 @@
+import math
+
+import main
+from conftest import make_candles
+
+PARAMS = {'rsi_period': 14, 'macd_fast': 12, 'macd_slow': 26, 'macd_signal': 9,
+          'bollinger_period': 20, 'stochastic_period': 14, 'adx_period': 14}
+WINDOW = 200
+# المحرك المتدفق يطابق ta إلا في أخطاء التقريب العشري المتراكمة (المجاميع المزاحة وتنعيم Wilder).
+TOLERANCE = 1e-7
+
+def assert_rows_close(streamed, reference, where):
+    for col in ('Close',) + main.INDICATOR_COLUMNS:
+        assert math.isclose(streamed[col], reference[col], rel_tol=TOLERANCE, abs_tol=TOLERANCE), \
+            f"{col} عند {where}: {streamed[col]} != {reference[col]}"
+
+def test_streaming_matches_full_recompute():
+    df = make_candles(500)
+    engine = main.IndicatorEngine(PARAMS)
+    # كما في التشغيل الفعلي: نافذة منزلقة من آخر WINDOW شمعة تتقدم شمعة واحدة كل مرة.
+    for end in range(WINDOW, len(df) + 1):
+        last, prev = engine.process(df.iloc[end - WINDOW:end])
+        ref_last, ref_prev = main.compute_indicator_rows(df.iloc[:end].copy(), PARAMS)
+        assert_rows_close(last, ref_last, df.index[end - 1])
+        assert_rows_close(prev, ref_prev, df.index[end - 1])
+
+def test_votes_match_full_recompute():
+    df = make_candles(400, seed=11)
+    engine = main.IndicatorEngine(PARAMS)
+    for end in range(WINDOW, len(df) + 1):
+        last, prev = engine.process(df.iloc[end - WINDOW:end])
+        ref_last, ref_prev = main.compute_indicator_rows(df.iloc[:end].copy(), PARAMS)
+        for strategy in ('dynamic', 'simple'):
+            assert main.indicator_votes(last, prev, strategy) == main.indicator_votes(ref_last, ref_prev, strategy)
+
+def test_committed_last_bar_does_not_rebuild():
+    df = make_candles(300)
+    engine = main.IndicatorEngine(PARAMS)
+    engine.process(df.iloc[:250])
+    committed = engine.last_timestamp
+    state_before = engine.rsi
+    # إطار ينتهي عند آخر شمعة مثبتة (بعد حذف الشمعة المتكونة مثلاً) لا يعيد بناء الحالة.
+    last, prev = engine.process(df.loc[:committed].iloc[-WINDOW:])
+    assert engine.rsi is state_before and engine.last_timestamp == committed
+    ref_last, ref_prev = main.compute_indicator_rows(df.loc[:committed].copy(), PARAMS)
+    assert_rows_close(last, ref_last, committed)
+    assert_rows_close(prev, ref_prev, committed)
+    # والتقدم بعدها يكمل من الحالة نفسها.
+    last, _ = engine.process(df.iloc[51:251])
+    assert engine.rsi is state_before
+    assert_rows_close(last, main.compute_indicator_rows(df.iloc[:251].copy(), PARAMS)[0], df.index[250])
+
+def test_prune_drops_engines_no_running_subscriber_uses(monkeypatch):
+    params, other = PARAMS, {**PARAMS, 'rsi_period': 7}
+    monkeypatch.setattr(main, 'TELEGRAM_SUBSCRIBER_IDS', {'1', '2'})
+    monkeypatch.setattr(main, 'subscribers', {'1': {'is_running': True, 'selected_pairs': ['EUR/USD'], 'indicator_params': params},
+                                              '2': {'is_running': False, 'selected_pairs': ['USD/JPY'], 'indicator_params': other}})
+    monkeypatch.setattr(main, 'indicator_engines', {})
+    kept = main.get_indicator_engine('EUR/USD', params)
+    for pair, engine_params in (('EUR/USD', other), ('USD/JPY', other), ('USD/JPY', params)):
+        main.get_indicator_engine(pair, engine_params)
+    main.prune_analysis_due()
+    assert list(main.indicator_engines.values()) == [kept]
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+import main
+from conftest import make_candles
+
+def save_and_restore(monkeypatch, frames: dict) -> bool:
+    monkeypatch.setattr(main, 'candle_cache', dict(frames))
+    monkeypatch.setattr(main, 'trend_cache', {})
+    monkeypatch.setattr(main, 'last_scored_bars', {pair: df.index[-1] for (pair, _), df in frames.items()})
+    main.write_market_snapshot(*main.collect_market_snapshot())
+    monkeypatch.setattr(main, 'candle_cache', {})
+    monkeypatch.setattr(main, 'last_scored_bars', {})
+    return main.load_market_snapshot()
+
+def backing_memmap(array: np.ndarray) -> np.memmap:
+    while array is not None and not isinstance(array, np.memmap): array = array.base
+    return array
+
+def test_round_trip_restores_candles_and_scored_bars(monkeypatch):
+    frames = {('EUR/USD', 'M5'): make_candles(300, seed=1), ('USD/JPY', 'M5'): make_candles(120, seed=2)}
+    assert save_and_restore(monkeypatch, frames)
+    for key, df in frames.items():
+        pd.testing.assert_frame_equal(main.candle_cache[key], df, check_freq=False, check_index_type=False)
+        assert main.last_scored_bars[key[0]] == df.index[-1]
+
+def test_restored_columns_are_views_on_the_file(monkeypatch):
+    assert save_and_restore(monkeypatch, {('EUR/USD', 'M5'): make_candles(300)})
+    restored = main.candle_cache[('EUR/USD', 'M5')]
+    mapped = {id(backing_memmap(restored[col].to_numpy())) for col in main.CANDLE_COLUMNS}
+    assert len(mapped) == 1 and None not in mapped
+    assert backing_memmap(restored['Close'].to_numpy()).filename.endswith(main.MARKET_SNAPSHOT_FILE)
+    # والتحليل يقرأ العروض نفسها: مقطع النافذة لا ينسخ.
+    window = restored.iloc[-main.ANALYSIS_BARS:]
+    assert np.shares_memory(window['Close'].to_numpy(), restored['Close'].to_numpy())
+
+def test_writes_to_restored_history_do_not_touch_the_file(monkeypatch):
+    assert save_and_restore(monkeypatch, {('EUR/USD', 'M5'): make_candles(300)})
+    with open(main.MARKET_SNAPSHOT_FILE, 'rb') as f: before = f.read()
+    restored = main.candle_cache[('EUR/USD', 'M5')]
+    restored.loc[restored.index[-1], 'High'] = 99.0
+    assert restored['High'].iloc[-1] == 99.0
+    with open(main.MARKET_SNAPSHOT_FILE, 'rb') as f: assert f.read() == before
+
+def test_corrupt_snapshot_is_ignored(monkeypatch):
+    with open(main.MARKET_SNAPSHOT_FILE, 'wb') as f: f.write(b'NOTASNAP' + b'\0' * 64)
+    monkeypatch.setattr(main, 'candle_cache', {})
+    assert not main.load_market_snapshot()
+    assert main.candle_cache == {}
@@ -0,0 +1,124 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+from aiohttp import web
+
+import main
+
+@asynccontextmanager
+async def stub_polygon(responses: list):
+    """خادم Polygon محلي يرد بالترتيب من responses (الأخير يتكرر) ويسجل الطلبات التي وصلته."""
+    seen = []
+
+    async def handler(request: web.Request) -> web.Response:
+        seen.append(request)
+        status, body, headers = responses[min(len(seen), len(responses)) - 1]
+        if isinstance(body, dict): return web.json_response(body, status=status, headers=headers)
+        return web.Response(status=status, text=body, headers=headers)
+
+    app = web.Application()
+    app.router.add_get('/{tail:.*}', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield f"http://127.0.0.1:{port}", seen
+    finally:
+        await runner.cleanup()
+
+def aggregates(bars: int) -> dict:
+    start = 1_704_067_200_000
+    return {'status': 'OK', 'results': [{'t': start + i * 300_000, 'o': 1.1, 'h': 1.2, 'l': 1.0, 'c': 1.15, 'v': 10}
+                                        for i in range(bars)]}
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(main, 'HTTP_BACKOFF_SECONDS', 0.01)
+
+def run_with_client(scenario):
+    async def go():
+        client = main.PolygonClient('test-key')
+        try:
+            return await scenario(client)
+        finally:
+            await client.close()
+    return asyncio.run(go())
+
+def test_success_sends_key_and_parses_json():
+    async def scenario(client):
+        async with stub_polygon([(200, aggregates(3), None)]) as (base_url, seen):
+            data = await client.get_json(f"{base_url}/v2/aggs/ticker/C:EURUSD/range/5/minute/1/2")
+            assert len(seen) == 1
+            assert seen[0].headers['Authorization'] == 'Bearer test-key'
+            assert seen[0].path == '/v2/aggs/ticker/C:EURUSD/range/5/minute/1/2'
+            return data
+    assert len(run_with_client(scenario)['results']) == 3
+
+def test_rate_limited_is_not_retried_and_carries_retry_after():
+    retries = []
+
+    async def scenario(client):
+        async with stub_polygon([(429, 'slow down', {'Retry-After': '7'})]) as (base_url, seen):
+            with pytest.raises(main.PolygonRateLimited) as raised:
+                await client.get_json(f"{base_url}/x", on_retry=lambda: retries.append(1))
+            assert len(seen) == 1
+            return raised.value
+    error = run_with_client(scenario)
+    assert error.status == 429 and error.retry_after == 7.0 and not retries
+
+def test_rate_limited_without_usable_retry_after():
+    async def scenario(client):
+        async with stub_polygon([(429, 'slow down', {'Retry-After': 'soon'})]) as (base_url, _):
+            with pytest.raises(main.PolygonRateLimited) as raised:
+                await client.get_json(f"{base_url}/x")
+            return raised.value
+    assert run_with_client(scenario).retry_after is None
+
+def test_server_error_is_retried_then_succeeds():
+    retries = []
+
+    async def scenario(client):
+        async with stub_polygon([(503, 'busy', None), (502, 'bad gateway', None), (200, {'ok': True}, None)]) as (base_url, seen):
+            data = await client.get_json(f"{base_url}/x", on_retry=lambda: retries.append(1))
+            assert len(seen) == 3
+            return data
+    assert run_with_client(scenario) == {'ok': True}
+    # كل إعادة محاولة تُحسب من حصة الطلبات.
+    assert len(retries) == 2
+
+def test_server_error_gives_up_after_max_retries():
+    async def scenario(client):
+        async with stub_polygon([(500, 'boom', None)]) as (base_url, seen):
+            with pytest.raises(main.PolygonHTTPError) as raised:
+                await client.get_json(f"{base_url}/x")
+            assert len(seen) == main.HTTP_MAX_RETRIES + 1
+            return raised.value
+    assert run_with_client(scenario).status == 500
+
+def test_client_error_is_not_retried():
+    async def scenario(client):
+        async with stub_polygon([(403, 'forbidden', None)]) as (base_url, seen):
+            with pytest.raises(main.PolygonHTTPError):
+                await client.get_json(f"{base_url}/x")
+            return len(seen)
+    assert run_with_client(scenario) == 1
+
+def test_forex_data_uses_base_url(monkeypatch):
+    async def scenario():
+        async with stub_polygon([(200, aggregates(250), None)]) as (base_url, seen):
+            monkeypatch.setattr(main, 'POLYGON_BASE_URL', base_url)
+            monkeypatch.setattr(main, 'POLYGON_API_KEY', 'test-key')
+            monkeypatch.setattr(main, 'polygon_client', main.PolygonClient('test-key'))
+            try:
+                df = await main.execute_get_forex_data('EUR/USD', 'M5', 200, SimpleNamespace(bot=None))
+            finally:
+                await main.polygon_client.close()
+                main.candle_cache.clear()
+            assert seen[0].path.startswith('/v2/aggs/ticker/C:EURUSD/range/5/minute/')
+            return df
+    df = asyncio.run(scenario())
+    assert len(df) == 200 and list(df.columns[:4]) == ['Open', 'High', 'Low', 'Close']
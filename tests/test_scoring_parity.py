@@ -0,0 +1,76 @@
+import pandas as pd
+
+import main
+from conftest import make_candles
+
+PARAMS = {'rsi_period': 14, 'macd_fast': 12, 'macd_slow': 26, 'macd_signal': 9,
+          'bollinger_period': 20, 'stochastic_period': 14, 'adx_period': 14}
+SETTINGS = {'indicator_params': PARAMS, 'macd_strategy': 'dynamic', 'trend_filter_mode': 'OFF'}
+# المحرك المتدفق يرى كل التاريخ منذ إنشائه، والمسار المتجه آخر ANALYSIS_BARS شمعة فقط:
+# الفرق أثر تهيئة المتوسطات الأسية، بنقاط المؤشر (0-100) للمذبذبات وبنسبة من السعر للباقي.
+OSCILLATOR_TOLERANCE = 0.01
+PRICE_TOLERANCE = 1e-6
+OSCILLATORS = ('rsi', 'stoch_k', 'stoch_d', 'adx', 'dmp', 'dmn')
+
+def panel_rows(window: pd.DataFrame) -> (dict, dict):
+    pairs, panel = main.build_price_panel({'X': window}, len(window))
+    ind = main.compute_panel_indicators(panel, PARAMS)
+    return ({col: ind[col][0, -1] for col in main.INDICATOR_COLUMNS},
+            {col: ind[col][0, -2] for col in main.INDICATOR_COLUMNS})
+
+def test_batch_matches_ta_on_the_same_window():
+    df = make_candles(300, seed=3)
+    for end in (200, 250, 300):
+        window = df.iloc[end - main.ANALYSIS_BARS:end]
+        last, _ = panel_rows(window)
+        ref_last, _ = main.compute_indicator_rows(window.copy(), PARAMS)
+        for col in main.INDICATOR_COLUMNS:
+            assert abs(last[col] - ref_last[col]) <= 1e-9 * max(1.0, abs(ref_last[col])), col
+
+def test_warm_engine_within_tolerance_of_batch():
+    for seed in range(3):
+        df = make_candles(800, seed=seed)
+        engine = main.IndicatorEngine(PARAMS)
+        # المحرك يكمل من آخر شمعة مثبتة حتى لو تقدمت النافذة عدة شموع، فنقارن كل رابع شمعة لتقصير الاختبار.
+        for end in range(main.ANALYSIS_BARS, len(df) + 1, 4):
+            window = df.iloc[end - main.ANALYSIS_BARS:end]
+            streamed, _ = engine.process(window)
+            batch, _ = panel_rows(window)
+            for col in main.INDICATOR_COLUMNS:
+                diff = abs(streamed[col] - batch[col])
+                limit = OSCILLATOR_TOLERANCE if col in OSCILLATORS else PRICE_TOLERANCE * abs(window['Close'].iloc[-1])
+                assert diff <= limit, f"{col} عند {window.index[-1]}: فرق {diff}"
+
+def test_scores_agree_between_paths():
+    for seed in range(3):
+        df = make_candles(700, seed=seed)
+        main.indicator_engines.clear()
+        for end in range(main.ANALYSIS_BARS, len(df) + 1, 2):
+            window = df.iloc[end - main.ANALYSIS_BARS:end]
+            streamed = main.analyze_signal_strength(window.copy(), 'NEUTRAL', 'NEUTRAL', 'X', None, SETTINGS)
+            assert streamed == main.score_pairs_batch({'X': window}, None, SETTINGS)['X'], window.index[-1]
+
+def test_pair_score_does_not_depend_on_batch_members():
+    long_df, short_df = make_candles(400, seed=1), make_candles(60, seed=2)
+    alone_details = {}
+    alone = main.score_pairs_batch({'A': long_df}, None, SETTINGS, alone_details)
+    together_details = {}
+    together = main.score_pairs_batch({'A': long_df, 'B': short_df}, None, SETTINGS, together_details)
+    assert together['A'] == alone['A']
+    assert together_details['A'] == alone_details['A']
+    assert together['B'] == main.score_pairs_batch({'B': short_df}, None, SETTINGS)['B']
+
+def test_rest_fetch_clears_minute_bucket_it_completes():
+    df = make_candles(50)
+    main.candle_cache[('EURUSD', 'M5')] = df.iloc[:-1]
+    start = df.index[-1]
+    main.snapshot_buckets['EURUSD'] = {'start': start, 'minutes': {start: {}}, 'has_base': False}
+    try:
+        tail = df.iloc[-2:]
+        candles = main.CandleArray.from_frame(tail)
+        main.merge_candles('EURUSD', 'M5', candles, 40)
+        assert 'EURUSD' not in main.snapshot_buckets
+        assert main.candle_cache[('EURUSD', 'M5')].index[-1] == start
+    finally:
+        main.candle_cache.clear()
+        main.snapshot_buckets.clear()
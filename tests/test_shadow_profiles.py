@@ -0,0 +1,58 @@
+import asyncio
+import json
+import os
+
+import pandas as pd
+
+import main
+
+PAIR = 'EUR/USD'
+BAR = pd.Timestamp('2024-01-01 10:00', tz='UTC')
+
+def write_profile(filename: str, name: str):
+    os.makedirs(main.STRATEGIES_DIR, exist_ok=True)
+    with open(os.path.join(main.STRATEGIES_DIR, filename), 'w', encoding='utf-8') as f:
+        json.dump({'profile_name': name, 'indicator_params': {'rsi_period': 14}, 'confirmation_minutes': 10}, f)
+
+def shadow_result(profile: dict, scores: tuple, raw_scores: tuple) -> tuple:
+    return profile, {PAIR: scores}, {PAIR: raw_scores}, {PAIR: ('NEUTRAL', 'NEUTRAL')}, {}
+
+def profile_totals() -> list:
+    return asyncio.run(main.signal_store.query("SELECT profile, outcome, SUM(count) FROM profile_daily GROUP BY 1, 2 HAVING SUM(count) > 0"))
+
+def test_pending_shadow_confirmations_survive_a_restart(monkeypatch):
+    write_profile('a.json', 'A')
+    write_profile('b.json', 'B')
+    monkeypatch.setattr(main, 'signal_store', main.SignalStore('signals.db'))
+    monkeypatch.setattr(main, 'shadow_profiles', {'signature': None, 'profiles': []})
+    monkeypatch.setattr(main, 'shadow_pending', {})
+    monkeypatch.setattr(main, 'last_scored_bars', {})
+    profiles = dict(main.load_shadow_profiles())
+    main.record_shadow_signals({filename: shadow_result(profile, (5, 1), (0, 0)) for filename, profile in profiles.items()}, {PAIR: BAR})
+    before = dict(main.shadow_pending)
+    assert set(before) == {(PAIR, 'a.json'), (PAIR, 'b.json')}
+
+    # إعادة التشغيل: الذاكرة فارغة وملف B حُذف.
+    main.shadow_pending.clear()
+    os.remove(os.path.join(main.STRATEGIES_DIR, 'b.json'))
+    asyncio.run(main.restore_shadow_pending())
+    assert main.shadow_pending == {(PAIR, 'a.json'): before[(PAIR, 'a.json')]}
+
+    due_bar = BAR + 2 * main.TIMEFRAME_BUCKETS['M5']
+    main.record_shadow_signals({'a.json': shadow_result(profiles['a.json'], (0, 0), (5, 0))}, {PAIR: due_bar})
+    assert main.shadow_pending == {}
+    assert sorted(profile_totals()) == [('A', 'confirmed', 1), ('B', 'expired', 1)]
+
+def test_restore_expires_confirmations_whose_bar_was_already_scored(monkeypatch):
+    write_profile('a.json', 'A')
+    monkeypatch.setattr(main, 'signal_store', main.SignalStore('signals.db'))
+    monkeypatch.setattr(main, 'shadow_profiles', {'signature': None, 'profiles': []})
+    monkeypatch.setattr(main, 'shadow_pending', {})
+    monkeypatch.setattr(main, 'last_scored_bars', {})
+    profile = dict(main.load_shadow_profiles())['a.json']
+    main.record_shadow_signals({'a.json': shadow_result(profile, (0, 5), (0, 0))}, {PAIR: BAR})
+    main.shadow_pending.clear()
+    main.last_scored_bars[PAIR] = BAR + 3 * main.TIMEFRAME_BUCKETS['M5']
+    asyncio.run(main.restore_shadow_pending())
+    assert main.shadow_pending == {}
+    assert profile_totals() == [('A', 'expired', 1)]
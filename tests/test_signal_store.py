@@ -0,0 +1,46 @@
+from datetime import datetime, timezone
+
+import main
+
+def open_store(legacy: dict = None) -> main.SignalStore:
+    store = main.SignalStore('signals.db')
+    store.open(legacy)
+    return store
+
+def owner_totals(store: main.SignalStore) -> dict:
+    rows = store._executor.submit(store._fetch, "SELECT pair, kind, outcome, SUM(count) FROM signal_daily WHERE subscriber = ? "
+                                  "GROUP BY 1, 2, 3", (str(main.TELEGRAM_CHAT_ID),)).result()
+    return {(pair, kind, outcome): count for pair, kind, outcome, count in rows if count}
+
+def test_legacy_counters_are_seeded_once_without_double_counting():
+    now = datetime.now(timezone.utc)
+    store = open_store()
+    initial_id = store.record('initial', 'EUR/USD', 'BUY', now, 4, 1, subscriber=str(main.TELEGRAM_CHAT_ID))
+    store.record('confirmation', 'EUR/USD', 'BUY', now, outcome='confirmed', initial_id=initial_id, subscriber=str(main.TELEGRAM_CHAT_ID))
+    store.resolve(initial_id, 'confirmed')
+    store.flush()
+    store._executor.submit(store._connection.close).result()
+
+    legacy = {'EUR/USD': {'initial': 5, 'confirmed': 2, 'failed_confirmation': 3, 'expired': 0}, 'USD/JPY': {'initial': 1}}
+    for _ in range(2):
+        store = open_store(legacy)
+        assert owner_totals(store) == {('EUR/USD', 'initial', 'confirmed'): 1, ('EUR/USD', 'initial', ''): 4,
+                                       ('EUR/USD', 'confirmation', 'confirmed'): 2, ('EUR/USD', 'confirmation', 'failed'): 3,
+                                       ('USD/JPY', 'initial', ''): 1}
+        store._executor.submit(store._connection.close).result()
+
+def test_ids_continue_after_the_largest_stored_id():
+    now = datetime.now(timezone.utc)
+    store = open_store()
+    first = [store.record('initial', 'EUR/USD', 'SELL', now) for _ in range(3)]
+    store.flush()
+    store._executor.submit(store._connection.close).result()
+    # معرف مستقبلي (ساعة قفزت للخلف أو سجل قديم بمعرفات زمنية) لا يتكرر بعد إعادة الفتح.
+    store = open_store()
+    store._executor.submit(store._write, [(main.INSERT_SIGNAL_SQL, (10 ** 15, now.timestamp(), 'EUR/USD', 'initial', 'BUY', None, None,
+                                                                    None, None, None, None, 'asia', None, None, None, None))]).result()
+    store._executor.submit(store._connection.close).result()
+    store = open_store()
+    assert first == [1, 2, 3]
+    assert store.record('initial', 'EUR/USD', 'BUY', now) == 10 ** 15 + 1
+    store.flush()
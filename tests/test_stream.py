@@ -0,0 +1,166 @@
+import asyncio
+from types import SimpleNamespace
+
+import pandas as pd
+import pytest
+from aiohttp import web
+
+import main
+from conftest import make_candles
+
+PAIR = 'EUR/USD'
+ONE_MINUTE_MS = 60_000
+
+@pytest.fixture(autouse=True)
+def fresh_stream_state(monkeypatch):
+    monkeypatch.setattr(main, 'candle_cache', {})
+    monkeypatch.setattr(main, 'snapshot_buckets', {})
+    monkeypatch.setattr(main, 'last_scored_bars', {})
+    monkeypatch.setattr(main, 'closed_bar_batch', {'histories': {}, 'traces': [], 'scheduled': False})
+    monkeypatch.setattr(main, 'api_request_queue', main.GovernorScheduler())
+    monkeypatch.setattr(main, 'STREAM_BATCH_DELAY_SECONDS', 0.05)
+
+def seed_history(bars: int = 100) -> pd.DataFrame:
+    """تاريخ M5 ينتهي بشمعة مغلقة قُيّمت سابقاً."""
+    df = make_candles(bars)
+    main.candle_cache[(PAIR, 'M5')] = df
+    main.last_scored_bars[PAIR] = df.index[-1]
+    return df
+
+def minute_event(start: pd.Timestamp, price: float = 1.2) -> dict:
+    start_ms = start.value // 1_000_000
+    return {'ev': 'CA', 'pair': PAIR, 'o': price, 'h': price + 0.001, 'l': price - 0.001, 'c': price, 'v': 5,
+            's': start_ms, 'e': start_ms + ONE_MINUTE_MS}
+
+def minute(start: pd.Timestamp, price: float = 1.2) -> dict:
+    event = minute_event(start, price)
+    return {'t': event['s'], 'o': event['o'], 'h': event['h'], 'l': event['l'], 'c': event['c'], 'v': event['v']}
+
+def test_minutes_fold_into_a_complete_bar():
+    df = seed_history()
+    bar = df.index[-1] + main.M5_BUCKET
+    statuses = [main.fold_minute_bar(PAIR, minute(bar + i * main.ONE_MINUTE, 1.2 + i / 1000)) for i in range(5)]
+    assert statuses == ['closed', 'updated', 'updated', 'updated', 'updated']
+    row = main.candle_cache[(PAIR, 'M5')].loc[bar]
+    assert row['Open'] == 1.2 and row['Close'] == 1.204 and row['High'] == pytest.approx(1.205) and row['Volume'] == 25
+    # الشمعة التالية تبدأ فوق شمعة مكتملة، فلا إصلاح.
+    assert main.fold_minute_bar(PAIR, minute(bar + main.M5_BUCKET)) == 'closed'
+
+def test_missing_minute_in_rest_based_bar_is_a_gap():
+    df = seed_history()
+    bar = df.index[-1]
+    # Polygon أعاد الشمعة الجارية بعد دقيقتين من بدايتها، ثم فاتتنا الدقيقة الثالثة في البث.
+    main.note_rest_bar(PAIR, df, (bar + 2 * main.ONE_MINUTE + pd.Timedelta(seconds=10)).to_pydatetime())
+    assert main.fold_minute_bar(PAIR, minute(bar + 2 * main.ONE_MINUTE)) == 'updated'
+    assert main.fold_minute_bar(PAIR, minute(bar + 4 * main.ONE_MINUTE)) == 'gap'
+    # وعند إغلاقها تُحذف لتبنى من جديد بالجلب التزايدي.
+    assert main.fold_minute_bar(PAIR, minute(bar + main.M5_BUCKET)) == 'gap'
+    assert main.candle_cache[(PAIR, 'M5')].index[-1] == df.index[-2]
+
+def test_rest_based_bar_completed_by_stream_closes_normally():
+    df = seed_history()
+    bar = df.index[-1]
+    main.note_rest_bar(PAIR, df, (bar + 3 * main.ONE_MINUTE + pd.Timedelta(seconds=2)).to_pydatetime())
+    assert main.fold_minute_bar(PAIR, minute(bar + 3 * main.ONE_MINUTE)) == 'updated'
+    assert main.fold_minute_bar(PAIR, minute(bar + 4 * main.ONE_MINUTE)) == 'updated'
+    assert main.fold_minute_bar(PAIR, minute(bar + main.M5_BUCKET)) == 'closed'
+
+def test_rest_fetch_of_closed_bar_needs_no_repair():
+    df = seed_history()
+    bar = df.index[-1] + main.M5_BUCKET
+    main.fold_minute_bar(PAIR, minute(bar))
+    # لقطة ناقصة ثم جلب بالنطاق الزمني بعد إغلاق الشمعة: نسخة Polygon هي المرجع.
+    main.note_rest_bar(PAIR, main.candle_cache[(PAIR, 'M5')], (bar + main.M5_BUCKET + pd.Timedelta(seconds=5)).to_pydatetime())
+    assert main.fold_minute_bar(PAIR, minute(bar + main.M5_BUCKET)) == 'closed'
+
+async def serve_websocket(script: list, received: list):
+    """خادم Polygon WebSocket محلي: ينتظر التحقق والاشتراك ثم يرسل دفعات الأحداث في script."""
+    async def handler(request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        received.append(await ws.receive_json())
+        await ws.send_json([{'ev': 'status', 'status': 'auth_success', 'message': 'authenticated'}])
+        received.append(await ws.receive_json())
+        for batch in script: await ws.send_json(batch)
+        async for _ in ws: pass
+        return ws
+
+    app = web.Application()
+    app.router.add_get('/forex', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f"ws://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/forex"
+
+async def wait_until(condition, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline: raise TimeoutError("الشرط لم يتحقق")
+        await asyncio.sleep(0.01)
+
+def test_stream_loop_scores_closed_bars_and_repairs_gaps(monkeypatch):
+    df = seed_history()
+    first, second = df.index[-1] + main.M5_BUCKET, df.index[-1] + 2 * main.M5_BUCKET
+    script = [[minute_event(first + i * main.ONE_MINUTE) for i in range(5)],
+              # الدقيقة الثالثة من الشمعة الثانية لا تصل.
+              [minute_event(second + i * main.ONE_MINUTE) for i in (0, 1, 3)]]
+    scored = []
+
+    async def capture_scores(histories, context):
+        scored.append({pair: history.index[-1] for pair, history in histories.items()})
+
+    monkeypatch.setattr(main, 'score_closed_bars', capture_scores)
+    monkeypatch.setattr(main, 'TELEGRAM_SUBSCRIBER_IDS', {'1', '2'})
+    monkeypatch.setattr(main, 'subscribers', {'1': {'is_running': True, 'selected_pairs': [PAIR], 'indicator_params': {}}})
+    monkeypatch.setattr(main, 'bot_state', {'data_mode': 'stream'})
+    monkeypatch.setattr(main, 'polygon_client', main.PolygonClient('test-key'))
+
+    async def scenario():
+        received = []
+        runner, url = await serve_websocket(script, received)
+        monkeypatch.setattr(main, 'POLYGON_WS_URL', url)
+        task = asyncio.create_task(main.stream_loop(SimpleNamespace(bot=None)))
+        try:
+            await wait_until(lambda: scored and main.api_request_queue.has_pending(f"analysis_{PAIR}"))
+            assert main.stream_state['connected']
+        finally:
+            main.subscribers['1']['is_running'] = False
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await main.polygon_client.close()
+            await runner.cleanup()
+        return received
+
+    received = asyncio.run(scenario())
+    assert received[0] == {'action': 'auth', 'params': main.POLYGON_API_KEY}
+    assert received[1] == {'action': 'subscribe', 'params': 'CA.C:EUR-USD'}
+    # الشمعة الأولى اكتملت بوصول دقيقتها الأخيرة فقُيّمت، والثانية ناقصة فطُلب إصلاحها ولم تُقيّم.
+    assert scored == [{PAIR: first}]
+    assert main.last_scored_bars[PAIR] == first
+
+def test_folding_keeps_the_history_long_trend_periods_need(monkeypatch):
+    monkeypatch.setattr(main, 'TELEGRAM_SUBSCRIBER_IDS', {'1', '2'})
+    monkeypatch.setattr(main, 'subscribers', {'1': {'is_running': True, 'selected_pairs': [PAIR], 'indicator_params': {'h1_ema_period': 100}}})
+    required = main.required_history()
+    assert required > main.CANDLE_CACHE_MAX_BARS
+    df = seed_history(required)
+    bar = df.index[-1] + main.M5_BUCKET
+    assert main.fold_minute_bar(PAIR, minute(bar)) == 'closed'
+    assert main.fold_minute_bar(PAIR, minute(bar + main.ONE_MINUTE)) == 'updated'
+    assert len(main.candle_cache[(PAIR, 'M5')]) == required
+
+def test_bulk_snapshot_scores_each_closed_bar_once(monkeypatch):
+    scored = []
+    async def score_closed_bars(histories, context): scored.append({pair: df.index[-1] for pair, df in histories.items()})
+    monkeypatch.setattr(main, 'score_closed_bars', score_closed_bars)
+    df = seed_history()
+    main.candle_cache[(PAIR, 'M5')] = pd.concat([df, make_candles(1, start=df.index[-1] + main.M5_BUCKET)])
+    main.last_scored_bars.pop(PAIR)
+    result = {'gap': [], 'closed': [PAIR]}
+    asyncio.run(main.bulk_snapshot_callback(result, None, None))
+    assert scored == [{PAIR: df.index[-1]}] and main.last_scored_bars[PAIR] == df.index[-1]
+    # الإصلاح يعيد الشمعة نفسها عبر m5_callback: لا تقييم ثانٍ.
+    asyncio.run(main.bulk_snapshot_callback(result, None, None))
+    asyncio.run(main.m5_callback(main.candle_cache[(PAIR, 'M5')].iloc[:-1], PAIR, None))
+    assert len(scored) == 1 and not main.closed_bar_batch['histories']
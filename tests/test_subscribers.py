@@ -0,0 +1,14 @@
+import main
+
+def test_chat_removed_from_the_env_list_loses_access_and_signals(monkeypatch):
+    owner = str(main.TELEGRAM_CHAT_ID)
+    monkeypatch.setattr(main, 'TELEGRAM_SUBSCRIBER_IDS', {'1'})
+    monkeypatch.setattr(main, 'subscribers', {owner: {'is_running': False, 'selected_pairs': ['USD/JPY']},
+                                              '1': {'is_running': True, 'selected_pairs': ['EUR/USD']},
+                                              '2': {'is_running': True, 'selected_pairs': ['AUD/USD']}})
+    assert main.is_allowed_chat(owner) and main.is_allowed_chat('1')
+    # '2' ما زال في ملف الحالة ويعمل، لكنه حُذف من TELEGRAM_SUBSCRIBER_IDS.
+    assert not main.is_allowed_chat('2')
+    assert list(main.running_subscribers()) == ['1']
+    assert main.watched_pairs() == ['EUR/USD']
+    assert [chat_ids for _, chat_ids in main.evaluation_groups().values()] == [['1']]